@@ -0,0 +1,258 @@
+import numpy as np
+import hashlib
+import glob
+import os
+import tempfile
+import uuid
+
+
+### ==================================================
+### Caching of results
+### ==================================================
+
+def fingerprint(*objs):
+    '''
+    Stable hash (hex string) of numbers, strings, arrays, containers, and the
+    public attributes of objects such as PulsarNoise, GalacticNoise, and TelescopeNoise
+    '''
+    h = hashlib.sha1()
+    def update(obj):
+        if isinstance(obj,np.ndarray):
+            h.update(("ndarray%s%s"%(obj.dtype.str,obj.shape)).encode())
+            h.update(np.ascontiguousarray(obj).tobytes())
+        elif isinstance(obj,(list,tuple)):
+            h.update(("%s%i"%(type(obj).__name__,len(obj))).encode())
+            for x in obj:
+                update(x)
+        elif isinstance(obj,dict):
+            h.update(("dict%i"%len(obj)).encode())
+            for key in sorted(obj,key=repr):
+                update(key)
+                update(obj[key])
+        elif hasattr(obj,"__dict__") and not callable(obj):
+            h.update(type(obj).__name__.encode())
+            update(dict((key,value) for key,value in vars(obj).items() if not key.startswith("_")))
+        elif callable(obj): # the repr of functions includes their address
+            h.update(("%s.%s"%(getattr(obj,"__module__",""),getattr(obj,"__qualname__",type(obj).__name__))).encode())
+        else:
+            if isinstance(obj,np.generic):
+                obj = obj.item()
+            h.update(("%s:%r;"%(type(obj).__name__,obj)).encode())
+    for obj in objs:
+        update(obj)
+    return h.hexdigest()
+
+
+def cell_keys(nus,bits=36):
+    '''
+    Keys for the channel frequencies of each cell, nus of shape (ncells,nchan).
+    Frequencies are rounded to bits bits of mantissa, so that cells of grids
+    constructed in different ways (e.g., with a wider frequency range) match
+    despite floating-point noise.
+    '''
+    mantissas,exponents = np.frexp(np.asarray(nus,dtype=float))
+    rounded = np.concatenate((np.round(mantissas*2**bits),exponents),axis=-1).astype(np.int64)
+    return [hashlib.sha1(row.tobytes()).hexdigest() for row in np.reshape(rounded,(-1,rounded.shape[-1]))]
+
+
+def atomic_write(filename,write):
+    '''
+    Call write(FILE) on a temporary file that then replaces filename, so that readers never see partial files
+    '''
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd,tmpname = tempfile.mkstemp(dir=directory,suffix=".tmp")
+    try:
+        with os.fdopen(fd,"wb") as FILE:
+            write(FILE)
+        os.replace(tmpname,filename)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+
+def atomic_savez(filename,**kwargs):
+    '''
+    np.savez() with atomic_write()
+    '''
+    atomic_write(filename,lambda FILE: np.savez(FILE,**kwargs))
+
+
+def atomic_save(filename,array):
+    '''
+    np.save() with atomic_write()
+    '''
+    atomic_write(filename,lambda FILE: np.save(FILE,array))
+
+
+class CellStore:
+    '''
+    Memo of sigma_TOA for individual grid cells, keyed by a fingerprint of the
+    inputs (see FrequencyOptimizer.get_fingerprint()) and by the channel
+    frequencies of each cell. Re-running calc() on a wider or finer grid then
+    only computes the cells that were not computed before, as long as the new
+    grid contains the old cells: linear grids with the same numin and dnu, or
+    log grids with the same numin and nsteps whose ranges are whole numbers of
+    steps, e.g., whole decades (other log grids do not share cells).
+
+    directory: If not None, each store() also writes its cells to a new file
+               directory/<fingerprint>.<id>.npz so that they persist between
+               runs and can be added by several processes at once. Loading
+               merges more than max_shards such files into one.
+    '''
+    def __init__(self,directory=None,max_shards=16):
+        self.directory = directory
+        self.max_shards = max_shards
+        self.cells = dict()
+        if directory is not None:
+            os.makedirs(directory,exist_ok=True)
+
+    def get_shards(self,fingerprint):
+        '''
+        Files of the cells stored on disk for fingerprint
+        '''
+        if self.directory is None:
+            return []
+        return sorted(glob.glob(os.path.join(self.directory,"%s*.npz"%fingerprint)))
+
+    def load(self,fingerprint):
+        '''
+        Return the cells stored on disk for fingerprint as a dictionary
+        '''
+        cells = dict()
+        shards = []
+        for filename in self.get_shards(fingerprint):
+            try:
+                with np.load(filename) as data:
+                    cells.update(zip(data['keys'].tolist(),data['sigmas'].tolist()))
+            except (OSError,ValueError): # merged by another process
+                continue
+            shards.append(filename)
+        if len(shards) > self.max_shards:
+            self.write(fingerprint,cells)
+            for filename in shards:
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+        return cells
+
+    def write(self,fingerprint,cells):
+        filename = os.path.join(self.directory,"%s.%s.npz"%(fingerprint,uuid.uuid4().hex))
+        atomic_savez(filename,keys=np.array(list(cells.keys())),sigmas=np.array(list(cells.values()),dtype=float))
+
+    def get_cells(self,fingerprint):
+        if fingerprint not in self.cells:
+            self.cells[fingerprint] = self.load(fingerprint)
+        return self.cells[fingerprint]
+
+    def lookup(self,fingerprint,nus):
+        '''
+        Return the stored sigmas for channel frequencies nus of shape (ncells,nchan), and whether each cell was found
+        '''
+        cells = self.get_cells(fingerprint)
+        keys = cell_keys(nus)
+        sigmas = np.zeros(len(keys)) + np.nan
+        found = np.zeros(len(keys),dtype=bool)
+        for i,key in enumerate(keys):
+            if key in cells:
+                sigmas[i] = cells[key]
+                found[i] = True
+        return sigmas,found
+
+    def store(self,fingerprint,nus,sigmas):
+        '''
+        Add the sigmas for channel frequencies nus of shape (ncells,nchan), and write them to disk if a directory is set
+        '''
+        new = dict(zip(cell_keys(nus),np.ravel(sigmas).tolist()))
+        self.get_cells(fingerprint).update(new)
+        if self.directory is not None and len(new) > 0:
+            self.write(fingerprint,new)
+
+    def clear(self):
+        self.cells.clear()
+
+
+def file_fingerprint(*filenames):
+    '''
+    Hash of the contents of files, e.g., ampratios.npz or the source code
+    '''
+    h = hashlib.sha1()
+    for filename in filenames:
+        h.update(os.path.basename(filename).encode())
+        with open(filename,"rb") as FILE:
+            for block in iter(lambda: FILE.read(2**20),b""):
+                h.update(block)
+    return h.hexdigest()
+
+
+class RunCache:
+    '''
+    Content-addressed cache of whole calc() results, one directory/<key>.npz
+    per run, where the key is a fingerprint of all of the inputs (see
+    FrequencyOptimizer.get_run_key()).
+
+    maxsize: Maximum total size (bytes) of the cache. The least recently used
+             runs are removed when a new run is stored.
+
+    Files are written atomically, so several processes can share a directory.
+    '''
+    def __init__(self,directory,maxsize=2**30):
+        self.directory = directory
+        self.maxsize = maxsize
+        os.makedirs(directory,exist_ok=True)
+
+    def get_filename(self,key):
+        return os.path.join(self.directory,"%s.npz"%key)
+
+    def load(self,key):
+        '''
+        Return a dictionary of the arrays stored for key, or None if there are none
+        '''
+        filename = self.get_filename(key)
+        try:
+            with np.load(filename) as data:
+                retval = dict((name,data[name]) for name in data.files)
+            os.utime(filename) # mark as recently used
+        except (OSError,ValueError):
+            return None
+        return retval
+
+    def store(self,key,**arrays):
+        atomic_savez(self.get_filename(key),**arrays)
+        self.evict()
+
+    def get_entries(self):
+        '''
+        Return (mtime, size, filename) of the runs in the cache, least recently used first
+        '''
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npz"):
+                continue
+            filename = os.path.join(self.directory,name)
+            try:
+                stat = os.stat(filename)
+            except OSError: # removed by another process
+                continue
+            entries.append((stat.st_mtime,stat.st_size,filename))
+        return sorted(entries)
+
+    def evict(self):
+        entries = self.get_entries()
+        total = sum(size for mtime,size,filename in entries)
+        for mtime,size,filename in entries[:-1]: # always keep the newest run
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for mtime,size,filename in self.get_entries():
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
@@ -0,0 +1,491 @@
+import numpy as np
+import importlib.util
+import os
+import zipfile
+import xml.etree.ElementTree as ET
+from frequencyoptimizer import PulsarNoise,TelescopeNoise,GalacticNoise
+from frequencyoptimizer import FrequencyOptimizer
+import frequencyoptimizer
+import parallel
+import cache
+import shards
+
+NCHAN = 16
+NSTEPS = 16
+
+Tcmb = 3.0
+
+# Columns of psr_info.ods that are named differently in psr_info.txt and psr_info.py
+COLUMN_ALIASES = {"PSR":"name","P":"period","I_1GHz":"flux_1GHz","Uscale":"uscale"}
+
+# Columns kept sorted in the catalog cache for range queries
+INDEXED_COLUMNS = ["DM","flux_1GHz"]
+
+# Version of the layout of the catalog cache
+CATALOG_VERSION = 1
+
+ODS_NAMESPACES = {"table":"urn:oasis:names:tc:opendocument:xmlns:table:1.0",
+                  "office":"urn:oasis:names:tc:opendocument:xmlns:office:1.0"}
+
+
+### ==================================================
+### Pulsar catalogs
+### ==================================================
+
+def read_table(filename):
+    '''
+    Read a whitespace-delimited table with a header line (e.g., psr_info.txt) as a list of column names
+    and a list of rows of strings, with None for missing values
+    '''
+    with open(filename,"r") as FILE:
+        lines = [line.split() for line in FILE if line.strip() != ""]
+    rows = [[None if value == "None" else value for value in sline] for sline in lines[1:]]
+    return lines[0],rows
+
+
+def read_ods(filename):
+    '''
+    Read the first sheet of an OpenDocument spreadsheet (e.g., psr_info.ods) like read_table(). The first
+    row holds the column names; rows without a name in the first column (e.g., units) are skipped.
+    '''
+    def tag(ns,name):
+        return "{%s}%s"%(ODS_NAMESPACES[ns],name)
+    with zipfile.ZipFile(filename) as z:
+        root = ET.fromstring(z.read("content.xml"))
+    sheet = next(root.iter(tag("table","table")))
+    lines = []
+    for row in sheet.iter(tag("table","table-row")):
+        line = []
+        for cell in row:
+            if cell.tag not in [tag("table","table-cell"),tag("table","covered-table-cell")]:
+                continue
+            kind = cell.get(tag("office","value-type"))
+            if kind is None:
+                value = None
+            elif kind in ["float","percentage","currency"]:
+                value = cell.get(tag("office","value"))
+            else:
+                value = "".join(cell.itertext())
+            line.extend([value]*int(cell.get(tag("table","number-columns-repeated"),1)))
+        if len(line) > 0 and line[0] not in [None,""]:
+            lines.append(line)
+    keys = lines[0]
+    while keys[-1] in [None,""]:
+        keys = keys[:-1]
+    keys = [COLUMN_ALIASES.get(key,key) for key in keys]
+    rows = [[None if value in ["","None"] else value for value in line[:len(keys)]] for line in lines[1:]]
+    return keys,rows
+
+
+def make_columns(keys,rows):
+    '''
+    Typed columns from rows of strings: numeric columns become float arrays and all others string
+    arrays. Returns dictionaries of the columns and of boolean arrays marking missing values (NaN or "").
+    '''
+    columns = dict()
+    missing = dict()
+    for i,key in enumerate(keys):
+        values = [row[i] if i < len(row) else None for row in rows]
+        missing[key] = np.array([value is None for value in values],dtype=bool)
+        try:
+            columns[key] = np.array([np.nan if value is None else float(value) for value in values],dtype=float)
+        except ValueError:
+            columns[key] = np.array(["" if value is None else value for value in values],dtype=str)
+    return columns,missing
+
+
+class Catalog:
+    '''
+    Pulsar catalog as typed columns, read from a table (e.g., psr_info.txt) or spreadsheet (psr_info.ods).
+    The columns are cached in binary form in the directory filename+".cache" (or cachedir) and memory-mapped,
+    so that opening the catalog and looking up pulsars takes about the same time for any catalog size. The
+    cache is rebuilt when the source file changes. If the cache cannot be written, the columns are kept in
+    memory instead.
+
+    Lookups: get(name) returns one pulsar as a dictionary, in the format of psr_info.py with None for
+    missing values; select(key,low,high) returns the names with low <= key <= high for an indexed
+    column (INDEXED_COLUMNS), sorted by key.
+    '''
+    def __init__(self,filename,cachedir=None):
+        self.filename = filename
+        self.cachedir = filename+".cache" if cachedir is None else cachedir
+        if self.load():
+            return
+        keys,arrays = self.build()
+        if not self.load():
+            # the cache could not be written (e.g., a read-only directory) or was replaced meanwhile by
+            # another process, for a newer source: use the columns just read
+            self.use(keys,arrays)
+
+    def get_source_info(self):
+        stat = os.stat(self.filename)
+        return [CATALOG_VERSION,stat.st_mtime_ns,stat.st_size]
+
+    def get_filename(self,name):
+        return os.path.join(self.cachedir,"%s.npy"%name)
+
+    def build(self):
+        '''
+        Read the source file and write the cache, if possible. Returns the column names and the arrays.
+        Every file is replaced atomically, so that processes building the same cache at once do not fail.
+        '''
+        info = self.get_source_info() # before reading, so that a concurrent change triggers a rebuild
+        if self.filename.endswith(".ods"):
+            keys,rows = read_ods(self.filename)
+        else:
+            keys,rows = read_table(self.filename)
+        columns,missing = make_columns(keys,rows)
+        names = columns[keys[0]]
+        arrays = dict()
+        for i,key in enumerate(keys):
+            arrays["column_%i"%i] = columns[key]
+            arrays["missing_%i"%i] = missing[key]
+        order = np.argsort(names,kind="stable")
+        arrays["names_sorted"] = names[order]
+        arrays["names_order"] = order
+        for key in INDEXED_COLUMNS:
+            if key in columns and columns[key].dtype.kind == "f":
+                order = np.nonzero(~missing[key])[0]
+                order = order[np.argsort(columns[key][order],kind="stable")]
+                arrays["%s_sorted"%key] = columns[key][order]
+                arrays["%s_order"%key] = order
+        try:
+            os.makedirs(self.cachedir,exist_ok=True)
+            for name,array in arrays.items():
+                cache.atomic_save(self.get_filename(name),array)
+            cache.atomic_savez(os.path.join(self.cachedir,"info.npz"),keys=np.array(keys,dtype=str),source=np.array(info))
+        except OSError:
+            pass
+        return keys,arrays
+
+    def load(self):
+        '''
+        Memory-map the cache, returns False if it is missing or out of date
+        '''
+        try:
+            with np.load(os.path.join(self.cachedir,"info.npz")) as data:
+                keys = data['keys'].tolist()
+                source = data['source'].tolist()
+            if source != self.get_source_info():
+                return False
+            names = ["%s_%i"%(kind,i) for i in range(len(keys)) for kind in ["column","missing"]]
+            names += ["%s_%s"%(key,kind) for key in ["names"] + INDEXED_COLUMNS for kind in ["sorted","order"]
+                      if os.path.exists(self.get_filename("%s_order"%key))]
+            self.use(keys,dict((name,np.load(self.get_filename(name),mmap_mode='r')) for name in names))
+        except (OSError,ValueError,KeyError):
+            return False
+        return True
+
+    def use(self,keys,arrays):
+        '''
+        Set the columns and indexes from the arrays of the cache, memory-mapped or in memory
+        '''
+        self.keys = keys
+        self.columns = dict((key,arrays["column_%i"%i]) for i,key in enumerate(keys))
+        self.missing = dict((key,arrays["missing_%i"%i]) for i,key in enumerate(keys))
+        self.indexes = dict((key,(arrays["%s_sorted"%key],arrays["%s_order"%key])) for key in ["names"] + INDEXED_COLUMNS
+                            if "%s_order"%key in arrays)
+
+    def __len__(self):
+        return len(self.columns[self.keys[0]])
+
+    def __contains__(self,name):
+        return self.find(name) is not None
+
+    @property
+    def names(self):
+        return self.columns[self.keys[0]]
+
+    def find(self,name):
+        '''
+        Row of the pulsar with the given name, or None
+        '''
+        names,order = self.indexes["names"]
+        i = np.searchsorted(names,name)
+        if i < len(names) and names[i] == name:
+            return int(order[i])
+        return None
+
+    def get_row(self,i):
+        '''
+        Row i as a dictionary, in the format of psr_info.py
+        '''
+        psr = dict()
+        for key in self.keys:
+            if self.missing[key][i]:
+                psr[key] = None
+            elif self.columns[key].dtype.kind == "f":
+                psr[key] = float(self.columns[key][i])
+            else:
+                psr[key] = str(self.columns[key][i])
+        psr["name"] = str(self.names[i])
+        return psr
+
+    def get(self,name):
+        i = self.find(name)
+        if i is None:
+            raise KeyError(name)
+        return self.get_row(i)
+
+    def select(self,key,low=-np.inf,high=np.inf):
+        '''
+        Names of the pulsars with low <= key <= high, sorted by key, for a column in INDEXED_COLUMNS
+        '''
+        if key not in self.indexes:
+            raise KeyError("No index for column %s"%key)
+        values,order = self.indexes[key]
+        start = np.searchsorted(values,low,side="left")
+        stop = np.searchsorted(values,high,side="right")
+        return [str(self.names[i]) for i in order[start:stop]]
+
+    def to_dict(self):
+        '''
+        All pulsars as a dictionary of dictionaries keyed by name, as load_catalog() returns
+        '''
+        return dict((str(self.names[i]),self.get_row(i)) for i in range(len(self)))
+
+
+def load_catalog(filename):
+    '''
+    Load a pulsar catalog as a dictionary of dictionaries keyed by pulsar name, either from a
+    python file containing one dictionary of dictionaries (e.g., psr_info.py), from a
+    whitespace-delimited table with a header line (e.g., psr_info.txt), or from a spreadsheet
+    (psr_info.ods); see Catalog for the latter two
+    '''
+    if not os.path.exists(filename) and os.path.exists(filename+".py"):
+        filename += ".py"
+    if filename.endswith(".py"):
+        name = os.path.splitext(os.path.basename(filename))[0]
+        spec = importlib.util.spec_from_file_location(name,filename)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        for a in dir(module):
+            if not a.startswith("__") and isinstance(getattr(module,a),dict):
+                return getattr(module,a)
+        raise ValueError("No dictionary found in %s"%filename)
+    return Catalog(filename).to_dict()
+
+
+def make_pulsar_noise(name,psr,tobs=1800.0,nchan=NCHAN):
+    '''
+    Return the PulsarNoise for a catalog entry (see predict_toas.py for the keys),
+    or None if parameters are missing
+    '''
+    psr = dict(psr)
+    if psr.get("W50") is None and psr.get("Weff") is not None:
+        psr["W50"] = 0.66*psr["Weff"]
+    if psr.get("scat_ts") is None and psr.get("DM") is not None:
+        import psr_utils as pu
+        psr["scat_ts"] = 1000*pu.pulse_broadening(psr["DM"],1000.0)
+    keys = ["period","DM","flux_1GHz","spec_index","W50","Weff","uscale","rms_J1","scat_ts","scat_ts_var","diss_ts"]
+    if any(psr.get(key) is None for key in keys):
+        return None
+    return PulsarNoise(
+        name,alpha=-psr["spec_index"],I_0=psr["flux_1GHz"],DM=psr["DM"],
+        taud=psr["scat_ts"]*1.5**4.4,tauvar=psr["scat_ts_var"]*1.5**4.4*0.5,
+        dtd=psr["diss_ts"],P=psr["period"],Uscale=psr["uscale"],
+        sigma_Js=np.zeros(nchan)+psr["rms_J1"] / \
+        np.sqrt(1000*tobs/psr["period"]),
+        Weffs=np.zeros(nchan)+psr["Weff"],W50s=np.zeros(nchan)+psr["W50"])
+
+
+def make_telescope_noise(rx_specs=None,gain=2.0,Trx=20.0,epsilon=0.01,tobs=1800.0,low_freq=1.0,high_freq=2.0):
+    '''
+    Return the TelescopeNoise and frequency range for a receiver spec file with columns
+    Frequency(GHz) Trx(K) Gain(K/Jy) FractionalGainError, or for frequency-independent values
+    '''
+    if rx_specs is not None:
+        rx_freq,Trx,gain,epsilon = np.loadtxt(rx_specs,unpack=True)
+        return TelescopeNoise(gain=gain,T_const=Trx+Tcmb,epsilon=epsilon,T=tobs,rx_nu=rx_freq,interpolate=True),np.min(rx_freq),np.max(rx_freq)
+    return TelescopeNoise(gain=gain,T_const=Trx+Tcmb,epsilon=epsilon,T=tobs),low_freq,high_freq
+
+
+def read_telescopes(filename,tobs=1800.0):
+    '''
+    Read a table of telescope configurations (whitespace-delimited with a header line, or a spreadsheet)
+    for FrequencyOptimizer.calc_sweep(). All columns are optional:
+
+    name - Configuration name
+    rx_specs - Receiver spec file (receiver_specs.txt format, relative to the table), which
+               replaces gain, Trx, and epsilon
+    gain - Telescope gain (K/Jy)
+    Trx - Receiver temperature (K)
+    epsilon - Fractional gain instability
+    pi_V - Degree of circular polarization
+    Npol - Number of polarizations
+    tobs - Observing time (s)
+
+    Returns the names and the TelescopeNoise of the configurations
+    '''
+    if filename.endswith(".ods"):
+        keys,rows = read_ods(filename)
+    else:
+        keys,rows = read_table(filename)
+    directory = os.path.dirname(os.path.abspath(filename))
+    defaults = dict(gain=2.0,Trx=20.0,epsilon=0.01,pi_V=0.1,Npol=2,tobs=tobs)
+    names = []
+    telnoises = []
+    for i,row in enumerate(rows):
+        config = dict((key,value) for key,value in zip(keys,row) if value is not None)
+        values = dict((key,float(config.get(key,value))) for key,value in defaults.items())
+        rx_specs = config.get("rx_specs")
+        if rx_specs is not None:
+            rx_specs = os.path.join(directory,rx_specs)
+        telnoise = make_telescope_noise(rx_specs,gain=values["gain"],Trx=values["Trx"],epsilon=values["epsilon"],tobs=values["tobs"])[0]
+        telnoise.pi_V = values["pi_V"]
+        telnoise.Npol = int(values["Npol"])
+        names.append(config.get("name","config%i"%i))
+        telnoises.append(telnoise)
+    return names,telnoises
+
+
+### ==================================================
+### Catalog grid runs
+### ==================================================
+
+def write_result(freqopt,outdir,plot=False):
+    '''
+    Save one pulsar's grid and append its optimum to the summary table
+    '''
+    name = freqopt.psrnoise.name
+    freqopt.save(os.path.join(outdir,"%s.npz"%name))
+    if np.all(np.isnan(freqopt.sigmas)):
+        MINC,MINB,MIN = np.nan,np.nan,np.nan
+    else:
+        MINC,MINB = freqopt.get_optimum()
+        MIN = frequencyoptimizer.grid_extrema(freqopt.sigmas)[0]
+    with open(os.path.join(outdir,"summary.txt"),'a') as FILE:
+        FILE.write("%-12s %10.5f %10.5f %12.5f\n"%(name,MINC,MINB,MIN))
+    if plot:
+        freqopt.plot(os.path.join(outdir,"%s.png"%name),doshow=False)
+    return MINC,MINB,MIN
+
+
+def make_optimizers(psrs,telnoise,numin,numax,tobs=1800.0,nchan=NCHAN,nsteps=NSTEPS,verbose=True,**kwargs):
+    '''
+    Return a dictionary of FrequencyOptimizers for the pulsars in a catalog that have all parameters
+    '''
+    galnoise = GalacticNoise()
+    freqopts = dict()
+    for name,psr in psrs.items():
+        psrnoise = make_pulsar_noise(name,psr,tobs,nchan)
+        if psrnoise is None:
+            if verbose:
+                print("Skipping %s, missing parameters"%name)
+            continue
+        freqopts[name] = FrequencyOptimizer(psrnoise,galnoise,telnoise,numin=numin,numax=numax,nchan=nchan,log=True,nsteps=nsteps,
+                                            frac_bw=False,full_bandwidth=False,masks=None,verbose=False,**kwargs)
+    return freqopts
+
+
+def start_summary(outdir):
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    with open(os.path.join(outdir,"summary.txt"),'w') as FILE:
+        FILE.write("#%-11s %10s %10s %12s\n"%("name","C(GHz)","B(GHz)","sigma(us)"))
+
+
+def get_processes(freqopts):
+    '''
+    Number of processes for computing the grids of all pulsars together, from FrequencyOptimizer.get_processes()
+    '''
+    if len(freqopts) == 0:
+        return 1
+    freqopt = next(iter(freqopts.values()))
+    Cs,Bs,valid = freqopt.get_grid()
+    ratios = (Cs[valid]+Bs[valid]/2.0)/(Cs[valid]-Bs[valid]/2.0)
+    ncells = sum(np.sum(f.get_grid()[2]) for f in freqopts.values())
+    return freqopt.get_processes(ncells,len(np.unique(np.round(ratios,10))))[0]
+
+
+# FrequencyOptimizer arguments that only calc() honors (stores, checkpoints, output files, executor)
+CALC_KWARGS = ["cell_store","run_cache","checkpoint","output","executor"]
+
+def run_catalog(psrs,telnoise,outdir,numin,numax,tobs=1800.0,nchan=NCHAN,nsteps=NSTEPS,ncpu=1,plot=False,verbose=True,**kwargs):
+    '''
+    Run FrequencyOptimizer.calc() for every pulsar in a catalog (see load_catalog()), writing
+    outdir/<name>.npz and a line of outdir/summary.txt as each pulsar finishes.
+
+    With ncpu > 1, blocks of grid rows of all pulsars are handed out together to a pool of workers,
+    unless one of CALC_KWARGS is given: then each pulsar runs calc() in turn, with ncpu processes.
+    ncpu="auto" chooses the number of processes as calc() does, for the cells of all pulsars together.
+    Additional keyword arguments are passed to FrequencyOptimizer.
+    Returns a dictionary of the FrequencyOptimizers by pulsar name.
+    '''
+    if ncpu != "auto" and (not isinstance(ncpu,(int,np.integer)) or ncpu < 1):
+        raise ValueError("ncpu must be a positive integer or \"auto\", not %r"%(ncpu,))
+    start_summary(outdir)
+    freqopts = make_optimizers(psrs,telnoise,numin,numax,tobs,nchan,nsteps,verbose,**kwargs)
+    for freqopt in freqopts.values():
+        freqopt.ncpu = ncpu
+
+    calc = any(kwargs.get(key) is not None for key in CALC_KWARGS)
+    if ncpu != 1 and not calc:
+        ncpu = get_processes(freqopts)
+    if ncpu == 1 or calc:
+        for name,freqopt in freqopts.items():
+            freqopt.calc()
+            MINC,MINB,MIN = write_result(freqopt,outdir,plot)
+            if verbose:
+                print("%-10s   %.3f   %.3f   %.3f"%(name,MINC,MINB,MIN))
+        return freqopts
+
+    # Blocks of rows of every pulsar, in catalog order so that pulsars finish one after another
+    items = []
+    remaining = dict()
+    for name,freqopt in freqopts.items():
+        valid = freqopt.get_grid()[2]
+        freqopt.sigmas = np.zeros(np.shape(valid)) + np.nan
+        freqopt.exact = np.zeros(np.shape(valid),dtype=bool)
+        block_size = freqopt.get_chunk_size(np.sum(valid),ncpu)*ncpu
+        blocks = list(frequencyoptimizer.iter_rows(valid,block_size))
+        items.extend([(name,rows) for rows in blocks])
+        remaining[name] = len(blocks)
+
+    executor = parallel.get_executor(ncpu)
+    for i,(sigmas,valid) in executor.imap_unordered(frequencyoptimizer.calc_rows,[(freqopts[name],rows) for name,rows in items]):
+        name,rows = items[i]
+        freqopt = freqopts[name]
+        freqopt.sigmas[rows] = sigmas
+        freqopt.exact[rows] = valid
+        remaining[name] -= 1
+        if remaining[name] == 0:
+            MINC,MINB,MIN = write_result(freqopt,outdir,plot)
+            if verbose:
+                print("%-10s   %.3f   %.3f   %.3f"%(name,MINC,MINB,MIN))
+    return freqopts
+
+
+def run_catalog_shard(psrs,telnoise,outdir,numin,numax,index,nshards,tobs=1800.0,nchan=NCHAN,nsteps=NSTEPS,verbose=True,**kwargs):
+    '''
+    Compute shard index (0 <= index < nshards) of the grids of all pulsars in a catalog and write
+    it to outdir/shard_<index>_of_<nshards>.npz. Each shard can run as an independent job;
+    merge_catalog_shards() combines them.
+    '''
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    freqopts = make_optimizers(psrs,telnoise,numin,numax,tobs,nchan,nsteps,verbose,**kwargs)
+    filename = shards.get_filename(outdir,index,nshards)
+    pieces = shards.calc_shard(freqopts,index,nshards,filename)
+    if verbose:
+        print("Wrote %s (%i blocks of rows)"%(filename,len(pieces)))
+    return filename
+
+
+def merge_catalog_shards(psrs,telnoise,outdir,numin,numax,nshards,tobs=1800.0,nchan=NCHAN,nsteps=NSTEPS,plot=False,verbose=True,**kwargs):
+    '''
+    Merge the shards written by run_catalog_shard() into the same outdir/<name>.npz files and
+    summary table as run_catalog()
+    '''
+    freqopts = make_optimizers(psrs,telnoise,numin,numax,tobs,nchan,nsteps,verbose,**kwargs)
+    results = shards.merge_shards([shards.get_filename(outdir,index,nshards) for index in range(nshards)])
+    start_summary(outdir)
+    for name,freqopt in freqopts.items():
+        if name not in results:
+            raise ValueError("No results for %s in the shards"%name)
+        freqopt.sigmas = results[name]['sigmas']
+        freqopt.exact = results[name]['exact']
+        MINC,MINB,MIN = write_result(freqopt,outdir,plot)
+        if verbose:
+            print("%-10s   %.3f   %.3f   %.3f"%(name,MINC,MINB,MIN))
+    return freqopts
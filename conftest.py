@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from frequencyoptimizer import PulsarNoise,GalacticNoise,TelescopeNoise,FrequencyOptimizer
+
+
+def make_pulsar_noise(name="J1744-1134",nchan=8,**kwargs):
+    '''
+    PulsarNoise with the parameters of J1744-1134 in the README, which kwargs replace
+    '''
+    params = dict(alpha=1.49,taud=26.1e-3,I_0=4.888,DM=3.14,D=0.41,tauvar=12.2e-3,dtd=1272.2,
+                  Weffs=np.zeros(nchan)+511.0,W50s=np.zeros(nchan)+136.8,sigma_Js=np.zeros(nchan)+0.066,P=4.074545941439190)
+    params.update(kwargs)
+    return PulsarNoise(name,**params)
+
+
+def make_optimizer(nchan=8,nsteps=4,log=True,psrnoise=None,telnoise=None,**kwargs):
+    '''
+    FrequencyOptimizer over 0.1-10 GHz for make_pulsar_noise() and a simple telescope
+    '''
+    if psrnoise is None:
+        psrnoise = make_pulsar_noise(nchan=nchan)
+    if telnoise is None:
+        telnoise = TelescopeNoise(gain=2.0,T_const=30)
+    kwargs.setdefault("numin",0.1)
+    kwargs.setdefault("numax",10.0)
+    return FrequencyOptimizer(psrnoise,GalacticNoise(),telnoise,nchan=nchan,log=log,nsteps=nsteps,verbose=False,**kwargs)
+
+
+@pytest.fixture
+def pulsar_noise():
+    return make_pulsar_noise
+
+
+@pytest.fixture
+def optimizer():
+    return make_optimizer
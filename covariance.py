@@ -0,0 +1,85 @@
+import numpy as np
+
+
+### ==================================================
+### Structured covariance matrices
+### ==================================================
+
+class StructuredCovariance:
+    '''
+    Covariance matrix, or stack of covariance matrices, of the form
+
+    C = diag(d) + U U^T
+
+    d: Diagonal, array of shape (...,N)
+    U: Low-rank factors, array of shape (...,N,k) with k << N
+
+    Solves use the Woodbury identity (Sherman-Morrison for k=1) and cost
+    O(N k^2) instead of the O(N^3) of a dense inversion. Matrices with a
+    non-positive diagonal element fall back to a dense solve.
+    '''
+    def __init__(self,d,U=None):
+        d = np.asarray(d,dtype=float)
+        if U is None:
+            U = np.zeros(d.shape+(0,))
+        U = np.asarray(U,dtype=float)
+        shape = np.broadcast_shapes(d.shape,U.shape[:-1])
+        self.d = np.broadcast_to(d,shape)
+        self.U = np.broadcast_to(U,shape+(U.shape[-1],))
+
+    @property
+    def shape(self):
+        return self.d.shape[:-1]
+
+    @property
+    def N(self):
+        return self.d.shape[-1]
+
+    def __add__(self,other):
+        if not isinstance(other,StructuredCovariance):
+            return NotImplemented
+        d = self.d + other.d
+        U1,U2 = self.U,other.U
+        shape = d.shape
+        U = np.concatenate((np.broadcast_to(U1,shape+(U1.shape[-1],)),np.broadcast_to(U2,shape+(U2.shape[-1],))),axis=-1)
+        return StructuredCovariance(d,U)
+
+    def to_dense(self):
+        '''
+        Return the full matrices as an array of shape (...,N,N)
+        '''
+        C = np.einsum('...ik,...jk->...ij',self.U,self.U)
+        inds = np.arange(self.N)
+        C[...,inds,inds] += self.d
+        return C
+
+    def solve(self,b):
+        '''
+        Return C^-1 b for b of shape (...,N,m)
+        '''
+        b = np.asarray(b,dtype=float)
+        b = np.broadcast_to(b,self.shape+b.shape[-2:])
+        good = np.all(self.d > 0,axis=-1)
+        d = np.where(good[...,np.newaxis],self.d,1.0)
+
+        DIb = b/d[...,np.newaxis]
+        if self.U.shape[-1] == 0:
+            retval = DIb
+        else:
+            DIU = self.U/d[...,np.newaxis]
+            capacitance = np.eye(self.U.shape[-1]) + np.einsum('...ni,...nj->...ij',self.U,DIU)
+            UTDIb = np.einsum('...ni,...nm->...im',self.U,DIb)
+            retval = DIb - np.einsum('...ni,...im->...nm',DIU,np.linalg.solve(capacitance,UTDIb))
+
+        if not np.all(good):
+            bad = ~good
+            retval = np.array(retval)
+            retval[bad] = np.linalg.solve(self.to_dense()[bad],b[bad])
+        return retval
+
+    def epoch_averaged_variance(self):
+        '''
+        Variance of the weighted average over all N elements, 1/(1^T C^-1 1)
+        '''
+        CIU = self.solve(np.ones((self.N,1)))
+        return 1.0/np.sum(CIU[...,0],axis=-1)
@@ -0,0 +1,64 @@
+import numpy as np
+import timescaling
+
+
+### ==================================================
+### Telescope design-space sweeps
+### ==================================================
+
+class TelescopeSweep:
+    '''
+    sigma_TOA of a stack of channel selections (cells) for many telescope configurations. The terms that
+    do not depend on the telescope (jitter, scintillation, DM(nu), the pulsar flux, sky temperature, and
+    scattering factors of the template-fitting errors, and the pulse widths of the polarization errors)
+    are computed once; each configuration only re-evaluates the template-fitting and polarization
+    diagonals and the covariance solves. See FrequencyOptimizer.calc_sweep().
+
+    freqopt: FrequencyOptimizer, whose telnoise sets the reference integration time
+    nus: Channel frequencies of shape (...,nchan), broadcast against the pulsar parameters
+    '''
+    def __init__(self,freqopt,nus):
+        self.freqopt = freqopt
+        self.nus = np.asarray(nus,dtype=float)
+        self.scaling = timescaling.TimeScaling(freqopt,self.nus)
+        self.factor,self.Tgal = freqopt.template_fitting_factors(self.nus)
+        self.widths = np.zeros(np.shape(self.nus)) + freqopt.psrnoise.W50s/100.0 #W50s in microseconds
+        self.shape = self.scaling.shape
+
+    def get_telescope_terms(self,telnoise):
+        '''
+        Template-fitting variances (for the reference integration time) and polarization term of the cells
+        for one TelescopeNoise, the latter the same as FrequencyOptimizer.polarization_error()
+        '''
+        gain,T_const,epsilon = telnoise.evaluate(self.nus)
+        sigmas = self.factor * (T_const + self.Tgal)/(gain*np.sqrt(telnoise.Npol))
+        sigmas = self.freqopt.limit_template_fitting_sigmas(self.nus,np.array(sigmas,dtype=float))
+        with np.errstate(divide="ignore"):
+            sigmatel2 = np.sqrt(1.0/np.sum(1.0/(epsilon*telnoise.pi_V*self.widths)**2,axis=-1))
+        return sigmas**2,sigmatel2
+
+    def sigma(self,telnoise):
+        '''
+        sigma_TOA of the cells for one TelescopeNoise
+        '''
+        sntf2,sigmatel2 = self.get_telescope_terms(telnoise)
+        return self.scaling.sigma(telnoise.T,sntf2,sigmatel2)
+
+    def sweep(self,telnoises,chunk=None):
+        '''
+        sigma_TOA of the cells for a sequence of TelescopeNoise, returns an array of shape (nconfig,)+cells.
+        Configurations are evaluated together in chunks that fit within freqopt.memory_limit.
+        '''
+        telnoises = list(telnoises)
+        retval = np.zeros((len(telnoises),)+self.shape)
+        if chunk is None:
+            ncells = int(np.prod(self.shape))
+            chunk = max(int(self.freqopt.memory_limit // (max(ncells,1)*self.freqopt.get_cell_bytes())),1)
+        for start in range(0,len(telnoises),chunk):
+            group = telnoises[start:start+chunk]
+            terms = [self.get_telescope_terms(telnoise) for telnoise in group]
+            sntf2 = np.array([np.broadcast_to(term[0],self.shape+(self.nus.shape[-1],)) for term in terms])
+            sigmatel2 = np.array([np.broadcast_to(term[1],self.shape) for term in terms])
+            T = np.reshape([telnoise.T for telnoise in group],(-1,)+(1,)*len(self.shape))
+            retval[start:start+len(group)] = self.scaling.sigma(T,sntf2,sigmatel2)
+        return retval
@@ -1,85 +1,23 @@
 import numpy as np
-import scipy.linalg as linalg
-import scipy.interpolate as interpolate
-import scipy.optimize as optimize
-from matplotlib.pyplot import *
-from matplotlib import cm,rc
-from matplotlib.ticker import FuncFormatter, MultipleLocator
-import matplotlib.patches as patches
 import DISS
-import glob
+import os
 import warnings
+import time
+import multiprocessing
+import hashlib
+import collections
+import copy
 import parallel
-import tsky
+import planning
+import shards
+import cache
+import skytemp
+from covariance import StructuredCovariance
 
 np.seterr(invalid="warn")
 
 
 
-rc('text',usetex=True)
-rc('font',**{'family':'serif','serif':['Times New Roman'],'size':14})#,'weight':'bold'})
-rc('xtick',**{'labelsize':16})
-rc('ytick',**{'labelsize':16})
-rc('axes',**{'labelsize':18,'titlesize':18})
-
-
-def nolog(x,pos):
-    return "$\hfill %0.1f$" % (10**x)
-noformatter = FuncFormatter(nolog)
-def nolog2(x,pos):
-    return "$\hfill %0.2f$" % (10**x)
-noformatter2 = FuncFormatter(nolog2)
-
-def log(x,pos):
-    y = x#np.log10(x)
-    #if y == 2:
-    #    return "$\hfill 100$" #added
-    if y == 1:
-        return "$\hfill 10$"
-    elif y == 0:
-        return "$\hfill 1$"
-    elif y == -1:
-        return "$\hfill 0.1$"
-    elif y == -2:
-        return "$\hfill 0.01$"
-    return "$\hfill 10^{%i}$" % x#np.log10(x) 
-
-formatter = FuncFormatter(log)
-
-
-
-def log100(x,pos):
-    y = x#np.log10(x)
-    if y == 2:
-        return "$\hfill 100$" #added
-    elif y == 1:
-        return "$\hfill 10$"
-    elif y == 0:
-        return "$\hfill 1$"
-    elif y == -1:
-        return "$\hfill 0.1$"
-    elif y == -2:
-        return "$\hfill 0.01$"
-    return "$\hfill 10^{%i}$" % x#np.log10(x) 
-
-formatter100 = FuncFormatter(log100)
-
-# Copied from utilities.py
-def uimshow(x,ax=None,origin='lower',interpolation='nearest',aspect='auto',**kwargs):
-    if ax is not None:
-        im=ax.imshow(x,origin=origin,interpolation=interpolation,aspect=aspect,**kwargs)
-    else:
-        im=imshow(x,origin=origin,interpolation=interpolation,aspect=aspect,**kwargs) # plt.
-    return im
-
-
-
-
-
-
-
-
-
 #K = 4.149 #ms GHz^2 pc^-1 cm^3
 K = 4.149e3 #us GHz^2 pc^-1 cm^3  
 # Note on units used: TOA errors in microseconds, observing frequencies in GHz, DM in pc cm^-3
@@ -99,6 +37,103 @@ LWS = [2.5,2,1.5,1,0.5]
 LWS = [2.5,2.25,2,1.75,1.5]
 #LWS = [2.5,2.25,2.0,1.75,1.5,1.25]
 
+# Approximate memory (bytes) that calc() may use for one chunk of grid cells
+MEMORY_LIMIT = 2**28
+
+# Source files whose contents define the code version for cached runs
+CODE_FILES = ["frequencyoptimizer.py","covariance.py","DISS.py","skytemp.py"]
+
+# Number of elements of the sigma grid to read at once when scanning it
+BLOCK_SIZE = 2**22
+
+def allocate(shape,filename=None,fill=np.nan,dtype=float):
+    '''
+    Return an array filled with fill, in memory or, if filename is given, as a memory-mapped .npy file
+    '''
+    if filename is None:
+        return np.full(shape,fill,dtype=dtype)
+    retval = np.lib.format.open_memmap(filename,mode='w+',dtype=dtype,shape=tuple(shape))
+    for rows in iter_rows(retval):
+        retval[rows] = fill
+    return retval
+
+def iter_rows(a,block_size=BLOCK_SIZE):
+    '''
+    Yield slices over the first axis of a that cover about block_size elements each
+    '''
+    nrows = np.shape(a)[0]
+    step = max(int(block_size // max(np.prod(np.shape(a)[1:]),1)),1)
+    for start in range(0,nrows,step):
+        yield slice(start,min(start+step,nrows))
+
+def grid_extrema(sigmas,block_size=BLOCK_SIZE):
+    '''
+    Return the minimum and maximum of the finite, positive values of sigmas and the index of the
+    minimum, reading sigmas (e.g., a memory-mapped grid) in blocks of rows
+    '''
+    MIN,MAX,INDMIN = np.inf,-np.inf,None
+    for rows in iter_rows(sigmas,block_size):
+        block = np.asarray(sigmas[rows])
+        good = np.isfinite(block) & (block > 0)
+        if not np.any(good):
+            continue
+        values = np.where(good,block,np.inf)
+        ind = np.unravel_index(np.argmin(values),block.shape)
+        if values[ind] < MIN:
+            MIN = values[ind]
+            INDMIN = (ind[0]+rows.start,)+ind[1:]
+        MAX = max(MAX,np.max(np.where(good,block,-np.inf)))
+    if INDMIN is None:
+        return np.nan,np.nan,None
+    return MIN,MAX,INDMIN
+
+def print_progress(ndone,ntotal,elapsed,eta):
+    '''
+    Progress callback that prints the number of cells done, the elapsed time, and the estimated time remaining
+    '''
+    print("Computed %i of %i cells (%.0f%%), elapsed %s, remaining %s"%(ndone,ntotal,100.0*ndone/max(ntotal,1),planning.format_time(elapsed),planning.format_time(eta)))
+
+def calc_rows(args):
+    '''
+    Worker function: sigma_TOA for a slice of rows of a FrequencyOptimizer's grid, args = (freqopt,rows)
+    '''
+    freqopt,rows = args
+    freqopt.ncpu = 1 # already in a worker
+    return freqopt.calc_rows(rows)
+
+def get_data_filename(filename):
+    '''
+    Look for a data file (e.g., ampratios.npz) in the current directory, then next to this module
+    '''
+    if os.path.exists(filename):
+        return filename
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)),filename)
+
+VERSIONS = dict()
+
+def get_version():
+    '''
+    Hash of the code (CODE_FILES) and of the ampratios.npz and tsky.dat tables, recomputed only when one of them changes
+    '''
+    filenames = [get_data_filename(filename) for filename in CODE_FILES+["ampratios.npz",skytemp.TSKY_FILE]]
+    stamp = tuple((filename,os.stat(filename).st_mtime_ns,os.stat(filename).st_size) for filename in filenames)
+    if stamp not in VERSIONS:
+        VERSIONS[stamp] = cache.file_fingerprint(*filenames)
+    return VERSIONS[stamp]
+
+SCATTERING_TABLES = dict()
+
+def get_scattering_table(filename="ampratios.npz"):
+    '''
+    Return log10(tau_d/W_eff) and log10 of the template-fitting error ratio from the convolved
+    Gaussian-exponential simulations in filename, read once per process and shared by all
+    FrequencyOptimizers (forked workers inherit it)
+    '''
+    if filename not in SCATTERING_TABLES:
+        with np.load(get_data_filename(filename)) as data:
+            SCATTERING_TABLES[filename] = (np.log10(data['ratios']),np.log10(data['errratios']))
+    return SCATTERING_TABLES[filename]
+
 def epoch_averaged_error(C,var=False):
     # Stripped down version from rednoisemodel.py from the excess noise project
     N = len(C)
@@ -110,6 +145,14 @@ def epoch_averaged_error(C,var=False):
         return C_E[0,0]
     return np.sqrt(C_E[0,0])
 
+def epoch_averaged_variance(C):
+    '''
+    Batched version of epoch_averaged_error(C,var=True) for a stack of covariance matrices of shape (...,N,N)
+    '''
+    U = np.ones(C.shape[:-1]+(1,))
+    CIU = np.linalg.solve(C,U)
+    return 1.0/np.sum(CIU,axis=(-2,-1))
+
 
 
 
@@ -144,6 +187,90 @@ def evalDMnuError(dnuiss,nu1,nu2,g=0.46,q=1.15,screen=False,fresnel=False):
     r = nu1/nu2
     return 0.184 * g * q * E_beta(r) * (phiF**2 / (nu1 * 1000))
 
+def evalDMnuCovMatrix(dnuiss,nus,g=0.46,q=1.15,screen=False,fresnel=False):
+    # Frequency-dependent DM covariance matrix evalDMnuError(...)**2 for every pair of channels
+    # nus and dnuiss (scaled to each channel) of shape (...,N), broadcast against each other
+    # returns an array of shape (...,N,N) in microseconds^2, zero on the diagonal
+    nus,dnuiss = np.broadcast_arrays(nus,dnuiss)
+    nui = nus[...,:,np.newaxis]
+    nuj = nus[...,np.newaxis,:]
+    #nu2 should be less than nu1, dnuiss is taken at nu1
+    dnuiss = np.where(nui > nuj,dnuiss[...,:,np.newaxis],dnuiss[...,np.newaxis,:])
+    with np.errstate(divide="ignore",invalid="ignore"):
+        sigma = evalDMnuError(dnuiss,np.maximum(nui,nuj),np.minimum(nui,nuj),g=g,q=q,screen=screen,fresnel=fresnel)
+    return np.where(nui == nuj,0.0,sigma**2)
+
+def DMnuScaling(dnud,fresnel=False):
+    # The DM(nu) covariance matrix is a power law in the scintillation bandwidth (or phiF if fresnel==True)
+    # Returns the factor between the matrix for dnud and the kernel matrix for dnud = 1 GHz
+    return (evalDMnuError(dnud,2.0,1.0,fresnel=fresnel)/evalDMnuError(1.0,2.0,1.0,fresnel=fresnel))**2
+
+def DMnuFrequencyScaling(s,fresnel=False):
+    # The DM(nu) kernel is also a power law in frequency for a fixed nuhigh/nulow
+    # Returns the factor between the kernel for channels s*nus and the kernel for nus
+    return (evalDMnuError(DISS.scale_dnu_d(1.0,1.0,2.0*s),2.0*s,s,fresnel=fresnel)/evalDMnuError(DISS.scale_dnu_d(1.0,1.0,2.0),2.0,1.0,fresnel=fresnel))**2
+
+
+class DMnuKernelCache:
+    '''
+    Cache of the epoch-averaged variances of the pulsar-independent DM(nu) kernel,
+    i.e., the frequency-dependent DM covariance matrix for dnud = 1 GHz at nuref.
+    Channel selections with the same nuhigh/nulow (e.g., the cells along the
+    diagonals of a log grid) are scaled copies of each other, and the kernel
+    is a power law in frequency, so variances are keyed by the shape nus/nus[0]
+    and rescaled with DMnuFrequencyScaling(). They are computed once per shape and
+    shared by all cells, pulsars, and FrequencyOptimizer instances in a process.
+
+    maxsize: Maximum number of cached channel selections
+    '''
+    def __init__(self,maxsize=2**18):
+        self.maxsize = maxsize
+        self.variances = collections.OrderedDict()
+
+    def kernel(self,nus,g=0.46,q=1.15,screen=False,fresnel=False,nuref=1.0):
+        '''
+        DM(nu) kernel matrices for nus of shape (...,nchan)
+        '''
+        dnud = DISS.scale_dnu_d(1.0,nuref,nus)
+        return evalDMnuCovMatrix(dnud,nus,g=g,q=q,screen=screen,fresnel=fresnel)
+
+    def variance(self,nus,g=0.46,q=1.15,screen=False,fresnel=False,nuref=1.0):
+        '''
+        Epoch-averaged variances of the DM(nu) kernel for nus of shape (...,nchan)
+        '''
+        nus = np.asarray(nus,dtype=float)
+        flatnus = np.reshape(nus,(-1,nus.shape[-1]))
+        nulows = flatnus[:,0]
+        shapes = flatnus/nulows[:,np.newaxis]
+        # Rounded so that cells with the same ratio share a key despite floating-point noise
+        keyshapes = np.round(shapes,10)
+        params = repr((g,q,screen,fresnel,nuref)).encode()
+        retval = np.zeros(len(flatnus))
+        missing = collections.OrderedDict()
+        for i,x in enumerate(keyshapes):
+            key = hashlib.sha1(x.tobytes()+params).digest()
+            if key in self.variances:
+                self.variances.move_to_end(key)
+                retval[i] = self.variances[key]
+            else:
+                missing.setdefault(key,[]).append(i)
+
+        if len(missing) > 0:
+            inds = [v[0] for v in missing.values()]
+            variances = epoch_averaged_variance(self.kernel(shapes[inds],g=g,q=q,screen=screen,fresnel=fresnel,nuref=nuref))
+            for (key,v),var in zip(missing.items(),variances):
+                retval[v] = var
+                self.variances[key] = var
+            while len(self.variances) > self.maxsize:
+                self.variances.popitem(last=False)
+        retval *= DMnuFrequencyScaling(nulows,fresnel=fresnel)
+        return np.reshape(retval,nus.shape[:-1])
+
+    def clear(self):
+        self.variances.clear()
+
+DMNU_CACHE = DMnuKernelCache()
+
 
 
 
@@ -205,6 +332,55 @@ class PulsarNoise:
             self.P = None
 
 
+class PulsarNoiseBatch:
+    '''
+    The parameters of N pulsars as columns (struct of arrays), so that FrequencyOptimizer can evaluate them
+    together, see FrequencyOptimizer.calc_pulsars(). Every column has shape (N,1), or (N,nchan) for
+    per-channel Weffs, W50s, and sigma_Js, and broadcasts against channel frequencies of shape (N,nchan).
+    Missing P, glon, and glat are NaN (glon and glat are None if no pulsar has them).
+
+    psrnoises: Sequence of PulsarNoise
+    '''
+    KEYS = ["alpha","dtd","dnud","taud","C1","I_0","DM","D","Uscale","tauvar","Weffs","W50s","sigma_Js","P","glon","glat"]
+
+    def __init__(self,psrnoises):
+        psrnoises = list(psrnoises)
+        self.names = [psrnoise.name for psrnoise in psrnoises]
+        self.name = "%i pulsars"%len(psrnoises)
+        for key in self.KEYS:
+            values = [np.nan if getattr(psrnoise,key) is None else np.atleast_1d(np.asarray(getattr(psrnoise,key),dtype=float)) for psrnoise in psrnoises]
+            if key in ["glon","glat"] and all(getattr(psrnoise,key) is None for psrnoise in psrnoises):
+                setattr(self,key,None)
+                continue
+            width = max([np.size(value) for value in values]+[1])
+            setattr(self,key,np.array([np.broadcast_to(value,(width,)) for value in values]).reshape((len(values),width)))
+
+    def __len__(self):
+        return len(self.names)
+
+    def for_cells(self):
+        '''
+        Copy of the batch with columns of shape (N,1,width), which broadcast against the channels of a stack
+        of grid cells of shape (1,ncells,nchan), see FrequencyOptimizer.calc_cube()
+        '''
+        retval = copy.copy(self)
+        for key in self.KEYS:
+            value = getattr(self,key)
+            if value is not None:
+                setattr(retval,key,value[:,np.newaxis,:])
+        return retval
+
+
+def cell_values(x):
+    '''
+    Values of a pulsar parameter per cell rather than per channel: drops the channel axis of the columns
+    of a PulsarNoiseBatch, leaves the scalars of a PulsarNoise as they are
+    '''
+    if np.ndim(x) == 0:
+        return x
+    return np.asarray(x)[...,0]
+
+
 class GalacticNoise:
     '''
     Container class for all Galaxy-related variables.
@@ -243,15 +419,88 @@ class TelescopeNoise:
         self.rx_nu = rx_nu
         self.interpolate = interpolate
 
+    def get_response(self):
+        '''
+        ReceiverResponse for the receiver spec (rx_nu,gain,T_const,epsilon), shared by all TelescopeNoise
+        instances with the same spec in a process
+        '''
+        key = cache.fingerprint(self.rx_nu,self.gain,self.T_const,self.epsilon)
+        if key not in RX_RESPONSES:
+            RX_RESPONSES[key] = ReceiverResponse(self.rx_nu,self.gain,self.T_const,self.epsilon)
+        return RX_RESPONSES[key]
+
+    def evaluate(self,nus):
+        '''
+        Return gain, T_const, and epsilon at frequencies nus, interpolated in the receiver spec if interpolate
+        '''
+        if self.interpolate: return self.get_response().evaluate(nus)
+        else: return self.gain,self.T_const,self.epsilon
+
     def get_gain(self,nu):
-        if self.interpolate: return np.interp(nu,self.rx_nu,self.gain)
-        else: return self.gain
+        return self.evaluate(nu)[0]
     def get_epsilon(self,nu):
-        if self.interpolate: return np.interp(nu,self.rx_nu,self.epsilon)
-        else: return self.epsilon
+        return self.evaluate(nu)[2]
     def get_T_const(self,nu):
-        if self.interpolate: return np.interp(nu,self.rx_nu,self.T_const)
-        else: return self.T_const
+        return self.evaluate(nu)[1]
+
+
+class ReceiverResponse:
+    '''
+    Receiver spec compiled into a table of gain (K/Jy), T_const (K), and epsilon at frequencies rx_nu (GHz),
+    e.g., the columns of receiver_specs.txt. All three are interpolated together (as np.interp, constant
+    beyond the ends). Responses are memoized by channel frequencies, which repeat between the covariance
+    terms of a batch of cells and between pulsars computed on the same grid.
+
+    maxbytes: Maximum size of the memoized responses
+    '''
+    def __init__(self,rx_nu,gain,T_const,epsilon,maxbytes=2**27):
+        rx_nu = np.atleast_1d(np.asarray(rx_nu,dtype=float))
+        order = np.argsort(rx_nu,kind="stable")
+        self.rx_nu = rx_nu[order]
+        self.table = np.array([(np.zeros(len(rx_nu))+x)[order] for x in [gain,T_const,epsilon]])
+        self.maxbytes = maxbytes
+        self.responses = collections.OrderedDict()
+        self.nbytes = 0
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["responses"] = collections.OrderedDict()
+        state["nbytes"] = 0
+        return state
+
+    def interpolate(self,nus):
+        '''
+        Table rows interpolated at nus, shape (3,)+nus.shape
+        '''
+        if len(self.rx_nu) == 1:
+            return np.zeros((3,)+np.shape(nus)) + self.table.reshape((3,)+(1,)*np.ndim(nus))
+        inds = np.clip(np.searchsorted(self.rx_nu,nus,side='right')-1,0,len(self.rx_nu)-2)
+        nu0 = self.rx_nu[inds]
+        nu1 = self.rx_nu[inds+1]
+        with np.errstate(invalid="ignore",divide="ignore"):
+            weights = np.clip(np.where(nu1 > nu0,(nus-nu0)/(nu1-nu0),1.0),0.0,1.0)
+        return self.table[:,inds]*(1-weights) + self.table[:,inds+1]*weights
+
+    def evaluate(self,nus):
+        '''
+        Return gain, T_const, and epsilon at frequencies nus (any shape)
+        '''
+        nus = np.asarray(nus,dtype=float)
+        if nus.size < 64: # cheaper than hashing
+            return tuple(self.interpolate(nus))
+        key = hashlib.sha1(repr(nus.shape).encode()+np.ascontiguousarray(nus).tobytes()).digest()
+        if key in self.responses:
+            self.responses.move_to_end(key)
+        else:
+            values = self.interpolate(nus)
+            values.flags.writeable = False
+            self.responses[key] = values
+            self.nbytes += values.nbytes
+            while self.nbytes > self.maxbytes and len(self.responses) > 1:
+                self.nbytes -= self.responses.popitem(last=False)[1].nbytes
+        return tuple(self.responses[key])
+
+RX_RESPONSES = dict()
     
 
 
@@ -263,7 +512,7 @@ class FrequencyOptimizer:
     Primary class for frequency optimization
     '''
     
-    def __init__(self,psrnoise,galnoise,telnoise,numin=0.01,numax=10.0,r=None,dnu=0.05,nchan=100,log=False,nsteps=8,frac_bw=False,verbose=True,vverbose=False,full_bandwidth=False,masks=None,levels=LEVELS,colors=COLORS,lws=LWS,full=True,ncpu=1):
+    def __init__(self,psrnoise,galnoise,telnoise,numin=0.01,numax=10.0,r=None,dnu=0.05,nchan=100,log=False,nsteps=8,frac_bw=False,verbose=True,vverbose=False,full_bandwidth=False,masks=None,levels=LEVELS,colors=COLORS,lws=LWS,full=True,ncpu=1,memory_limit=MEMORY_LIMIT,dmnu_cache=DMNU_CACHE,cell_store=None,run_cache=None,output=None,executor=None,checkpoint=None,checkpoint_interval=600.0,progress=None):
 
 
 
@@ -277,6 +526,9 @@ class FrequencyOptimizer:
         
         self.numin = numin
         self.numax = numax
+        self.dnu = dnu
+        self.nsteps = nsteps
+        self.full_bandwidth = full_bandwidth
         self.masks = masks
         if type(masks) == tuple: #implies it is not None
             self.masks = [masks]
@@ -285,26 +537,25 @@ class FrequencyOptimizer:
 
         if self.frac_bw == False:
             if self.log == False:
-                self.dnu = dnu
                 self.Cs = np.arange(numin,numax,dnu)
                 self.Bs = np.arange(numin,numax/2,dnu)
             else:
                 MIN = np.log10(numin)
                 MAX = np.log10(numax)
-                self.Cs = np.logspace(MIN,MAX,(MAX-MIN)*nsteps+1)
+                self.Cs = np.logspace(MIN,MAX,int((MAX-MIN)*nsteps+1))
                 if full_bandwidth:
                     MAX = np.log10(2*numax)
-                    self.Bs = np.logspace(MIN,MAX,(MAX-MIN)*nsteps+1) 
+                    self.Bs = np.logspace(MIN,MAX,int((MAX-MIN)*nsteps+1)) 
                 else:
-                    self.Bs = np.logspace(MIN,MAX,(MAX-MIN)*nsteps+1)
+                    self.Bs = np.logspace(MIN,MAX,int((MAX-MIN)*nsteps+1))
         else:
             if self.log == False:
                 pass
             else:
                 MIN = np.log10(numin)
                 MAX = np.log10(numax)
-                self.Cs = np.logspace(MIN,MAX,(MAX-MIN)*nsteps+1)
-                self.Bs = np.logspace(MIN,MAX,(MAX-MIN)*nsteps+1)
+                self.Cs = np.logspace(MIN,MAX,int((MAX-MIN)*nsteps+1))
+                self.Bs = np.logspace(MIN,MAX,int((MAX-MIN)*nsteps+1))
                 self.Fs = np.logspace(np.log10(self.Bs[-1]/self.Cs[0]),np.log10(1.0),len(self.Cs))[::-1]
                 self.Fs = np.logspace(np.log10(self.Bs[0]/self.Cs[-1]),np.log10(2.0),len(self.Cs))
                 # do not log space?
@@ -314,7 +565,6 @@ class FrequencyOptimizer:
 
         self.nchan = nchan
 
-        self.scattering_mod_f = None
         self.verbose = verbose
         if vverbose:
             self.verbose = True
@@ -324,6 +574,15 @@ class FrequencyOptimizer:
         self.lws = lws
         self.full = full
         self.ncpu = ncpu
+        self.memory_limit = memory_limit
+        self.dmnu_cache = dmnu_cache
+        self.cell_store = cell_store
+        self.run_cache = run_cache
+        self.output = output
+        self.executor = executor
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.progress = progress
 
     def template_fitting_error(self,S,Weff=100.0,Nphi=2048): #Weff in microseconds
         return Weff / (S * np.sqrt(Nphi))
@@ -331,73 +590,108 @@ class FrequencyOptimizer:
 
 
     def get_bandwidths(self,nus):
+        '''
+        Channel bandwidths for nus, which can be a single set of channels or a stack of shape (...,nchan)
+        '''
         if self.log == False:
             # assume equal bins?
-            B = np.diff(nus)[0]
+            B = nus[...,1:2] - nus[...,0:1]
             #B = np.concatenate((np.diff(nus),self.dnu))
         else:
-            logdiff = np.diff(np.log10(nus))[0]
-            edges = 10**(np.concatenate(([np.log10(nus[0])-logdiff/2.0],np.log10(nus)+logdiff/2.0)))
-            B = np.diff(edges)
+            lognus = np.log10(nus)
+            logdiff = lognus[...,1:2] - lognus[...,0:1]
+            edges = 10**(np.concatenate((lognus[...,0:1]-logdiff/2.0,lognus+logdiff/2.0),axis=-1))
+            B = np.diff(edges,axis=-1)
         return B
 
 
-    def build_template_fitting_cov_matrix(self,nus,nuref=1.0):
+    def get_channels(self,C,B):
         '''
-        Constructs the template-fitting error (i.e., from finite signal-to-noise ratio) covariance matrix
+        Channel frequencies for center frequencies C and bandwidths B, returns an array of shape C.shape+(nchan,)
+        '''
+        C = np.asarray(C,dtype=float)[...,np.newaxis]
+        B = np.asarray(B,dtype=float)[...,np.newaxis]
+        nulow = C - B/2.0
+        nuhigh = C + B/2.0
+        steps = np.linspace(0.0,1.0,self.nchan+1)[:-1] #more uniform sampling?
+        if self.log == False:
+            return nulow + (nuhigh-nulow)*steps
+        with np.errstate(invalid="ignore",divide="ignore"):
+            return 10**(np.log10(nulow) + (np.log10(nuhigh)-np.log10(nulow))*steps)
+
+
+    def template_fitting_factors(self,nus,nuref=1.0):
+        '''
+        Telescope-independent parts of the template-fitting errors, factor and Tgal, such that the errors are
+        factor * (T_const + Tgal) / (gain * sqrt(Npol)) before limit_template_fitting_sigmas()
         '''
-        
         Weffs = self.psrnoise.Weffs
-        if type(Weffs) != np.ndarray:
-            Weffs = np.zeros_like(nus)+Weffs
         B = self.get_bandwidths(nus)
        
         if self.psrnoise.glon is None or self.psrnoise.glat is None:
             Tgal = 20*np.power(nus/0.408,-1*self.galnoise.beta)
-        else:            
-            Tgal = np.array([tsky.psr_tsky(self.psrnoise.glon,
-                                           self.psrnoise.glat,
-                                           nu*1e3) for nu in nus])
-        Tsys = self.telnoise.get_T_const(nus) + Tgal
+        else:
+            # a PulsarNoiseBatch can mix pulsars with and without positions
+            known = np.isfinite(self.psrnoise.glon) & np.isfinite(self.psrnoise.glat)
+            Tgal = np.where(known,skytemp.tsky(np.where(known,self.psrnoise.glon,0.0),np.where(known,self.psrnoise.glat,0.0),nus*1e3),
+                            20*np.power(nus/0.408,-1*self.galnoise.beta))
 
         
         tau = 0.0
-        if self.psrnoise.DM != 0.0 and self.psrnoise.D != 0.0 and self.galnoise.T_e != 0.0 and self.galnoise.fillingfactor != 0:
+        if np.all(self.psrnoise.DM != 0.0) and np.all(self.psrnoise.D != 0.0) and self.galnoise.T_e != 0.0 and self.galnoise.fillingfactor != 0:
             tau = 1.417e-6 * (self.galnoise.fillingfactor/0.2)**-1 * self.psrnoise.DM**2 * self.psrnoise.D**-1 * np.power(self.galnoise.T_e/100,-1.35)
 
-        numer =  (self.psrnoise.I_0 * 1e-3) * np.power(nus/nuref,-1*self.psrnoise.alpha)*np.sqrt(self.telnoise.Npol*B*1e9*self.telnoise.T) 
+        numer =  (self.psrnoise.I_0 * 1e-3) * np.power(nus/nuref,-1*self.psrnoise.alpha)*np.sqrt(B*1e9*self.telnoise.T) 
         #* np.exp(-1*tau*np.power(nus/nuref,-2.1)) #
 
-        denom = Tsys / self.telnoise.get_gain(nus)
-        S = self.psrnoise.Uscale*numer/denom # numer/denom is the mean S/N over all phase. Need to adjust by the factor Uscale.
-
-        
-        #print numer,denom
-
-        #print nus,B
-        #print self.psrnoise.I_0,self.telnoise.gain,B,self.telnoise.T#np.power(nus/nuref,-1*self.psrnoise.alpha)
-        
-        sigmas = self.template_fitting_error(S,Weffs,1)
+        # Uscale*numer*sqrt(Npol)*gain/Tsys is the mean S/N over all phase. Need to adjust by the factor Uscale.
+        factor = self.template_fitting_error(self.psrnoise.Uscale*numer,Weffs,1)
 
-        if self.psrnoise.taud > 0.0:
+        if np.any(self.psrnoise.taud > 0.0): # factors are 1 where taud = 0
             tauds = DISS.scale_tau_d(self.psrnoise.taud,nuref,nus)
             retval = self.scattering_modifications(tauds,Weffs)
             #retval = 1
-            sigmas *= retval #??
+            factor = factor*retval #??
+        return factor,Tgal
 
+    def limit_template_fitting_sigmas(self,nus,sigmas):
+        '''
+        Caps the template-fitting errors and applies the masks, in place
+        '''
         # Any enormous values should not cause an overflow
-        inds = np.where(sigmas>1e100)[0]
-        sigmas[inds] = 1e100
+        sigmas[sigmas>1e100] = 1e100
 
 
         # implement masks here
         if self.masks is not None:
             for i,mask in enumerate(self.masks):
                 maskmin,maskmax = mask
-                inds = np.where(np.logical_and(nus>=maskmin,nus<=maskmax))[0]
-                sigmas[inds] = 0.0 #???
+                sigmas[np.broadcast_to(np.logical_and(nus>=maskmin,nus<=maskmax),np.shape(sigmas))] = 0.0 #???
         
+        return sigmas
+
+    def template_fitting_sigmas(self,nus,nuref=1.0):
+        '''
+        Per-channel template-fitting errors (i.e., from finite signal-to-noise ratio)
+        '''
+        factor,Tgal = self.template_fitting_factors(nus,nuref=nuref)
+        gain,T_const,epsilon = self.telnoise.evaluate(nus)
+        Tsys = T_const + Tgal
+        sigmas = factor * Tsys/(gain*np.sqrt(self.telnoise.Npol))
+        return self.limit_template_fitting_sigmas(nus,np.array(sigmas,dtype=float))
+
+    def build_template_fitting_cov_matrix(self,nus,nuref=1.0):
+        '''
+        Constructs the template-fitting error (i.e., from finite signal-to-noise ratio) covariance matrix
+        '''
+        sigmas = self.template_fitting_sigmas(nus,nuref=nuref)
         return np.matrix(np.diag(sigmas**2))
+
+    def jitter_sigmas(self,nus):
+        '''
+        Per-channel jitter errors, broadcast against nus
+        '''
+        return np.zeros(np.shape(nus)) + self.psrnoise.sigma_Js
         
     def build_jitter_cov_matrix(self):
         '''
@@ -407,55 +701,30 @@ class FrequencyOptimizer:
         if type(sigma_Js) != np.ndarray:
             sigma_Js = np.zeros(self.nchan)+sigma_Js
 
-        retval = np.matrix(np.zeros((len(sigma_Js),len(sigma_Js))))
-        if sigma_Js is not None:
-            for i in range(len(sigma_Js)):
-                for j in range(len(sigma_Js)):
-                    retval[i,j] = sigma_Js[i] * sigma_Js[j]
-        return retval
+        return np.matrix(np.outer(sigma_Js,sigma_Js))
 
         
     def scattering_modifications(self,tauds,Weffs,filename="ampratios.npz",directory=None):
         '''
         Takes the calculations of the convolved Gaussian-exponential simulations and returns the multiplicative factor applies to the template-fitting errors
         '''
-        if len(glob.glob(filename))!=1:
-            if directory is None:
-                directory = __file__.split("/")[0] + "/"
-        else:
-            directory = ""
-        if type(Weffs) != np.ndarray:
-            Weffs = np.zeros_like(nus)+Weffs
-
-        if self.scattering_mod_f is None:
-            data = np.load(directory+"ampratios.npz")
-            ratios = data['ratios']
-            ampratios = data['ampratios']
-            Weffratios = data['Weffratios']
-            errratios = data['errratios']
-            
-            logratios = np.log10(ratios)
-            logerrratios = np.log10(errratios)
+        if directory is not None:
+            filename = os.path.join(directory,filename)
+        logratios,logerrratios = get_scattering_table(filename)
 
-            self.scattering_mod_f = interpolate.interp1d(logratios,logerrratios)
-
-        dataratios = np.array(tauds)/np.array(Weffs) #sigma_Ws?
+        with np.errstate(divide="ignore",invalid="ignore"):
+            dataratios = np.array(tauds)/np.array(Weffs) #sigma_Ws?
 
         retval = np.zeros_like(dataratios) + 1.0
-        inds = np.where(dataratios > 0.01)[0] #must be greater than this value
-        retval[inds] = 10**self.scattering_mod_f(np.log10(dataratios[inds]))
+        inds = dataratios > 0.01 #must be greater than this value
+        # linear in log-log as before; NaN (an invalid cell) beyond the table
+        retval[inds] = 10**np.interp(np.log10(dataratios[inds]),logratios,logerrratios,left=np.nan,right=np.nan)
         return retval
-        
 
-
-    def build_scintillation_cov_matrix(self,nus,nuref=1.0,C1=1.16,etat=0.2,etanu=0.2):
+    def scintillation_sigmas(self,nus,nuref=1.0,C1=1.16,etat=0.2,etanu=0.2):
         '''
-        Constructs the scintillation (finite-scintle effect) error covariance matrix
+        Per-channel scintillation (finite-scintle effect) errors and number of scintles
         '''
-
-        numin = nus[0]
-        numax = nus[-1]
-
         B = self.get_bandwidths(nus)
         dtd = DISS.scale_dt_d(self.psrnoise.dtd,nuref,nus)
         dnud = DISS.scale_dnu_d(self.psrnoise.dnud,nuref,nus)
@@ -465,6 +734,13 @@ class FrequencyOptimizer:
 
         # check if niss >> 1?
         sigmas = taud/np.sqrt(niss)
+        return sigmas,niss
+
+    def build_scintillation_cov_matrix(self,nus,nuref=1.0,C1=1.16,etat=0.2,etanu=0.2):
+        '''
+        Constructs the scintillation (finite-scintle effect) error covariance matrix
+        '''
+        sigmas,niss = self.scintillation_sigmas(nus,nuref=nuref,C1=C1,etat=etat,etanu=etanu)
 
         retval = np.matrix(np.diag(sigmas**2))
 
@@ -476,70 +752,63 @@ class FrequencyOptimizer:
         #return np.matrix(np.diag(sigmas**2)) #these will be independent IF niss is large
         
         
-
-
-
-    # Using notation from signal processing notes, lecture 17
     def DM_misestimation(self,nus,errs,covmat=False):#,fullDMnu=True):
         '''
         Return sum of DM mis-estimation errors
         '''
-        N = len(nus)
-        X = np.matrix(np.ones((N,2))) #design matrix
-        for i,nu in enumerate(nus):
-            X[i,1] = K/nu**2
-
         # Template-Fitting Errors
         if covmat is False:
-            V = np.matrix(np.diag(errs**2)) #weights matrix
+            V = StructuredCovariance(errs**2) #weights matrix
         else:
             V = errs
-        XT = X.T
-        VI = V.I
-        P = np.dot(np.dot(XT,VI),X).I 
+
+        template_fitting_var,DM_nu_var,scattering_var = self.DM_misestimation_components(nus,V)
+
+        retval = np.sqrt(template_fitting_var + DM_nu_var + scattering_var)
+        
+        if self.vverbose:
+            print("DM misestimation noise: %0.3f us"%retval)
+            
+            print("   DM estimation error: %0.3f us"%np.sqrt(template_fitting_var))
+            print("   DM(nu) error: %0.3f us"%np.sqrt(DM_nu_var))
+            print("   Chromatic term error: %0.3f us"%np.sqrt(scattering_var))
 
 
+        return retval
 
+    # Using notation from signal processing notes, lecture 17
+    def DM_misestimation_components(self,nus,V):
+        '''
+        Return the DM estimation, DM(nu), and chromatic variances of the DM mis-estimation error.
+        nus can be a stack of shape (...,nchan), and V either a StructuredCovariance or a (stack of) dense covariance matrices
+        '''
+        X = np.ones(np.shape(nus)+(2,)) #design matrix
+        X[...,1] = K/nus**2
+
+        if isinstance(V,StructuredCovariance):
+            VIX = V.solve(X)
+        else:
+            V = np.asarray(V)
+            VIX = np.linalg.solve(V,np.broadcast_to(X,V.shape[:-1]+(2,)))
+        P = np.linalg.inv(np.einsum('...ni,...nj->...ij',X,VIX))
 
         # for now, ignore covariances and simply return the t_inf error    
-        template_fitting_var = P[0,0] 
+        template_fitting_var = P[...,0,0]
 
         ## Frequency-Dependent DM
         #DM_nu_var = evalDMnuError(self.psrnoise.dnud,np.max(nus),np.min(nus))**2 / 25.0
         if self.full:
-            DM_nu_cov = self.build_DMnu_cov_matrix(nus)
-            DM_nu_var = epoch_averaged_error(DM_nu_cov,var=True)
-            #print nus
-            # FOO
-            #print DM_nu_cov
-            #print DM_nu_var
-            if DM_nu_var < 0.0:# or np.isnan(DM_nu_var): #no longer needed
-                DM_nu_var = 0 
+            DM_nu_var = self.DMnu_variance(nus)
         else: # [deprecated], please be aware!
-            DM_nu_var = evalDMnuError(self.psrnoise.dnud,np.max(nus),np.min(nus))**2 / 25.0
-
-
-        
+            DM_nu_var = evalDMnuError(cell_values(self.psrnoise.dnud),np.max(nus,axis=-1),np.min(nus,axis=-1))**2 / 25.0
 
         # PBF errors (scattering), included already in cov matrix?
         # Scattering error, assume this is proportional to nu^-4.4? or 4?
         chromatic_components = self.psrnoise.tauvar * np.power(nus,-4.4)
-        scattering_var = np.dot(np.dot(np.dot(P,XT),VI),chromatic_components)[0,0]**2
+        XTVIc = np.einsum('...ni,...n->...i',VIX,chromatic_components)
+        scattering_var = np.einsum('...ij,...j->...i',P,XTVIc)[...,0]**2
 
-
-
-
-        retval = np.sqrt(template_fitting_var + DM_nu_var + scattering_var)
-        
-        if self.vverbose:
-            print("DM misestimation noise: %0.3f us"%retval)
-            
-            print("   DM estimation error: %0.3f us"%np.sqrt(template_fitting_var))
-            print("   DM(nu) error: %0.3f us"%np.sqrt(DM_nu_var))
-            print("   Chromatic term error: %0.3f us"%np.sqrt(scattering_var))
-
-
-        return retval
+        return template_fitting_var,DM_nu_var,scattering_var
 
 
 
@@ -547,85 +816,87 @@ class FrequencyOptimizer:
         '''
         Constructs the frequency-dependent DM error covariance matrix
         '''
+        return np.matrix(self.build_DMnu_cov_matrices(nus,g=g,q=q,screen=screen,fresnel=fresnel,nuref=nuref))
 
+    def build_DMnu_cov_matrices(self,nus,g=0.46,q=1.15,screen=False,fresnel=False,nuref=1.0):
+        '''
+        Constructs the frequency-dependent DM error covariance matrices for nus of shape (...,nchan), returns an array of shape (...,nchan,nchan)
+        '''
         dnud = DISS.scale_dnu_d(self.psrnoise.dnud,nuref,nus)
+        return evalDMnuCovMatrix(dnud,nus,g=g,q=q,screen=screen,fresnel=fresnel)
 
 
 
-        # Construct the matrix, this could be sped up by a factor of two
-        retval = np.matrix(np.zeros((len(nus),len(nus))))
-        for i in range(len(nus)):
-            for j in range(len(nus)):
-
-                if nus[i] == nus[j]:
-                    continue # already set to zero
-                
-                # speed up
-                #if retval[j,i] != 0.0:
-                #    continue
-                #    retval[i,j] = retval[j,i]
-                #    continue
-                
-                #nu2 should be less than nu1
-                if nus[i] > nus[j]: 
-                    nu1 = nus[i]
-                    nu2 = nus[j]
-                    dnuiss = dnud[i]
-                else:
-                    nu1 = nus[j]
-                    nu2 = nus[i]
-                    dnuiss = dnud[j]
-                #dnuiss = DISS.scale_dnu_d(self.psrnoise.dnud,nuref,nu1) #correct direction now, but should be nu1?
-                    
-                sigma = evalDMnuError(dnuiss,nu1,nu2,g=g,q=q,screen=screen,fresnel=fresnel)
-
-                retval[i,j] = sigma**2
-                #retval[j,i] = sigma**2
-            #raise SystemExit
-        return retval
-
         
+    def DMnu_variance(self,nus,g=0.46,q=1.15,screen=False,fresnel=False,nuref=1.0):
+        '''
+        Epoch-averaged variance of the frequency-dependent DM covariance matrix for nus of shape (...,nchan).
+        The matrix is a pulsar-independent kernel times a power of dnud, so the kernel is taken from self.dmnu_cache when set
+        '''
+        if self.dmnu_cache is None:
+            DM_nu_var = epoch_averaged_variance(self.build_DMnu_cov_matrices(nus,g=g,q=q,screen=screen,fresnel=fresnel,nuref=nuref))
+        else:
+            DM_nu_var = DMnuScaling(cell_values(self.psrnoise.dnud),fresnel=fresnel) * self.dmnu_cache.variance(nus,g=g,q=q,screen=screen,fresnel=fresnel,nuref=nuref)
+        return np.where(DM_nu_var < 0.0,0.0,DM_nu_var) # or np.isnan(DM_nu_var): #no longer needed
 
-
-        
-    def build_polarization_cov_matrix(self,nus):
+    def polarization_sigmas(self,nus):
         '''
-        Constructs the polarization error covariance matrix
+        Per-channel polarization errors, broadcast against nus
         '''
         W50s = self.psrnoise.W50s
-        if type(W50s) != np.ndarray:
-            W50s = np.zeros(self.nchan)+W50s
         #if type(self.telnoise.get_epsilon(nus)) != np.ndarray:
         #    epsilon = np.zeros(self.nchan)+self.telnoise.get_epsilon(nus)
-        if type(self.telnoise.pi_V) != np.ndarray:
-            pi_V = np.zeros(self.nchan)+self.telnoise.pi_V
-        if type(self.telnoise.eta) != np.ndarray:
-            eta = np.zeros(self.nchan)+self.telnoise.eta
-        if type(self.telnoise.pi_L) != np.ndarray:
-            pi_L = np.zeros(self.nchan)+self.telnoise.pi_L
-
+        pi_V = self.telnoise.pi_V
+        eta = self.telnoise.eta
+        pi_L = self.telnoise.pi_L
 
         epsilon = self.telnoise.get_epsilon(nus)
         sigmas = epsilon*pi_V*(W50s/100.0) #W50s in microseconds #do more?
         sigmasprime = 2 * np.sqrt(eta) * pi_L #Actually use this
+        return np.zeros(np.shape(nus)) + sigmas
+        
+    def build_polarization_cov_matrix(self,nus):
+        '''
+        Constructs the polarization error covariance matrix
+        '''
+        sigmas = self.polarization_sigmas(nus)
         return np.matrix(np.diag(sigmas**2))
 
 
 
-    def calc_single(self,nus):
+    def build_covariance(self,nus):
         '''
-        Calculate sigma_TOA given a selection of frequencies
+        Constructs the sum of the template-fitting, jitter, and scintillation covariance matrices as a StructuredCovariance.
+        The template-fitting term is diagonal, the jitter term has rank one, and the scintillation term is diagonal plus a rank-one block over the channels with niss < 2
         '''
-        sncov = self.build_template_fitting_cov_matrix(nus)
-        jittercov = self.build_jitter_cov_matrix() #needs to have same length as nus!
-        disscov = self.build_scintillation_cov_matrix(nus) 
+        sntf = self.template_fitting_sigmas(nus)
+        sJ = self.jitter_sigmas(nus)
+        sdiss,niss = self.scintillation_sigmas(nus)
 
+        block = niss < 2
+        d = sntf**2 + np.where(block,0.0,sdiss**2)
+        U = np.stack(np.broadcast_arrays(sJ,np.where(block,sdiss,0.0)),axis=-1)
+        return StructuredCovariance(d,U)
 
-        cov = sncov + jittercov + disscov
+    def polarization_error(self,nus):
+        '''
+        Same as epoch_averaged_error(self.build_polarization_cov_matrix(nus)), for nus of shape (...,nchan)
+        '''
+        with np.errstate(divide="ignore"):
+            return np.sqrt(1.0/np.sum(1.0/self.polarization_sigmas(nus)**2,axis=-1))
 
-        sigma2 = epoch_averaged_error(cov,var=True)
+    def calc_single(self,nus):
+        '''
+        Calculate sigma_TOA given a selection of frequencies
+        '''
+        cov = self.build_covariance(nus)
+
+        sigma2 = cov.epoch_averaged_variance()
 
         if self.vverbose:
+            sncov = self.build_template_fitting_cov_matrix(nus)
+            jittercov = self.build_jitter_cov_matrix() #needs to have same length as nus!
+            disscov = self.build_scintillation_cov_matrix(nus) 
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
                 print("White noise: %0.3f us"%np.sqrt(sigma2))
@@ -642,13 +913,13 @@ class FrequencyOptimizer:
 
         
         
-        sigmatel2 = epoch_averaged_error(self.build_polarization_cov_matrix(nus))
+        sigmatel2 = self.polarization_error(nus)
 
 
         sigmadm2 = self.DM_misestimation(nus,cov,covmat=True)**2
 
 
-        sigma = np.sqrt(sigma2 + sigmadm2 + sigmatel2) #need to include PBF errors?
+        sigma = float(np.sqrt(sigma2 + sigmadm2 + sigmatel2)) #need to include PBF errors?
 
 
         if self.vverbose:
@@ -665,242 +936,706 @@ class FrequencyOptimizer:
 
         return sigma
 
+    def calc_batch(self,nus):
+        '''
+        Calculate sigma_TOA for a stack of channel selections of shape (...,nchan) at once
+        '''
+        cov = self.build_covariance(nus)
+
+        sigma2 = cov.epoch_averaged_variance()
+        sigmatel2 = self.polarization_error(nus)
+        sigmadm2 = sum(self.DM_misestimation_components(nus,cov))
+
+        sigma = np.sqrt(sigma2 + sigmadm2 + sigmatel2)
+
+        if self.psrnoise.P is not None:
+            P = cell_values(self.psrnoise.P)
+            sigma = np.where(sigma > P,P,sigma)
+        return sigma
+
+    def calc_pulsars(self,nus):
+        '''
+        Calculate sigma_TOA for every pulsar of a PulsarNoiseBatch (self.psrnoise) at once, for one selection
+        of frequencies of shape (nchan,) shared by all pulsars or one per pulsar, of shape (N,nchan).
+        Returns an array of N values, the same as calc_single() for each pulsar.
+        '''
+        nus = np.asarray(nus,dtype=float)
+        return self.calc_batch(np.broadcast_to(nus,(len(self.psrnoise),nus.shape[-1])))
 
-    def calc(self):
+    def get_time_scaling(self,nus):
         '''
-        Run a full calculation over a grid of frequencies
+        Return a timescaling.TimeScaling of channel selections nus, of shape (...,nchan), or of shape (nchan,)
+        shared by all pulsars of a PulsarNoiseBatch, to evaluate sigma_TOA for other integration times and
+        to allocate observing time
+        '''
+        import timescaling
+        nus = np.asarray(nus,dtype=float)
+        if isinstance(self.psrnoise,PulsarNoiseBatch) and nus.ndim == 1:
+            nus = np.broadcast_to(nus,(len(self.psrnoise),len(nus)))
+        return timescaling.TimeScaling(self,nus)
+
+    def calc_cube(self,filename=None):
+        '''
+        Calculate sigma_TOA of every pulsar of a PulsarNoiseBatch (self.psrnoise) over the grid, as self.cube
+        of shape (N,)+self.sigmas.shape, memory-mapped to filename if given. The channels, receiver response,
+        DM(nu) kernel, and design matrix of each cell are computed once for all pulsars.
+        See objectives.py for array-level objectives of the cube.
+        '''
+        N = len(self.psrnoise)
+        Cs,Bs,valid = self.get_grid()
+        self.cube = allocate((N,)+valid.shape,filename)
+        cube = self.cube.reshape((N,-1))
+        inds = np.flatnonzero(valid)
+        chunk = max(int(self.memory_limit // (N*self.get_cell_bytes())),1)
+
+        freqopt = copy.copy(self)
+        freqopt.psrnoise = self.psrnoise.for_cells()
+        t0 = time.time()
+        for start in range(0,len(inds),chunk):
+            if self.progress is not None:
+                elapsed = time.time() - t0
+                self.progress(start,len(inds),elapsed,elapsed*(len(inds)-start)/max(start,1))
+            elif self.verbose:
+                print("Computing cells %i-%i (of %i) for %i pulsars"%(start,min(start+chunk,len(inds)),len(inds),N))
+            cells = inds[start:start+chunk]
+            nus = self.get_channels(Cs.flat[cells],Bs.flat[cells])
+            cube[:,cells] = freqopt.calc_batch(nus[np.newaxis])
+        if isinstance(self.cube,np.memmap):
+            self.cube.flush()
+        return self.cube
+
+    def calc_sweep(self,telnoises,nus=None,filename=None):
+        '''
+        Calculate sigma_TOA for each of a sequence of TelescopeNoise configurations (e.g., from
+        catalog.read_telescopes()), computing the telescope-independent terms only once (see design.py).
+        The integration times of the configurations may differ from that of self.telnoise.
+
+        For channel frequencies nus of shape (...,nchan), or (nchan,) shared by all pulsars of a
+        PulsarNoiseBatch, returns an array of shape (nconfig,)+nus.shape[:-1]. Otherwise computes the grid
+        as self.sweep, of shape (nconfig,N)+self.sigmas.shape for a PulsarNoiseBatch of N pulsars and
+        (nconfig,)+self.sigmas.shape for a PulsarNoise, memory-mapped to filename if given.
+        '''
+        import design
+        telnoises = list(telnoises)
+        batch = isinstance(self.psrnoise,PulsarNoiseBatch)
+        if nus is not None:
+            nus = np.asarray(nus,dtype=float)
+            if batch and nus.ndim == 1:
+                nus = np.broadcast_to(nus,(len(self.psrnoise),len(nus)))
+            return design.TelescopeSweep(self,nus).sweep(telnoises)
+
+        Cs,Bs,valid = self.get_grid()
+        freqopt = self
+        shape = ()
+        if batch:
+            freqopt = copy.copy(self)
+            freqopt.psrnoise = self.psrnoise.for_cells()
+            shape = (len(self.psrnoise),)
+        self.sweep = allocate((len(telnoises),)+shape+valid.shape,filename)
+        values = self.sweep.reshape((len(telnoises),)+shape+(-1,))
+        inds = np.flatnonzero(valid)
+        chunk = max(int(self.memory_limit // (len(telnoises)*int(np.prod(shape))*self.get_cell_bytes())),1)
+
+        t0 = time.time()
+        for start in range(0,len(inds),chunk):
+            if self.progress is not None:
+                elapsed = time.time() - t0
+                self.progress(start,len(inds),elapsed,elapsed*(len(inds)-start)/max(start,1))
+            elif self.verbose:
+                print("Computing cells %i-%i (of %i) for %i configurations"%(start,min(start+chunk,len(inds)),len(inds),len(telnoises)))
+            cells = inds[start:start+chunk]
+            nus = self.get_channels(Cs.flat[cells],Bs.flat[cells])
+            if batch:
+                nus = nus[np.newaxis]
+            values[...,cells] = design.TelescopeSweep(freqopt,nus).sweep(telnoises)
+        if isinstance(self.sweep,np.memmap):
+            self.sweep.flush()
+        return self.sweep
+
+    def get_array_optimum(self,objective="mean",weights=None,target=1.0):
+        '''
+        Shared center frequency and bandwidth that optimize an array-level objective of self.cube, see
+        objectives.aggregate()
+        '''
+        import objectives
+        Cs,Bs,valid = self.get_grid()
+        ind = objectives.find_optimum(objectives.aggregate_cube(self.cube,objective,weights,target))
+        if ind is None:
+            return np.nan,np.nan
+        return Cs[ind],Bs[ind]
+
+    def compare_objectives(self,objectives=None,weights=None,target=1.0):
+        '''
+        Optimal shared (C,B) of self.cube for each array-level objective and its loss under the others,
+        see objectives.compare_objectives()
+        '''
+        import objectives as objectives_module
+        if objectives is None:
+            objectives = objectives_module.OBJECTIVES
+        Cs,Bs,valid = self.get_grid()
+        return objectives_module.compare_objectives(self.cube,Cs,Bs,objectives,weights,target)
+
+    def get_grid(self,rows=slice(None)):
+        '''
+        Return the center frequencies, bandwidths, and validity of every grid cell (or of a slice of rows)
+        as arrays of the shape of self.sigmas
         '''
-        print("Computing for pulsar: %s"%self.psrnoise.name)
-        self.sigmas = np.zeros((len(self.Cs),len(self.Bs)))
         if self.frac_bw == False:
-            def loop_func(ic):
-                C = self.Cs[ic]
-                sigmas = np.zeros(len(self.Bs))
-                if self.verbose:
-                    print("Computing center freq %0.3f GHz (%i/%i)"%(C,ic,len(self.Cs)))
-                for ib,B in enumerate(self.Bs):
-                    #print C,B
-                    #if B > 1.9*C:
-                    #if B > 2*C*(self.r - 1)/(self.r + 1):
-                    if self.r is not None and ((C+0.5*B)/(C-0.5*B) > self.r or B > 1.9*C or C - B/2.0 < self.numin):
-                        self.sigmas[ic,ib] =np.nan
-                    else:
-                        nulow = C - B/2.0
-                        nuhigh = C + B/2.0
-
-                        if self.log == False:
-                            nus = np.linspace(nulow,nuhigh,self.nchan+1)[:-1] #more uniform sampling?
-                        else:
-                            nus = np.logspace(np.log10(nulow),np.log10(nuhigh),self.nchan+1)[:-1] #more uniform sampling?
-                        sigmas[ib] = self.calc_single(nus)
-                        #self.sigmas[ic,ib] = self.calc_single(nus)
-                        #print self.sigmas[ic,ib]
-                return sigmas
+            Cs,Bs = np.meshgrid(self.Cs[rows],self.Bs,indexing='ij')
+        else:
+            Cs,Fs = np.meshgrid(self.Cs[rows],self.Fs,indexing='ij')
+            Bs = Cs*Fs
+        return Cs,Bs,self.is_valid(Cs,Bs)
 
+    def is_valid(self,Cs,Bs):
+        '''
+        Return whether center frequencies Cs and bandwidths Bs lie within the region to be computed
+        '''
+        Cs = np.asarray(Cs)
+        Bs = np.asarray(Bs)
+        if self.frac_bw == False:
+            with np.errstate(divide="ignore",invalid="ignore"):
+                valid = Cs - Bs/2.0 > 0
+                if self.r is not None:
+                    valid &= ~(((Cs+0.5*Bs)/(Cs-0.5*Bs) > self.r) | (Bs > 1.9*Cs) | (Cs - Bs/2.0 < self.numin))
         else:
-            def loop_func(ic):
-                C = self.Cs[ic]
-                sigmas = np.zeros(len(self.Fs))
-                if verbose:
-                    print(ic,len(self.Cs),C)
-                for indf,F in enumerate(self.Fs):
-                    B = C*F
-                    if B > 1.9*C or B <= 0:
-                        self.sigmas[ic,indf] = np.nan
-                    else:
-                        nulow = C - B/2.0
-                        nuhigh = C + B/2.0
+            valid = (Bs <= 1.9*Cs) & (Bs > 0)
+        return valid
 
+    def get_cells(self):
+        '''
+        Return the grid indices, center frequencies, and bandwidths of all grid cells that need to be computed
+        '''
+        Cs,Bs,valid = self.get_grid()
+        ic,ib = np.nonzero(valid)
+        return ic,ib,Cs[ic,ib],Bs[ic,ib]
 
-                        if self.log == False:
-                            nus = np.linspace(nulow,nuhigh,self.nchan+1)[:-1] #more uniform sampling?
-                        else:
-                            nus = np.logspace(np.log10(nulow),np.log10(nuhigh),self.nchan+1)[:-1] #more uniform sampling?   
+    def get_cell_bytes(self):
+        '''
+        Approximate memory (bytes) used by the intermediate arrays of each grid cell being computed
+        '''
+        # The white-noise covariance is stored as a StructuredCovariance, only the DM(nu) matrices are dense
+        nbytes = 8*32*self.nchan
+        if self.full:
+            nbytes += 8*8*self.nchan**2 # DM(nu) matrices, their temporaries, and the copies made by the solver
+        return nbytes
+
+    def get_chunk_size(self,ncells,nprocs=1):
+        '''
+        Number of grid cells to compute at once, such that the intermediate arrays fit within memory_limit
+        '''
+        chunk = int(self.memory_limit // self.get_cell_bytes())
+        if nprocs > 1:
+            chunk = min(chunk,int(np.ceil(ncells/(4.0*nprocs))))
+        return max(chunk,1)
 
-                        #self.sigmas[ic,indf] = self.calc_single(nus)
-                        sigmas[indf] = self.calc_single(nus)
-                return sigmas
+    def get_process_memory(self,ncells,nshapes):
+        '''
+        Approximate peak memory (bytes) of one process computing ncells cells with nshapes DM(nu) kernels
+        '''
+        return min(self.memory_limit,ncells*self.get_cell_bytes()) + nshapes*self.nchan*8
 
+    def get_processes(self,ncells,nshapes=None):
+        '''
+        Return the number of processes and of BLAS threads per process (None to leave BLAS as is)
+        for computing ncells cells with nshapes distinct channel spacings
+        '''
+        if nshapes is None:
+            nshapes = ncells
+        if self.ncpu == "auto":
+            runtime = planning.estimate_runtime(ncells,self.nchan,nshapes,self.full)
+            return planning.choose_processes(runtime,self.nchan,"auto",self.get_process_memory(ncells,nshapes),planning.get_available_memory())
         if self.ncpu == 1:
-            for ic,C in enumerate(self.Cs):
-                self.sigmas[ic,:] = loop_func(ic)
-        else: #should set export OPENBLAS_NUM_THREADS=1
-            if self.verbose:
-                print("Attempting multiprocessing, nprocs=%s"%str(self.ncpu))
-            self.sigmas[:,:] = parallel.parmap(loop_func,range(len(self.Cs)),nprocs=self.ncpu)
+            return 1,None
+        return planning.choose_processes(0,self.nchan,self.ncpu)
 
+    def plan(self):
+        '''
+        Predict the runtime and peak memory of calc() over the full grid, and the number of processes
+        and BLAS threads it will use. Returns a planning.Plan, which prints as a summary.
+        '''
+        Cs,Bs,valid = self.get_grid()
+        ncells = int(np.sum(valid))
+        with np.errstate(divide="ignore",invalid="ignore"):
+            ratios = ((Cs+Bs/2.0)/(Cs-Bs/2.0))[valid]
+        nshapes = len(np.unique(np.round(ratios,10)))
+        nprocs,threads = self.get_processes(ncells,nshapes)
+
+        runtime = planning.estimate_runtime(ncells,self.nchan,nshapes,self.full)/nprocs
+        if nprocs > 1:
+            executor = self.executor if self.executor is not None else parallel.EXECUTORS.get((nprocs,None,threads))
+            if executor is None or len(executor.processes) == 0:
+                method = multiprocessing.get_start_method() if executor is None or executor.method is None else executor.method
+                runtime += planning.COST_STARTUP.get(method,1.0)
+
+        if self.output is None:
+            nblock = ncells
+            memory = valid.size*(8+1) + valid.size*(8+8+1) # sigmas and exact, and the temporary grid
+        else:
+            nblock = min(ncells,self.get_chunk_size(ncells,nprocs)*nprocs)
+            memory = valid.size*1
+        memory += nblock*self.nchan*8*(2 if nprocs > 1 else 1) # channel frequencies, and their shared copy
+        memory += nprocs*self.get_process_memory(int(np.ceil(nblock/float(nprocs))),nshapes)
+        return planning.Plan(ncells,self.nchan,nshapes,nprocs,1 if threads is None else threads,runtime,memory)
 
-    def plot(self,filename="triplot.png",doshow=True,figsize=(8,6),save=True,minimum=None,points=None,colorbararrow=None):
+    def get_fingerprint(self):
         '''
-        Create the triangle plots as in the optimal frequencies paper.
+        Hash of all inputs that determine sigma_TOA for a given selection of channels, including the code version
         '''
-        fig = figure(figsize=figsize)
-        ax = fig.add_subplot(111)
-        if self.frac_bw == False:
-            data = np.transpose(np.log10(self.sigmas))
-            if self.log == False:
-                im = uimshow(data,extent=[self.Cs[0],self.Cs[-1],self.Bs[0],self.Bs[-1]],cmap=cm.inferno_r,ax=ax)
+        return cache.fingerprint(self.psrnoise,self.galnoise,self.telnoise,self.log,self.full,self.masks,get_version())
 
-                ax.set_xlabel(r"$\mathrm{Center~Frequency~\nu_0~(GHz)}$")
-                ax.set_ylabel(r"$\mathrm{Bandwidth}~B~\mathrm{(GHz)}$")
-            else:
+    def calc_cells(self,Cs,Bs):
+        '''
+        Calculate sigma_TOA for 1D arrays of center frequencies and bandwidths.
+        Cells found in self.cell_store are not computed again
+        '''
+        nus = self.get_channels(Cs,Bs)
+        if self.cell_store is None:
+            return self.calc_channels(nus)
+
+        fingerprint = self.get_fingerprint()
+        sigmas,found = self.cell_store.lookup(fingerprint,nus)
+        if self.verbose:
+            print("Reusing %i of %i cells"%(np.sum(found),len(found)))
+        if not np.all(found):
+            sigmas[~found] = self.calc_channels(nus[~found])
+            self.cell_store.store(fingerprint,nus[~found],sigmas[~found])
+        return sigmas
+
+    def calc_channels(self,nus):
+        '''
+        Calculate sigma_TOA for channel selections of shape (ncells,nchan), in memory-limited chunks
+        '''
+        ncells = len(nus)
+        if ncells == 0:
+            return np.zeros(0)
+        nshapes = len(np.unique(np.round(nus[:,-1]/nus[:,0],10)))
+        nprocs,threads = self.get_processes(ncells,nshapes)
+        chunk = self.get_chunk_size(ncells,nprocs)
+        starts = range(0,ncells,chunk)
+
+        t0 = time.time()
+        def loop_func(start):
+            if self.progress is not None:
+                elapsed = time.time() - t0
+                self.progress(start,ncells,elapsed,elapsed*(ncells-start)/max(start,1))
+            elif self.verbose:
+                print("Computing cells %i-%i (of %i)"%(start,min(start+chunk,ncells),ncells))
+            return self.calc_batch(nus[start:start+chunk])
 
-                im = uimshow(data,extent=np.log10(np.array([self.Cs[0],self.Cs[-1],self.Bs[0],self.Bs[-1]])),cmap=cm.inferno_r,ax=ax)
-                cax = ax.contour(data,extent=np.log10(np.array([self.Cs[0],self.Cs[-1],self.Bs[0],self.Bs[-1]])),colors=self.colors,levels=self.levels,linewidths=self.lws,origin='lower')
-
-                #https://stackoverflow.com/questions/18390068/hatch-a-nan-region-in-a-contourplot-in-matplotlib
-                # get data you will need to create a "background patch" to your plot
-                xmin, xmax = ax.get_xlim()
-                ymin, ymax = ax.get_ylim()
-                xy = (xmin,ymin)
-                width = xmax - xmin
-                height = ymax - ymin
-                # create the patch and place it in the back of countourf (zorder!)
-                p = patches.Rectangle(xy, width, height, hatch='X', color='0.5', fill=None, zorder=-10)
-                ax.add_patch(p)
-
-
-                ax.set_xlabel(r"$\mathrm{Center~Frequency~\nu_0~(GHz)}$")
-                ax.set_ylabel(r"$\mathrm{Bandwidth}~B~\mathrm{(GHz)}$")
-                ax.xaxis.set_major_locator(MultipleLocator(0.5))
-                ax.yaxis.set_major_locator(MultipleLocator(0.5))
-                ax.xaxis.set_major_formatter(noformatter)
-                ax.yaxis.set_major_formatter(noformatter)
-
-                ax.text(0.05,0.9,"PSR~%s"%self.psrnoise.name.replace("-","$-$"),fontsize=18,transform=ax.transAxes,bbox=dict(boxstyle="square",fc="white"))
-
-            if minimum is not None:
-                checkdata = np.log10(self.sigmas)
-                flatdata = checkdata.flatten()
-                #inds = np.where(np.logical_not(np.isnan(flatdata)))[0]
-                inds = np.where((~np.isnan(flatdata))&~(np.isinf(flatdata)))[0]
-                MIN = np.min(flatdata[inds])
-                INDC,INDB = np.where(checkdata==MIN)
-                INDC,INDB = INDC[0],INDB[0]
-                MINB = self.Bs[INDB]
-                MINC = self.Cs[INDC]
-                cax = ax.contour(data,extent=np.log10(np.array([self.Cs[0],self.Cs[-1],self.Bs[0],self.Bs[-1]])),colors=['b','b'],levels=[np.log10(1.1*(10**MIN)),np.log10(1.5*(10**MIN))],linewidths=[1,1],linestyles=['--','--'],origin='lower')
-                print("Minimum",MINC,MINB,MIN)
-                with open("minima.txt",'a') as FILE:
-                    FILE.write("%s minima %f %f %f\n"%(self.psrnoise.name,MINC,MINB,MIN))
-                if self.log:
-                    ax.plot(np.log10(MINC),np.log10(MINB),minimum,zorder=50,ms=10)
-                else:
-                    ax.plot(MINC,MINB,minimum,zorder=50,ms=10)
-
-            if points is not None:
-                if type(points) == tuple:
-                    points = [points]
-                for point in points:
-                    x,y,fmt = point
-                    nulow = x - y/2.0
-                    nuhigh = x + y/2.0
-
-                    if self.log:
-                        ax.plot(np.log10(x),np.log10(y),fmt,zorder=50,ms=8)
-                        nus = np.logspace(np.log10(nulow),np.log10(nuhigh),self.nchan+1)[:-1] 
-                        sigma = np.log10(self.calc_single(nus))
-                    else:
-                        ax.plot(x,y,fmt,zorder=50,ms=8)
-                        nus = np.linspace(nulow,nuhigh,self.nchan+1)[:-1] #more uniform sampling?
-                        sigma = np.log10(self.calc_single(nus))
-                    with open("minima.txt",'a') as FILE:
-                        FILE.write("%s point %f %f %f\n"%(self.psrnoise.name,x,y,sigma))
+        if self.vverbose:
+            values = [[self.calc_single(x) for x in nus]]
+        elif nprocs == 1:
+            with parallel.blas_threads(threads):
+                values = [loop_func(start) for start in starts]
+        else: # the workers limit their BLAS threads themselves
+            executor = self.executor if self.executor is not None else parallel.get_executor(nprocs,blas_threads=threads)
+            if self.verbose:
+                print("Computing %i cells with %i processes"%(ncells,executor.nprocs))
+            return executor.map_array(self.calc_batch,nus,maxchunk=chunk)
+        return np.concatenate(values)
 
+    def __getstate__(self):
+        '''
+        State sent to worker processes: results, stores, and the executor stay behind, and the
+        shared DM(nu) cache is replaced by the worker's own
+        '''
+        state = self.__dict__.copy()
+        for key in ["sigmas","exact","cube","sweep","cell_store","run_cache","executor","progress"]:
+            state[key] = None
+        if self.dmnu_cache is DMNU_CACHE:
+            state["dmnu_cache"] = "DMNU_CACHE"
+        return state
+
+    def __setstate__(self,state):
+        if isinstance(state.get("dmnu_cache"),str):
+            state["dmnu_cache"] = DMNU_CACHE
+        self.__dict__.update(state)
+
+    def get_run_key(self,adaptive=False,**kwargs):
+        '''
+        Hash of everything that determines the result of calc(): the inputs and code version
+        (see get_fingerprint()), the grid, and the options
+        '''
+        grid = [self.numin,self.numax,self.dnu,self.nsteps,self.nchan,self.log,self.frac_bw,self.full_bandwidth,self.r,self.Cs,self.Bs]
+        options = [adaptive,kwargs,self.levels if adaptive else None]
+        return cache.fingerprint(self.get_fingerprint(),grid,options)
 
+    def calc(self,adaptive=False,**kwargs):
+        '''
+        Run a full calculation over a grid of frequencies
 
+        adaptive: Compute only the cells needed to resolve the minimum and contours, see calc_adaptive()
+        '''
+        if self.run_cache is not None:
+            key = self.get_run_key(adaptive,**kwargs)
+            result = self.run_cache.load(key)
+            if result is not None:
+                if self.verbose:
+                    print("Loading cached results for pulsar: %s"%self.psrnoise.name)
+                self.sigmas = result['sigmas']
+                if self.output is not None:
+                    self.sigmas = allocate(np.shape(result['sigmas']),self.output)
+                    self.sigmas[:] = result['sigmas']
+                    self.sigmas.flush()
+                self.exact = result['exact']
+                return
+        if adaptive:
+            self.calc_adaptive(**kwargs)
+        else:
+            self.calc_grid()
+        if self.output is not None:
+            self.sigmas.flush()
+        if self.run_cache is not None:
+            self.run_cache.store(key,sigmas=self.sigmas,exact=self.exact)
 
-            if colorbararrow is not None:
-                data = np.log10(self.sigmas)
-                flatdata = data.flatten()
-                #inds = np.where(np.logical_not(np.isnan(flatdata)))[0]
-                inds = np.where((~np.isnan(flatdata))&~(np.isinf(flatdata)))[0]
-                MIN = np.min(flatdata[inds])
-                MAX = np.max(flatdata[inds])
-                if self.log == True:
-                    x = np.log10(self.Cs[-1]*1.05)#self.Bs[-1])
-                    dx = np.log10(1.2)#np.log10(self.Cs[-1])#self.Bs[-1]*2)
-                    frac = (np.log10(colorbararrow)-MIN)/(MAX-MIN)
-                    y = frac*(np.log10(self.Bs[-1]) - np.log10(self.Bs[0])) + np.log10(self.Bs[0])
-                    arrow(x,y,dx,0.0,fc='k',ec='k',zorder=50,clip_on=False)
+    def calc_grid(self):
+        '''
+        Calculate sigma_TOA for every valid cell of the grid
+        '''
+        print("Computing for pulsar: %s"%self.psrnoise.name)
+        if self.verbose:
+            print("Plan: %s"%self.plan())
+        if self.output is None and self.checkpoint is None:
+            Cs,Bs,valid = self.get_grid()
+            self.sigmas = np.zeros(np.shape(valid)) + np.nan
+            self.sigmas[valid] = self.calc_cells(Cs[valid],Bs[valid])
+            self.exact = valid
+            return
+
+        # Compute blocks of rows, writing them to the memory-mapped output and checkpoint as they finish
+        shape = (len(self.Cs),np.shape(self.get_grid(slice(0,1))[0])[1])
+        self.sigmas = allocate(shape,self.output)
+        self.exact = np.zeros(shape,dtype=bool)
+        key = None if self.checkpoint is None else self.get_run_key()
+        done = self.load_checkpoint(key)
+        nprocs = self.get_processes(np.prod(shape))[0]
+        block_size = self.get_chunk_size(np.prod(shape),nprocs)*nprocs
+        last = time.time()
+        try:
+            for rows in iter_rows(self.sigmas,block_size):
+                todo = np.nonzero(~np.all(done[rows],axis=1))[0] + rows.start
+                if len(todo) == 0:
+                    continue
+                rows = slice(todo[0],todo[-1]+1)
+                self.sigmas[rows],self.exact[rows] = self.calc_rows(rows)
+                done[rows] = True
+                if time.time() - last >= self.checkpoint_interval:
+                    self.write_checkpoint(key,done)
+                    last = time.time()
+        except BaseException:
+            self.write_checkpoint(key,done)
+            raise
+        self.remove_checkpoint()
+
+    def load_checkpoint(self,key):
+        '''
+        Fill self.sigmas and self.exact with the cells completed in the checkpoint file, if it belongs
+        to the calculation with this key (see get_run_key()), and return the mask of completed cells
+        '''
+        done = np.zeros(np.shape(self.sigmas),dtype=bool)
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return done
+        with np.load(self.checkpoint) as data:
+            if str(data['key']) != key or data['done'].shape != done.shape:
+                if self.verbose:
+                    print("Ignoring checkpoint %s of a different calculation"%self.checkpoint)
+                return done
+            done = data['done']
+            self.sigmas[done] = data['sigmas'][done]
+            self.exact[done] = data['exact'][done]
+        if self.verbose:
+            print("Resuming from checkpoint %s, %i of %i cells done"%(self.checkpoint,np.sum(done),done.size))
+        return done
+
+    def write_checkpoint(self,key,done):
+        '''
+        Write the completed cells and the key of the calculation to the checkpoint file
+        '''
+        if self.checkpoint is None:
+            return
+        cache.atomic_savez(self.checkpoint,key=np.array(key),done=done,sigmas=np.where(done,self.sigmas,np.nan),exact=self.exact)
 
+    def remove_checkpoint(self):
+        if self.checkpoint is not None and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
 
+    def iter_calc(self,cells=False,progress=None):
+        '''
+        Generator form of calc(). Computes the grid in blocks of rows and yields (i,C,Bs,sigmas) for each
+        row i, with sigmas NaN for invalid cells, or with cells=True ((i,j),C,B,sigma) for each valid cell,
+        as soon as they are computed. Rows come in order when computed serially and in order of completion
+        from the process pool. self.sigmas and self.exact fill in as rows finish, so stopping early keeps
+        the completed part. The loop body may run other calculations, also in parallel.
+
+        progress: Called as progress(ndone,ntotal,elapsed,eta) with the numbers of cells of the grid and
+                  times in s after each block of rows (default: self.progress), e.g., print_progress.
+                  self.progress is not called for the chunks of cells within the blocks.
+        '''
+        if progress is None:
+            progress = self.progress
+        Cs,Bs,valid = self.get_grid()
+        self.sigmas = allocate(np.shape(valid),self.output)
+        self.exact = np.zeros(np.shape(valid),dtype=bool)
+        ntotal = int(np.sum(valid))
+        nprocs,threads = self.get_processes(ntotal)
+        blocks = list(iter_rows(valid,self.get_chunk_size(ntotal,max(nprocs,2))))
+
+        def compute(rows): # progress is reported per block of rows below, not per chunk of cells
+            calc_progress,self.progress = self.progress,None
+            try:
+                return self.calc_rows(rows)
+            finally:
+                self.progress = calc_progress
+
+        if nprocs == 1:
+            results = ((i,compute(rows)) for i,rows in enumerate(blocks))
+        else:
+            executor = self.executor if self.executor is not None else parallel.get_executor(nprocs,blas_threads=threads)
+            results = executor.imap_unordered(calc_rows,[(self,rows) for rows in blocks])
+        ndone = 0
+        start = time.time()
+        try:
+            for i,(sigmas,blockvalid) in results:
+                rows = blocks[i]
+                self.sigmas[rows] = sigmas
+                self.exact[rows] = blockvalid
+                ndone += int(np.sum(blockvalid))
+                if progress is not None:
+                    elapsed = time.time() - start
+                    progress(ndone,ntotal,elapsed,elapsed*(ntotal-ndone)/max(ndone,1))
+                for k in range(rows.start,rows.stop):
+                    if cells:
+                        for j in np.nonzero(blockvalid[k-rows.start])[0]:
+                            yield (k,j),Cs[k,j],Bs[k,j],sigmas[k-rows.start,j]
+                    else:
+                        yield k,Cs[k,0],Bs[k],sigmas[k-rows.start]
+        finally:
+            results.close() # stops the remaining work when the caller stops early
 
+    def calc_shard(self,index,nshards,filename):
+        '''
+        Compute shard index (0 <= index < nshards) of the grid, a deterministic block of rows, and write it
+        to filename, so that independent jobs can share one calculation. See merge_shards().
+        '''
+        return shards.calc_shard({self.psrnoise.name:self},index,nshards,filename)
 
-        else:
-            if self.log == False:
-                pass
-            else:
-                goodinds = []
-                for indf,F in enumerate(self.Fs):
-                    if np.any(np.isnan(self.sigmas[:,indf])):
-                        continue
-                    goodinds.append(indf)
-                goodinds = np.array(goodinds)
-                data = np.transpose(np.log10(self.sigmas[:,goodinds]))
-
-                im = uimshow(data,extent=np.log10(np.array([self.Cs[0],self.Cs[-1],self.Fs[goodinds][0],self.Fs[goodinds][-1]])),cmap=cm.inferno_r,ax=ax)
-                cax = ax.contour(data,extent=np.log10(np.array([self.Cs[0],self.Cs[-1],self.Fs[goodinds][0],self.Fs[goodinds][-1]])),colors=COLORS,levels=LEVELS,linewidths=LWS,origin='lower')
-
-                #im = uimshow(data,extent=np.array([np.log10(self.Cs[0]),np.log10(self.Cs[-1]),self.Fs[goodinds][0],self.Fs[goodinds][-1]]),cmap=cm.inferno_r,ax=ax)
-                #cax = ax.contour(data,extent=np.array([np.log10(self.Cs[0]),np.log10(self.Cs[-1]),self.Fs[goodinds][0],self.Fs[goodinds][-1]]),colors=COLORS,levels=LEVELS,linewidths=LWS,origin='lower')
-
-
-                
-                print(self.Fs)
-                ax.set_xlabel(r"$\mathrm{Center~Frequency~\nu_0~(GHz)}$")
-                #ax.set_ylabel(r"$r~\mathrm{(\nu_{max}/\nu_{min})}$")
-                ax.set_ylabel(r"$\mathrm{Fractional~Bandwidth~(B/\nu_0)}$")
-                # no log
-                #ax.yaxis.set_major_locator(FixedLocator(np.log10(np.arange(0.25,1.75,0.25))))
-                
-                ax.xaxis.set_major_formatter(noformatter)
-                #ax.yaxis.set_major_formatter(noformatter)
-            
-            
-        cbar = fig.colorbar(im)#,format=formatter)
-        cbar.set_label("$\mathrm{TOA~Uncertainty~\sigma_{TOA}~(\mu s)}$")
+    def merge_shards(self,filenames):
+        '''
+        Set sigmas and exact from the files of all shards of this calculation written by calc_shard()
+        '''
+        results = shards.merge_shards(filenames)
+        if list(results.keys()) != [self.psrnoise.name]:
+            raise ValueError("Shards are for %s, not %s"%(", ".join(results.keys()),self.psrnoise.name))
+        with np.load(filenames[0]) as data:
+            if str(data['key_0']) != self.get_run_key():
+                raise ValueError("Shards belong to a different calculation")
+        self.sigmas = results[self.psrnoise.name]['sigmas']
+        self.exact = results[self.psrnoise.name]['exact']
+
+    def calc_rows(self,rows):
+        '''
+        Calculate sigma_TOA for a slice of rows (center frequencies) of the grid.
+        Return the sigmas, NaN for invalid cells, and the validity of each cell
+        '''
+        Cs,Bs,valid = self.get_grid(rows)
+        sigmas = np.zeros(np.shape(valid)) + np.nan
+        sigmas[valid] = self.calc_cells(Cs[valid],Bs[valid])
+        return sigmas,valid
 
-        # https://stackoverflow.com/questions/6485000/python-matplotlib-colorbar-setting-tick-formator-locator-changes-tick-labels
-        cbar.locator = MultipleLocator(1)
-        cbar.formatter = formatter
+    def calc_adaptive(self,nstart=8,tolerance=0.02,margin=np.log10(1.1),max_fraction=0.8):
         '''
-        MAX = np.max(data[np.where(np.logical_not(np.isnan(data)))])
-        if MAX <= np.log10(700):
-            cbar.formatter = formatter100
-        else:
-            cbar.formatter = formatter
+        Run a coarse-to-fine calculation over the grid of frequencies.
+        Starting from a grid of about nstart x nstart cells, each block of cells is tested at the nodes of its
+        subdivision (its center and edge midpoints). It is filled by bilinear interpolation in log10(sigma) if
+        that reproduces these nodes to within tolerance (tolerance/4 if the block crosses one of the contour
+        levels), and subdivided otherwise, as are the blocks within margin (in log10(sigma)) of the minimum
+        and the blocks partly outside the valid region. self.exact marks the cells that were computed exactly.
+        If the first subdivision leaves more than max_fraction of the remaining cells in blocks to be tested,
+        the adaptive scheme would gain little, and all remaining cells are computed at once as in calc_grid().
         '''
-        cbar.update_ticks()
-        #if self.log:
-        #    cb = colorbar(cax)
+        print("Computing for pulsar: %s"%self.psrnoise.name)
+        Cs,Bs,valid = self.get_grid()
+        nC,nB = np.shape(valid)
+        self.sigmas = allocate((nC,nB),self.output)
+        self.exact = np.zeros((nC,nB),dtype=bool)
+        key = None if self.checkpoint is None else self.get_run_key(True,nstart=nstart,tolerance=tolerance,margin=margin,max_fraction=max_fraction)
+        self.exact = self.load_checkpoint(key) # the exactly computed cells are the completed ones
+        with np.errstate(divide="ignore",invalid="ignore"):
+            logsigmas = np.where(self.exact,np.log10(np.where(self.exact,self.sigmas,1.0)),np.nan)
+        last = [time.time()]
+
+        def nodes(n):
+            step = 2**int(max(np.floor(np.log2(max(n-1,1)/float(nstart))),0))
+            return np.array(sorted(set(range(0,n,step)) | set([n-1])))
+
+        def edges(inds):
+            if len(inds) == 1:
+                return np.zeros((1,2),dtype=int)
+            return np.stack((inds[:-1],inds[1:]),axis=1)
+
+        def compute(ic,ib):
+            inds = np.unique(np.ravel_multi_index((np.ravel(ic),np.ravel(ib)),(nC,nB)))
+            ic,ib = np.unravel_index(inds,(nC,nB))
+            todo = valid[ic,ib] & ~self.exact[ic,ib]
+            ic,ib = ic[todo],ib[todo]
+            if len(ic) == 0:
+                return
+            try:
+                self.sigmas[ic,ib] = self.calc_cells(Cs[ic,ib],Bs[ic,ib])
+            except BaseException:
+                self.write_checkpoint(key,self.exact)
+                raise
+            self.exact[ic,ib] = True
+            with np.errstate(divide="ignore",invalid="ignore"):
+                logsigmas[ic,ib] = np.log10(self.sigmas[ic,ib])
+            if time.time() - last[0] >= self.checkpoint_interval:
+                self.write_checkpoint(key,self.exact)
+                last[0] = time.time()
+
+        # number of valid cells in blocks (i0,i1,j0,j1), inclusive, from a summed-area table
+        table = np.zeros((nC+1,nB+1),dtype=int)
+        table[1:,1:] = np.cumsum(np.cumsum(valid,axis=0),axis=1)
+        def count(i0,i1,j0,j1):
+            return table[i1+1,j1+1] - table[i0,j1+1] - table[i1+1,j0] + table[i0,j0]
+
+        def interpolate(corners,ti,tj):
+            return (1-ti)*(1-tj)*corners[0] + (1-ti)*tj*corners[1] + ti*(1-tj)*corners[2] + ti*tj*corners[3]
+
+        iCs,iBs = nodes(nC),nodes(nB)
+        compute(*np.meshgrid(iCs,iBs,indexing='ij'))
+        blocks = np.array([(a0,a1,b0,b1) for a0,a1 in edges(iCs) for b0,b1 in edges(iBs)])
+        blocks = blocks[count(*blocks.T) > 0]
+        first = True
+
+        while len(blocks) > 0:
+            blocks = blocks[(blocks[:,1] - blocks[:,0] > 1) | (blocks[:,3] - blocks[:,2] > 1)] # else every cell is a computed corner
+            i0,i1,j0,j1 = [x[:,np.newaxis,np.newaxis] for x in blocks.T]
+            ip = np.concatenate((i0,(i0+i1)//2,i1),axis=1)
+            jp = np.concatenate((j0,(j0+j1)//2,j1),axis=2)
+            compute(*np.broadcast_arrays(ip,jp))
+            finite = np.isfinite(logsigmas)
+            MIN = np.min(logsigmas[finite]) if np.any(finite) else np.nan
+
+            probes = logsigmas[ip,jp]
+            corners = [probes[:,a,b,np.newaxis,np.newaxis] for a,b in [(0,0),(0,2),(2,0),(2,2)]]
+            ti = (ip-i0)/np.maximum(i1-i0,1).astype(float)
+            tj = (jp-j0)/np.maximum(j1-j0,1).astype(float)
+            error = np.max(np.abs(probes - interpolate(corners,ti,tj)),axis=(1,2))
+            cmin,cmax = np.min(probes,axis=(1,2)),np.max(probes,axis=(1,2))
+            contour = np.any((self.levels >= cmin[:,np.newaxis]) & (self.levels <= cmax[:,np.newaxis]),axis=1)
+            i0,i1,j0,j1 = blocks.T
+            complete = (count(i0,i1,j0,j1) == (i1-i0+1)*(j1-j0+1)) & np.all(np.isfinite(probes),axis=(1,2))
+            accept = complete & (cmin > MIN + margin) & (error <= np.where(contour,tolerance/4.0,tolerance))
+
+            for i0,i1,j0,j1 in blocks[accept]:
+                corners = logsigmas[[i0,i0,i1,i1],[j0,j1,j0,j1]]
+                ti,tj = np.meshgrid(np.linspace(0,1,i1-i0+1),np.linspace(0,1,j1-j0+1),indexing='ij')
+                fill = ~self.exact[i0:i1+1,j0:j1+1]
+                self.sigmas[i0:i1+1,j0:j1+1][fill] = 10**interpolate(corners,ti,tj)[fill]
+
+            # subdivide the others into halves along each axis that is longer than one cell
+            i0,i1,j0,j1 = blocks[~accept].T
+            splitC,splitB = i1 - i0 > 1,j1 - j0 > 1
+            iend,istart = np.where(splitC,(i0+i1)//2,i1),np.where(splitC,(i0+i1)//2,i0)
+            jend,jstart = np.where(splitB,(j0+j1)//2,j1),np.where(splitB,(j0+j1)//2,j0)
+            halves = [(i0,iend,j0,jend),(i0,iend,jstart,j1),(istart,i1,j0,jend),(istart,i1,jstart,j1)]
+            blocks = np.unique(np.concatenate([np.stack(half,axis=1) for half in halves]),axis=0)
+            blocks = blocks[count(*blocks.T) > 0]
+
+            if first and len(blocks) > 0:
+                first = False
+                # cells covered by the blocks, which share their edges, from a 2D difference array
+                covered = np.zeros((nC+1,nB+1),dtype=int)
+                i0,i1,j0,j1 = blocks.T
+                for di,dj,sign in [(i0,j0,1),(i0,j1+1,-1),(i1+1,j0,-1),(i1+1,j1+1,1)]:
+                    np.add.at(covered,(di,dj),sign)
+                covered = np.cumsum(np.cumsum(covered,axis=0),axis=1)[:nC,:nB] > 0
+                remaining = np.sum(valid & ~self.exact)
+                pending = np.sum(covered & valid & ~self.exact)
+                if pending > max_fraction*remaining:
+                    if self.verbose:
+                        print("Adaptive refinement would test %i of %i remaining cells, computing all"%(pending,remaining))
+                    compute(*np.nonzero(valid & ~self.exact))
+                    break
+
+        if self.verbose:
+            print("Computed %i of %i cells exactly"%(np.sum(self.exact),np.sum(valid)))
+        self.remove_checkpoint()
+
+
+    def find_optimum(self,starts=None,nstart=5,nbest=3,maxiter=100,tol=1e-8):
+        '''
+        Find the optimal center frequency and bandwidth to sub-grid precision without computing the grid.
+        log10(sigma_TOA) is minimized over (log10(C),log10(B)) with SLSQP, within the range of the grid and
+        subject to B < 1.9 C and, if r is set, the same constraints as calc() (r and numin).
 
+        starts: List of (C,B) starting points, e.g., the optima of similar pulsars
+        nstart: If starts is None, evaluate a coarse nstart x nstart grid...
+        nbest: ...and start from its nbest lowest cells
 
+        Returns C,B,sigma
+        '''
+        import scipy.optimize as optimize
+        Cs,Bs,valid = self.get_grid()
+        bounds = [(np.log10(np.min(Cs)),np.log10(np.max(Cs))),(np.log10(np.min(Bs)),np.log10(np.max(Bs)))]
+
+        # Constraints as functions of x = (log10(C),log10(B)) that must be non-negative
+        constraints = [lambda x: np.log10(1.9) + x[0] - x[1]]
+        if self.r is not None and self.frac_bw == False:
+            constraints.append(lambda x: np.log10(2.0*(self.r-1)/(self.r+1)) + x[0] - x[1])
+            constraints.append(lambda x: (10**x[0] - 10**x[1]/2.0)/self.numin - 1)
+        constraints = [{'type':'ineq','fun':fun} for fun in constraints]
+
+        def func(x):
+            C,B = 10**x
+            if B >= 2*C:
+                return 1e3 # SLSQP can step slightly outside of the constraints, but nulow must stay positive
+            return np.log10(self.calc_single(self.get_channels(C,B)))
+
+        if starts is None:
+            logCs,logBs = np.meshgrid(np.linspace(bounds[0][0],bounds[0][1],nstart),np.linspace(bounds[1][0],bounds[1][1],nstart),indexing='ij')
+            Cs,Bs = 10**logCs.ravel(),10**logBs.ravel()
+            inds = self.is_valid(Cs,Bs) & (Bs <= 1.9*Cs)
+            Cs,Bs = Cs[inds],Bs[inds]
+            sigmas = self.calc_cells(Cs,Bs)
+            inds = np.argsort(sigmas)[:nbest]
+            starts = list(zip(Cs[inds],Bs[inds]))
+
+        best = None
+        for C,B in starts:
+            x0 = np.clip(np.log10([C,B]),[b[0] for b in bounds],[b[1] for b in bounds])
+            result = optimize.minimize(func,x0,method="SLSQP",bounds=bounds,constraints=constraints,tol=tol,options={'maxiter':maxiter})
+            if self.verbose:
+                print("Start C=%0.3f GHz, B=%0.3f GHz: optimum C=%0.3f GHz, B=%0.3f GHz, sigma=%0.3f us after %i evaluations"%(C,B,10**result.x[0],10**result.x[1],10**result.fun,result.nfev))
+            feasible = all(constraint['fun'](result.x) > -1e-6 for constraint in constraints)
+            if feasible and (best is None or result.fun < best.fun):
+                best = result
 
-        if save:
-            savefig(filename)
-        if doshow:
-            show()
-        else:
-            close()
+        if best is None:
+            return np.nan,np.nan,np.nan
+        C,B = 10**best.x
+        return C,B,10**best.fun
+
+    def plot(self,filename="triplot.png",doshow=True,figsize=(8,6),save=True,minimum=None,points=None,colorbararrow=None):
+        '''
+        Create the triangle plots as in the optimal frequencies paper. Plotting lives in plotting.py,
+        so that matplotlib is only imported when needed.
+        '''
+        import plotting
+        plotting.plot(self,filename,doshow=doshow,figsize=figsize,save=save,minimum=minimum,points=points,colorbararrow=colorbararrow)
 
     def save(self,filename):
         '''
         Output the results of the grid runs to a file
         '''
         if self.frac_bw == False:
-            np.savez(filename,Cs=self.Cs,Bs=self.Bs,sigmas=self.sigmas)
+            np.savez(filename,Cs=self.Cs,Bs=self.Bs,sigmas=self.sigmas,exact=self.exact)
         else:
-            np.savez(filename,Cs=self.Cs,Fs=self.Fs,sigmas=self.sigmas)
+            np.savez(filename,Cs=self.Cs,Fs=self.Fs,sigmas=self.sigmas,exact=self.exact)
 
     def get_optimum(self):
-        checkdata = np.log10(self.sigmas)
-        flatdata = checkdata.flatten()
-        #inds = np.where(np.logical_not(np.isnan(flatdata)))[0]
-        inds = np.where((~np.isnan(flatdata))&~(np.isinf(flatdata)))[0]
-        MIN = np.min(flatdata[inds])
-        INDC,INDB = np.where(checkdata==MIN)
-        INDC,INDB = INDC[0],INDB[0]
+        MIN,MAX,(INDC,INDB) = grid_extrema(self.sigmas)
         MINB = self.Bs[INDB]
         MINC = self.Cs[INDC]
 
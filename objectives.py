@@ -0,0 +1,108 @@
+import numpy as np
+from frequencyoptimizer import iter_rows,BLOCK_SIZE
+
+
+### ==================================================
+### Array-level objectives
+### ==================================================
+
+OBJECTIVES = ["mean","median","fraction","inverse_variance"]
+
+
+def aggregate(sigmas,objective="mean",weights=None,target=1.0):
+    '''
+    Array-level figure of merit, lower is better, of the sigma_TOA of N pulsars along the first axis of sigmas
+
+    mean: Weighted mean of sigma
+    median: Median of sigma (unweighted)
+    fraction: Minus the weighted fraction of pulsars with sigma < target (us)
+    inverse_variance: (sum of w/sigma^2)^(-1/2) with the weights w normalized to a sum of one,
+                      i.e., the sigma of an equivalent single pulsar
+
+    weights: N weights (default: equal)
+    The result is NaN wherever sigma is NaN for any pulsar.
+    '''
+    sigmas = np.asarray(sigmas,dtype=float)
+    if weights is None:
+        weights = np.ones(len(sigmas))
+    weights = np.asarray(weights,dtype=float)
+    w = np.reshape(weights/np.sum(weights),(-1,)+(1,)*(sigmas.ndim-1))
+    with np.errstate(divide="ignore",invalid="ignore"):
+        if objective == "mean":
+            retval = np.sum(w*sigmas,axis=0)
+        elif objective == "median":
+            retval = np.median(sigmas,axis=0)
+        elif objective == "fraction":
+            retval = -np.sum(w*(sigmas < target),axis=0)
+        elif objective == "inverse_variance":
+            retval = 1.0/np.sqrt(np.sum(w/sigmas**2,axis=0))
+        else:
+            raise ValueError("Unknown objective %s, use one of %s"%(objective,", ".join(OBJECTIVES)))
+    return np.where(np.any(np.isnan(sigmas),axis=0),np.nan,retval)
+
+
+def aggregate_cube(cube,objective="mean",weights=None,target=1.0,block_size=BLOCK_SIZE):
+    '''
+    aggregate() of a (pulsar,C,B) cube of sigma_TOA (e.g., memory-mapped), read in blocks of rows of C
+    '''
+    retval = np.zeros(np.shape(cube)[1:]) + np.nan
+    for rows in iter_rows(cube[0],max(block_size//len(cube),1)):
+        retval[rows] = aggregate(cube[:,rows],objective,weights,target)
+    return retval
+
+
+def find_optimum(values):
+    '''
+    Index of the lowest non-NaN value of a grid, or None if all values are NaN
+    '''
+    if np.all(np.isnan(values)):
+        return None
+    return np.unravel_index(np.nanargmin(values),np.shape(values))
+
+
+def compare_objectives(cube,Cs,Bs,objectives=OBJECTIVES,weights=None,target=1.0):
+    '''
+    Optimal shared (C,B) of a (pulsar,C,B) cube for each objective, and how much worse it does under
+    each of the other objectives. Cs and Bs are the center frequencies and bandwidths of every cell.
+
+    Returns a dictionary keyed by objective of dictionaries with the optimum C, B, and value, and losses,
+    a dictionary keyed by objective of the loss at this optimum relative to that objective's own best:
+    relative (value/best - 1) for the sigma-like objectives and the difference in the fraction of
+    pulsars for "fraction"
+    '''
+    values = dict((objective,aggregate_cube(cube,objective,weights,target)) for objective in objectives)
+    optima = dict((objective,find_optimum(values[objective])) for objective in objectives)
+    report = dict()
+    for objective in objectives:
+        ind = optima[objective]
+        if ind is None:
+            report[objective] = dict(C=np.nan,B=np.nan,value=np.nan,losses=dict())
+            continue
+        losses = dict()
+        for other in objectives:
+            if optima[other] is None:
+                continue
+            value,best = values[other][ind],values[other][optima[other]]
+            if other == "fraction":
+                losses[other] = value - best
+            else:
+                losses[other] = value/best - 1
+        report[objective] = dict(C=float(Cs[ind]),B=float(Bs[ind]),value=float(values[objective][ind]),losses=losses)
+    return report
+
+
+def format_comparison(report):
+    '''
+    Table of the output of compare_objectives()
+    '''
+    objectives = list(report.keys())
+    lines = ["%-18s %8s %8s %10s   %s"%("objective","C(GHz)","B(GHz)","value","loss under: "+" ".join("%10s"%other[:10] for other in objectives))]
+    for objective in objectives:
+        result = report[objective]
+        losses = " ".join("%10.4f"%result["losses"].get(other,np.nan) for other in objectives)
+        lines.append("%-18s %8.4f %8.4f %10.4f   %s%s"%(objective,result["C"],result["B"],result["value"]," "*12,losses))
+    Cs = np.array([report[objective]["C"] for objective in objectives])
+    Bs = np.array([report[objective]["B"] for objective in objectives])
+    if np.any(np.isfinite(Cs)):
+        lines.append("Spread of the optima: C %.4f-%.4f GHz, B %.4f-%.4f GHz"%(np.nanmin(Cs),np.nanmax(Cs),np.nanmin(Bs),np.nanmax(Bs)))
+    return "\n".join(lines)
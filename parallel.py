@@ -1,36 +1,422 @@
 import multiprocessing
+import multiprocessing.shared_memory
+import multiprocessing.resource_tracker
+import atexit
+import contextlib
+import os
+import pickle
+import queue
+import signal
+import threading
+import time
+import traceback
+import warnings
+from concurrent.futures import CancelledError
+import numpy as np
+try:
+    import threadpoolctl
+except ImportError:
+    threadpoolctl = None
 
 
 ### ==================================================
 ### Parallelization
 ### ==================================================
 
-# https://stackoverflow.com/questions/3288595/multiprocessing-how-to-use-pool-map-on-a-function-defined-in-a-class/16071616#16071616
-def fun(f, q_in, q_out):
+# Environment variables read by the common BLAS libraries when they are loaded
+BLAS_ENV_VARS = ["OMP_NUM_THREADS","OPENBLAS_NUM_THREADS","MKL_NUM_THREADS","VECLIB_MAXIMUM_THREADS","NUMEXPR_NUM_THREADS"]
+
+WARNED = set()
+
+def warn_once(message):
+    if message not in WARNED:
+        WARNED.add(message)
+        warnings.warn(message,RuntimeWarning,stacklevel=3)
+
+
+def limit_blas_threads(nthreads):
+    '''
+    Limit the BLAS libraries already loaded in this process to nthreads threads.
+    Requires threadpoolctl; returns the threadpool_limits object, or None if it is not installed
+    (with a warning, once)
+    '''
+    if nthreads is None:
+        return None
+    if threadpoolctl is None:
+        warn_once("threadpoolctl is not installed, so BLAS threads in this process cannot be limited to %i"%nthreads)
+        return None
+    return threadpoolctl.threadpool_limits(limits=nthreads)
+
+
+@contextlib.contextmanager
+def blas_threads(nthreads):
+    '''
+    Context in which BLAS uses nthreads threads (no-op if nthreads is None or threadpoolctl is not installed)
+    '''
+    limits = limit_blas_threads(nthreads)
+    try:
+        yield
+    finally:
+        if limits is not None:
+            limits.restore_original_limits()
+
+
+def get_start_method(method=None,blas_threads=None):
+    '''
+    Start method for workers with blas_threads BLAS threads. Forked workers inherit the parent's
+    BLAS threads and can only change them with threadpoolctl, so without it the default fork
+    becomes spawn, whose workers read BLAS_ENV_VARS when they load BLAS.
+    '''
+    if blas_threads is None or threadpoolctl is not None:
+        return method
+    if multiprocessing.get_context(method).get_start_method() != "fork":
+        return method
+    if method is None:
+        return "spawn"
+    warn_once("threadpoolctl is not installed, so forked workers cannot limit their BLAS threads to %i; use method=\"spawn\" or install threadpoolctl"%blas_threads)
+    return method
+
+
+class RemoteTraceback(Exception):
+    '''
+    Traceback of an exception raised in a worker, attached as the __cause__ of the re-raised exception
+    '''
+    def __init__(self,tb):
+        self.tb = tb
+    def __str__(self):
+        return self.tb
+
+
+def guided_chunks(n,nprocs,minchunk=1,maxchunk=None):
+    '''
+    Split range(n) into (start,stop) chunks of decreasing size, (remaining work)/(2 nprocs),
+    so that the workers are handed large chunks first and all finish at about the same time
+    '''
+    chunks = []
+    start = 0
+    while start < n:
+        size = max(int(np.ceil((n-start)/(2.0*nprocs))),minchunk)
+        if maxchunk is not None:
+            size = min(size,maxchunk)
+        chunks.append((start,min(start+size,n)))
+        start += size
+    return chunks
+
+
+def attach_shared_memory(name):
+    '''
+    Attach to an existing shared memory block without registering it with the resource tracker: only the
+    process that created the block owns and unlinks it, otherwise the tracker reports it as leaked
+    '''
+    try:
+        return multiprocessing.shared_memory.SharedMemory(name=name,track=False) # Python 3.13+
+    except TypeError:
+        pass
+    register = multiprocessing.resource_tracker.register
+    multiprocessing.resource_tracker.register = lambda name,rtype: None
+    try:
+        return multiprocessing.shared_memory.SharedMemory(name=name)
+    finally:
+        multiprocessing.resource_tracker.register = register
+
+
+class SharedArray:
+    '''
+    numpy array in a multiprocessing.shared_memory block, created or, if name is given, attached to
+    '''
+    def __init__(self,shape,dtype=float,name=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        nbytes = max(int(np.prod(self.shape))*self.dtype.itemsize,1)
+        if name is None:
+            self.shm = multiprocessing.shared_memory.SharedMemory(create=True,size=nbytes)
+        else:
+            self.shm = attach_shared_memory(name)
+        self.array = np.ndarray(self.shape,dtype=self.dtype,buffer=self.shm.buf)
+
+    def spec(self):
+        return (self.shape,self.dtype.str,self.shm.name)
+
+    def close(self,unlink=False):
+        self.array = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def worker(q_job,q_tasks,q_out,cancelled,nthreads=None):
+    '''
+    Worker loop. Jobs (job_id,function,kind,spec) arrive on the worker's own queue q_job, chunks
+    (job_id,start,stop,items) of all jobs on the shared queue q_tasks, with start=None ending a job.
+    Chunks of jobs that are cancelled or already over are skipped.
+    '''
+    signal.signal(signal.SIGINT,signal.SIG_IGN) # interrupts are handled by the parent
+    if threadpoolctl is not None: # otherwise BLAS_ENV_VARS did, see get_start_method()
+        limit_blas_threads(nthreads)
+    pending = None
     while True:
-        i, x = q_in.get()
-        if i is None:
+        job = q_job.get()
+        if job is None:
             break
-        q_out.put((i, f(x)))
+        job_id,payload,kind,spec = job
+        arrays = None
+        try:
+            f = pickle.loads(payload)
+        except BaseException as e:
+            f = None
+            error = e,traceback.format_exc()
 
+        while True:
+            if pending is not None:
+                task,pending = pending,None
+            else:
+                task = q_tasks.get()
+            tid,start,stop,items = task
+            if tid < job_id: # left over from an earlier job
+                continue
+            if tid > job_id: # this job is over, the task belongs to the next one
+                pending = task
+                break
+            if start is None:
+                break
+            if cancelled.value >= job_id:
+                continue
+            try:
+                if f is None:
+                    raise error[0]
+                if kind == "array":
+                    if arrays is None: # attached only once there is work, i.e., while the caller keeps the block
+                        arrays = [] # filled in place, so that blocks attached before a failure are closed
+                        arrays.extend(SharedArray(*s) for s in spec)
+                    inp,out = arrays[0].array,arrays[1].array
+                    out[start:stop] = f(inp[start:stop])
+                    q_out.put((job_id,start,None,None))
+                else:
+                    q_out.put((job_id,start,[f(x) for x in items],None))
+            except BaseException as e:
+                tb = error[1] if f is None else traceback.format_exc()
+                try:
+                    pickle.dumps(e)
+                except Exception:
+                    e = RuntimeError(repr(e))
+                q_out.put((job_id,start,None,(e,tb)))
+        for array in arrays or []:
+            array.close()
 
-def parmap(f, X, nprocs=None):
-    if nprocs is None:
-        nprocs = multiprocessing.cpu_count()
-    q_in = multiprocessing.Queue(1)
-    q_out = multiprocessing.Queue()
 
-    proc = [multiprocessing.Process(target=fun, args=(f, q_in, q_out))
-            for _ in range(nprocs)]
-    for p in proc:
-        p.daemon = True
-        p.start()
+class Executor:
+    '''
+    Pool of persistent worker processes.
+
+    nprocs: Number of workers (default: number of CPUs)
+    method: multiprocessing start method, e.g., "fork" or "spawn" (default: the platform default,
+            or spawn instead of fork if blas_threads is set and threadpoolctl is not installed)
+    timeout: Default time limit (s) for each call, None for no limit
+    blas_threads: Number of BLAS threads in each worker, None to leave as is. Spawned workers
+                  read it from the environment, forked workers need threadpoolctl.
+
+    Workers are started on first use and kept until shutdown(), so that state such as the
+    DM(nu) kernel cache stays warm between calls. Functions must be picklable, e.g., module-level
+    functions or bound methods. Exceptions in workers are re-raised in the caller, and cancel()
+    (e.g., from another thread) or a timeout stops the current call. A call made while another one
+    is still open (e.g., inside a loop over imap_unordered(), or from another thread) runs on a
+    temporary pool of its own.
+    '''
+    def __init__(self,nprocs=None,method=None,timeout=None,blas_threads=1):
+        if nprocs is None:
+            nprocs = multiprocessing.cpu_count()
+        self.nprocs = nprocs
+        self.method = get_start_method(method,blas_threads)
+        self.timeout = timeout
+        self.blas_threads = blas_threads
+        self.context = multiprocessing.get_context(self.method)
+        self.processes = []
+        self.job_id = 0
+        self.lock = threading.Lock()
+        self.busy = False # whether a call is in progress, possibly suspended at a yield
+        self.cancel_event = threading.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.shutdown()
+
+    def start(self):
+        if len(self.processes) > 0:
+            return
+        self.q_jobs = [self.context.Queue() for _ in range(self.nprocs)]
+        self.q_tasks = self.context.Queue()
+        self.q_out = self.context.Queue()
+        self.cancelled = self.context.Value('l',self.job_id,lock=False)
+        environ = dict(os.environ)
+        if self.blas_threads is not None:
+            os.environ.update(dict((var,str(self.blas_threads)) for var in BLAS_ENV_VARS))
+        try:
+            for q_job in self.q_jobs:
+                p = self.context.Process(target=worker,args=(q_job,self.q_tasks,self.q_out,self.cancelled,self.blas_threads))
+                p.daemon = True
+                p.start()
+                self.processes.append(p)
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+
+    def shutdown(self,terminate=False):
+        '''
+        Stop the workers; they are restarted by the next call
+        '''
+        if len(self.processes) == 0:
+            return
+        if not terminate:
+            for q_job in self.q_jobs:
+                q_job.put(None)
+            for p in self.processes:
+                p.join(5)
+        for p in self.processes:
+            if p.is_alive():
+                p.terminate()
+                p.join()
+        for q in self.q_jobs + [self.q_tasks,self.q_out]:
+            q.close()
+            q.cancel_join_thread()
+        self.processes = []
+
+    def cancel(self):
+        '''
+        Stop the current call, which raises concurrent.futures.CancelledError
+        '''
+        self.cancel_event.set()
+
+    def run(self,f,kind,chunks,spec=None,items=None,timeout=None):
+        '''
+        Hand out chunks of a job to the workers and return the results of each chunk by start index
+        '''
+        return dict(self.iter_run(f,kind,chunks,spec,items,timeout))
 
-    sent = [q_in.put((i, x)) for i, x in enumerate(X)]
-    [q_in.put((None, None)) for _ in range(nprocs)]
-    res = [q_out.get() for _ in range(len(sent))]
+    def iter_run(self,f,kind,chunks,spec=None,items=None,timeout=None):
+        '''
+        Hand out chunks of a job to the workers and yield (start index, result) of each chunk as it finishes
+        '''
+        payload = pickle.dumps(f) # fail here rather than in the queue's feeder thread
+        if timeout is None:
+            timeout = self.timeout
+        with self.lock:
+            busy = self.busy
+            self.busy = True
+        if busy:
+            # A job of this pool is still open, e.g., the caller is iterating over imap_unordered() and
+            # computes something else in the loop, or another thread uses it: run on a pool of its own
+            with Executor(self.nprocs,self.method,timeout,self.blas_threads) as executor:
+                for result in executor.iter_run(f,kind,chunks,spec,items,timeout):
+                    yield result
+            return
 
-    [p.join() for p in proc]
+        try:
+            self.start()
+            self.cancel_event.clear()
+            self.job_id += 1
+            job_id = self.job_id
+            for q_job in self.q_jobs:
+                q_job.put((job_id,payload,kind,spec))
+            for start,stop in chunks:
+                self.q_tasks.put((job_id,start,stop,None if items is None else items[start:stop]))
+            for _ in self.processes:
+                self.q_tasks.put((job_id,None,None,None))
 
-    return [x for i, x in sorted(res)]
+            deadline = None if timeout is None else time.time()+timeout
+            nresults = 0
+            restart = False # whether the workers may be stuck or gone
+            try:
+                while nresults < len(chunks):
+                    if self.cancel_event.is_set():
+                        raise CancelledError()
+                    wait = 0.1
+                    if deadline is not None:
+                        if time.time() > deadline:
+                            restart = True
+                            raise TimeoutError("Parallel job did not finish within %g s"%timeout)
+                        wait = max(min(wait,deadline-time.time()),0.001)
+                    try:
+                        tid,start,value,error = self.q_out.get(timeout=wait)
+                    except queue.Empty:
+                        if not all(p.is_alive() for p in self.processes):
+                            restart = True
+                            raise RuntimeError("A worker process died unexpectedly")
+                        continue
+                    if tid != job_id:
+                        continue
+                    if error is not None:
+                        e,tb = error
+                        raise e from RemoteTraceback(tb)
+                    nresults += 1
+                    yield start,value
+            except BaseException as e:
+                self.cancelled.value = job_id
+                if restart or isinstance(e,KeyboardInterrupt):
+                    self.shutdown(terminate=True)
+                raise
+        finally:
+            self.busy = False
 
+    def map_array(self,f,X,maxchunk=None,minchunk=1,dtype=float,timeout=None):
+        '''
+        Return the concatenation of f(X[start:stop]) over chunks of the first axis of X, where f
+        returns one value per row. X and the result are exchanged through shared memory.
+        '''
+        X = np.ascontiguousarray(X)
+        n = len(X)
+        if n == 0:
+            return np.zeros(0,dtype=dtype)
+        inp = SharedArray(X.shape,X.dtype)
+        out = SharedArray((n,),dtype)
+        try:
+            inp.array[:] = X
+            self.run(f,"array",guided_chunks(n,self.nprocs,minchunk,maxchunk),spec=[inp.spec(),out.spec()],timeout=timeout)
+            retval = np.array(out.array)
+        finally:
+            inp.close(unlink=True)
+            out.close(unlink=True)
+        return retval
+
+    def map(self,f,X,maxchunk=None,timeout=None):
+        '''
+        Return [f(x) for x in X], computed in chunks of items
+        '''
+        X = list(X)
+        results = self.run(f,"items",guided_chunks(len(X),self.nprocs,1,maxchunk),items=X,timeout=timeout)
+        return [x for start in sorted(results) for x in results[start]]
+
+    def imap_unordered(self,f,X,maxchunk=1,timeout=None):
+        '''
+        Yield (index,f(x)) for x in X as the results come in
+        '''
+        X = list(X)
+        for start,values in self.iter_run(f,"items",guided_chunks(len(X),self.nprocs,1,maxchunk),items=X,timeout=timeout):
+            for i,value in enumerate(values):
+                yield start+i,value
+
+
+EXECUTORS = dict()
+
+def get_executor(nprocs=None,method=None,blas_threads=1):
+    '''
+    Return a shared, persistent Executor for nprocs workers
+    '''
+    key = (nprocs,method,blas_threads)
+    if key not in EXECUTORS:
+        EXECUTORS[key] = Executor(nprocs,method,blas_threads=blas_threads)
+    return EXECUTORS[key]
+
+@atexit.register
+def shutdown_executors():
+    for executor in EXECUTORS.values():
+        executor.shutdown()
+    EXECUTORS.clear()
+
+
+def parmap(f, X, nprocs=None):
+    '''
+    Return [f(x) for x in X] using the shared Executor. f must be picklable
+    '''
+    return get_executor(nprocs).map(f, X)
@@ -0,0 +1,146 @@
+import numpy as np
+import os
+import time
+
+
+### ==================================================
+### Cost model for grid runs
+### ==================================================
+
+# Seconds per grid cell, per cell and channel, and per element of a DM(nu) kernel
+# (nchan^2 for each distinct channel spacing), measured with one BLAS thread.
+# calibrate() rescales these for the current machine.
+COST_CELL = 2.0e-6
+COST_CHANNEL = 2.5e-7
+COST_KERNEL = 5.0e-8
+SPEED_FACTOR = 1.0
+
+# Seconds to start the pool of workers for each start method
+COST_STARTUP = {"fork":0.1,"spawn":2.0,"forkserver":1.0}
+
+# Minimum predicted work (s) per process for an additional process to be worthwhile
+MIN_PROCESS_TIME = 1.0
+
+# Channel counts below which the nchan x nchan solves do not gain from multithreaded BLAS
+BLAS_MIN_NCHAN = 256
+
+
+def get_cpu_count():
+    '''
+    Number of CPUs available to this process
+    '''
+    if hasattr(os,"sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def get_available_memory():
+    '''
+    Available physical memory (bytes), or None if unknown
+    '''
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES")*os.sysconf("SC_PAGE_SIZE")
+    except (ValueError,OSError,AttributeError):
+        return None
+
+
+def estimate_runtime(ncells,nchan,nshapes=0,full=True):
+    '''
+    Predicted single-process runtime (s) for ncells cells of nchan channels with nshapes
+    distinct channel spacings whose DM(nu) kernels need to be computed
+    '''
+    runtime = ncells*(COST_CELL + COST_CHANNEL*nchan)
+    if full:
+        runtime += nshapes*COST_KERNEL*nchan**2
+    return runtime*SPEED_FACTOR
+
+
+def choose_processes(runtime,nchan,ncpu="auto",process_memory=0,available_memory=None):
+    '''
+    Return the number of processes and of BLAS threads per process for a run with predicted
+    single-process runtime (s). With ncpu="auto", use as many processes as there is work for,
+    up to the number of CPUs and the available memory. BLAS threads only fill the remaining
+    CPUs when the matrices are large enough to gain from them.
+    '''
+    cpus = get_cpu_count()
+    if ncpu == "auto":
+        nprocs = int(min(max(runtime // MIN_PROCESS_TIME,1),cpus))
+        if available_memory is not None and process_memory > 0:
+            nprocs = int(max(min(nprocs,available_memory // process_memory),1))
+    else:
+        nprocs = int(ncpu)
+    if nchan >= BLAS_MIN_NCHAN:
+        threads = max(cpus // nprocs,1)
+    else:
+        threads = 1
+    return nprocs,threads
+
+
+def format_bytes(nbytes):
+    for unit in ["B","kB","MB","GB"]:
+        if nbytes < 1024.0:
+            return "%.1f %s"%(nbytes,unit)
+        nbytes /= 1024.0
+    return "%.1f TB"%nbytes
+
+
+def format_time(seconds):
+    if seconds < 120:
+        return "%.1f s"%seconds
+    if seconds < 7200:
+        return "%.1f min"%(seconds/60.0)
+    return "%.1f h"%(seconds/3600.0)
+
+
+class Plan:
+    '''
+    Predicted cost of a calc() run and the chosen parallelization, see FrequencyOptimizer.plan()
+
+    ncells: Number of cells to compute
+    nchan: Number of channels
+    nshapes: Number of distinct channel spacings (DM(nu) kernels)
+    nprocs: Number of processes
+    blas_threads: BLAS threads per process
+    runtime (s): Predicted runtime
+    memory (bytes): Predicted peak memory, summed over processes
+    '''
+    def __init__(self,ncells,nchan,nshapes,nprocs,blas_threads,runtime,memory):
+        self.ncells = ncells
+        self.nchan = nchan
+        self.nshapes = nshapes
+        self.nprocs = nprocs
+        self.blas_threads = blas_threads
+        self.runtime = runtime
+        self.memory = memory
+
+    def __str__(self):
+        return "%i cells x %i channels (%i DM(nu) kernels): %i process(es) x %i BLAS thread(s), predicted runtime %s, peak memory %s"%(
+            self.ncells,self.nchan,self.nshapes,self.nprocs,self.blas_threads,format_time(self.runtime),format_bytes(self.memory))
+
+
+def calibrate(freqopt,ncells=500):
+    '''
+    Time freqopt.calc_channels() on a sample of its grid cells (with and without cached DM(nu)
+    kernels) and rescale the cost model to this machine. Returns the new SPEED_FACTOR.
+    '''
+    global SPEED_FACTOR
+    import frequencyoptimizer
+    Cs,Bs,valid = freqopt.get_grid()
+    inds = np.nonzero(valid.ravel())[0]
+    inds = inds[np.linspace(0,len(inds)-1,min(ncells,len(inds))).astype(int)]
+    nus = freqopt.get_channels(Cs.ravel()[inds],Bs.ravel()[inds])
+    nshapes = len(np.unique(np.round(nus[:,-1]/nus[:,0],10)))
+
+    dmnu_cache,verbose,ncpu = freqopt.dmnu_cache,freqopt.verbose,freqopt.ncpu
+    freqopt.dmnu_cache = frequencyoptimizer.DMnuKernelCache()
+    freqopt.verbose,freqopt.ncpu = False,1
+    try:
+        start = time.time()
+        freqopt.calc_channels(nus)
+        elapsed = time.time() - start
+    finally:
+        freqopt.dmnu_cache,freqopt.verbose,freqopt.ncpu = dmnu_cache,verbose,ncpu
+
+    SPEED_FACTOR = 1.0
+    SPEED_FACTOR = elapsed/estimate_runtime(len(nus),freqopt.nchan,nshapes,freqopt.full)
+    return SPEED_FACTOR
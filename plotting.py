@@ -0,0 +1,215 @@
+import numpy as np
+from matplotlib.pyplot import *
+from matplotlib import cm,rc
+from matplotlib.ticker import FuncFormatter, MultipleLocator
+import matplotlib.patches as patches
+from frequencyoptimizer import LEVELS,COLORS,LWS,grid_extrema
+
+
+
+rc('text',usetex=True)
+rc('font',**{'family':'serif','serif':['Times New Roman'],'size':14})#,'weight':'bold'})
+rc('xtick',**{'labelsize':16})
+rc('ytick',**{'labelsize':16})
+rc('axes',**{'labelsize':18,'titlesize':18})
+
+
+def nolog(x,pos):
+    return "$\hfill %0.1f$" % (10**x)
+noformatter = FuncFormatter(nolog)
+def nolog2(x,pos):
+    return "$\hfill %0.2f$" % (10**x)
+noformatter2 = FuncFormatter(nolog2)
+
+def log(x,pos):
+    y = x#np.log10(x)
+    #if y == 2:
+    #    return "$\hfill 100$" #added
+    if y == 1:
+        return "$\hfill 10$"
+    elif y == 0:
+        return "$\hfill 1$"
+    elif y == -1:
+        return "$\hfill 0.1$"
+    elif y == -2:
+        return "$\hfill 0.01$"
+    return "$\hfill 10^{%i}$" % x#np.log10(x) 
+
+formatter = FuncFormatter(log)
+
+
+
+def log100(x,pos):
+    y = x#np.log10(x)
+    if y == 2:
+        return "$\hfill 100$" #added
+    elif y == 1:
+        return "$\hfill 10$"
+    elif y == 0:
+        return "$\hfill 1$"
+    elif y == -1:
+        return "$\hfill 0.1$"
+    elif y == -2:
+        return "$\hfill 0.01$"
+    return "$\hfill 10^{%i}$" % x#np.log10(x) 
+
+formatter100 = FuncFormatter(log100)
+
+# Copied from utilities.py
+def uimshow(x,ax=None,origin='lower',interpolation='nearest',aspect='auto',**kwargs):
+    if ax is not None:
+        im=ax.imshow(x,origin=origin,interpolation=interpolation,aspect=aspect,**kwargs)
+    else:
+        im=imshow(x,origin=origin,interpolation=interpolation,aspect=aspect,**kwargs) # plt.
+    return im
+
+
+
+### ==================================================
+### Plots of FrequencyOptimizer grids
+### ==================================================
+
+def plot(freqopt,filename="triplot.png",doshow=True,figsize=(8,6),save=True,minimum=None,points=None,colorbararrow=None):
+    '''
+    Create the triangle plots as in the optimal frequencies paper, see FrequencyOptimizer.plot()
+    '''
+    fig = figure(figsize=figsize)
+    ax = fig.add_subplot(111)
+    if freqopt.frac_bw == False:
+        data = np.transpose(np.log10(freqopt.sigmas))
+        if freqopt.log == False:
+            im = uimshow(data,extent=[freqopt.Cs[0],freqopt.Cs[-1],freqopt.Bs[0],freqopt.Bs[-1]],cmap=cm.inferno_r,ax=ax)
+
+            ax.set_xlabel(r"$\mathrm{Center~Frequency~\nu_0~(GHz)}$")
+            ax.set_ylabel(r"$\mathrm{Bandwidth}~B~\mathrm{(GHz)}$")
+        else:
+
+            im = uimshow(data,extent=np.log10(np.array([freqopt.Cs[0],freqopt.Cs[-1],freqopt.Bs[0],freqopt.Bs[-1]])),cmap=cm.inferno_r,ax=ax)
+            cax = ax.contour(data,extent=np.log10(np.array([freqopt.Cs[0],freqopt.Cs[-1],freqopt.Bs[0],freqopt.Bs[-1]])),colors=freqopt.colors,levels=freqopt.levels,linewidths=freqopt.lws,origin='lower')
+
+            #https://stackoverflow.com/questions/18390068/hatch-a-nan-region-in-a-contourplot-in-matplotlib
+            # get data you will need to create a "background patch" to your plot
+            xmin, xmax = ax.get_xlim()
+            ymin, ymax = ax.get_ylim()
+            xy = (xmin,ymin)
+            width = xmax - xmin
+            height = ymax - ymin
+            # create the patch and place it in the back of countourf (zorder!)
+            p = patches.Rectangle(xy, width, height, hatch='X', color='0.5', fill=None, zorder=-10)
+            ax.add_patch(p)
+
+
+            ax.set_xlabel(r"$\mathrm{Center~Frequency~\nu_0~(GHz)}$")
+            ax.set_ylabel(r"$\mathrm{Bandwidth}~B~\mathrm{(GHz)}$")
+            ax.xaxis.set_major_locator(MultipleLocator(0.5))
+            ax.yaxis.set_major_locator(MultipleLocator(0.5))
+            ax.xaxis.set_major_formatter(noformatter)
+            ax.yaxis.set_major_formatter(noformatter)
+
+            ax.text(0.05,0.9,"PSR~%s"%freqopt.psrnoise.name.replace("-","$-$"),fontsize=18,transform=ax.transAxes,bbox=dict(boxstyle="square",fc="white"))
+
+        if minimum is not None:
+            MIN,MAX,(INDC,INDB) = grid_extrema(freqopt.sigmas)
+            MIN = np.log10(MIN)
+            MINB = freqopt.Bs[INDB]
+            MINC = freqopt.Cs[INDC]
+            cax = ax.contour(data,extent=np.log10(np.array([freqopt.Cs[0],freqopt.Cs[-1],freqopt.Bs[0],freqopt.Bs[-1]])),colors=['b','b'],levels=[np.log10(1.1*(10**MIN)),np.log10(1.5*(10**MIN))],linewidths=[1,1],linestyles=['--','--'],origin='lower')
+            print("Minimum",MINC,MINB,MIN)
+            with open("minima.txt",'a') as FILE:
+                FILE.write("%s minima %f %f %f\n"%(freqopt.psrnoise.name,MINC,MINB,MIN))
+            if freqopt.log:
+                ax.plot(np.log10(MINC),np.log10(MINB),minimum,zorder=50,ms=10)
+            else:
+                ax.plot(MINC,MINB,minimum,zorder=50,ms=10)
+
+        if points is not None:
+            if type(points) == tuple:
+                points = [points]
+            for point in points:
+                x,y,fmt = point
+                nulow = x - y/2.0
+                nuhigh = x + y/2.0
+
+                if freqopt.log:
+                    ax.plot(np.log10(x),np.log10(y),fmt,zorder=50,ms=8)
+                    nus = np.logspace(np.log10(nulow),np.log10(nuhigh),freqopt.nchan+1)[:-1] 
+                    sigma = np.log10(freqopt.calc_single(nus))
+                else:
+                    ax.plot(x,y,fmt,zorder=50,ms=8)
+                    nus = np.linspace(nulow,nuhigh,freqopt.nchan+1)[:-1] #more uniform sampling?
+                    sigma = np.log10(freqopt.calc_single(nus))
+                with open("minima.txt",'a') as FILE:
+                    FILE.write("%s point %f %f %f\n"%(freqopt.psrnoise.name,x,y,sigma))
+
+
+
+
+        if colorbararrow is not None:
+            MIN,MAX,INDMIN = grid_extrema(freqopt.sigmas)
+            MIN,MAX = np.log10(MIN),np.log10(MAX)
+            if freqopt.log == True:
+                x = np.log10(freqopt.Cs[-1]*1.05)#freqopt.Bs[-1])
+                dx = np.log10(1.2)#np.log10(freqopt.Cs[-1])#freqopt.Bs[-1]*2)
+                frac = (np.log10(colorbararrow)-MIN)/(MAX-MIN)
+                y = frac*(np.log10(freqopt.Bs[-1]) - np.log10(freqopt.Bs[0])) + np.log10(freqopt.Bs[0])
+                arrow(x,y,dx,0.0,fc='k',ec='k',zorder=50,clip_on=False)
+
+
+
+
+    else:
+        if freqopt.log == False:
+            pass
+        else:
+            goodinds = []
+            for indf,F in enumerate(freqopt.Fs):
+                if np.any(np.isnan(freqopt.sigmas[:,indf])):
+                    continue
+                goodinds.append(indf)
+            goodinds = np.array(goodinds)
+            data = np.transpose(np.log10(freqopt.sigmas[:,goodinds]))
+
+            im = uimshow(data,extent=np.log10(np.array([freqopt.Cs[0],freqopt.Cs[-1],freqopt.Fs[goodinds][0],freqopt.Fs[goodinds][-1]])),cmap=cm.inferno_r,ax=ax)
+            cax = ax.contour(data,extent=np.log10(np.array([freqopt.Cs[0],freqopt.Cs[-1],freqopt.Fs[goodinds][0],freqopt.Fs[goodinds][-1]])),colors=COLORS,levels=LEVELS,linewidths=LWS,origin='lower')
+
+            #im = uimshow(data,extent=np.array([np.log10(freqopt.Cs[0]),np.log10(freqopt.Cs[-1]),freqopt.Fs[goodinds][0],freqopt.Fs[goodinds][-1]]),cmap=cm.inferno_r,ax=ax)
+            #cax = ax.contour(data,extent=np.array([np.log10(freqopt.Cs[0]),np.log10(freqopt.Cs[-1]),freqopt.Fs[goodinds][0],freqopt.Fs[goodinds][-1]]),colors=COLORS,levels=LEVELS,linewidths=LWS,origin='lower')
+
+
+            
+            print(freqopt.Fs)
+            ax.set_xlabel(r"$\mathrm{Center~Frequency~\nu_0~(GHz)}$")
+            #ax.set_ylabel(r"$r~\mathrm{(\nu_{max}/\nu_{min})}$")
+            ax.set_ylabel(r"$\mathrm{Fractional~Bandwidth~(B/\nu_0)}$")
+            # no log
+            #ax.yaxis.set_major_locator(FixedLocator(np.log10(np.arange(0.25,1.75,0.25))))
+            
+            ax.xaxis.set_major_formatter(noformatter)
+            #ax.yaxis.set_major_formatter(noformatter)
+        
+        
+    cbar = fig.colorbar(im)#,format=formatter)
+    cbar.set_label("$\mathrm{TOA~Uncertainty~\sigma_{TOA}~(\mu s)}$")
+
+    # https://stackoverflow.com/questions/6485000/python-matplotlib-colorbar-setting-tick-formator-locator-changes-tick-labels
+    cbar.locator = MultipleLocator(1)
+    cbar.formatter = formatter
+    '''
+    MAX = np.max(data[np.where(np.logical_not(np.isnan(data)))])
+    if MAX <= np.log10(700):
+        cbar.formatter = formatter100
+    else:
+        cbar.formatter = formatter
+    '''
+    cbar.update_ticks()
+    #if freqopt.log:
+    #    cb = colorbar(cax)
+
+
+
+    if save:
+        savefig(filename)
+    if doshow:
+        show()
+    else:
+        close()
@@ -1,16 +1,13 @@
 import numpy as np
-import psr_utils as pu
-import matplotlib.pyplot as plt
 import pyslalib.slalib as slalib
 from argparse import ArgumentParser
-from frequencyoptimizer import PulsarNoise,TelescopeNoise,GalacticNoise
-from frequencyoptimizer import FrequencyOptimizer
+from frequencyoptimizer import GalacticNoise
+from frequencyoptimizer import FrequencyOptimizer,PulsarNoiseBatch
+import catalog
 
 NCHAN = 16
 NSTEPS = 16
 
-Tcmb = 3.0
-
 usage = """%(prog)s [options]
 
 Receiver/telescope parameters can be specified via a text file using
@@ -64,9 +61,30 @@ rx_group.add_argument("-e", "--epsilon", type=float, default=0.01,
                       help="Fractional gain instability (default=%(default)s)")
 parser.add_argument("-t", "--tobs", type=float, default=1800.0, 
                     help="Observing time (s; default=%(default)s)")
+parser.add_argument("--array", action="store_true",
+                    help=("Find the band (center frequency, bandwidth) shared by "
+                          "all pulsars that is optimal for the array as a whole, "
+                          "for several array-level objectives"))
+parser.add_argument("--target", type=float, default=1.0,
+                    help=("Target sigma of the fraction-of-pulsars objective "
+                          "and of the observing times needed with --allocate "
+                          "(us; default=%(default)s)"))
+parser.add_argument("--allocate", type=float,
+                    help=("Split this total observing time (s) across the "
+                          "pulsars to optimize --objective"))
+parser.add_argument("--objective", default="mean",
+                    choices=["mean","median","fraction","inverse_variance"],
+                    help="Array-level objective of --allocate (default=%(default)s)")
+parser.add_argument("--telescopes",
+                    help=("Table of telescope configurations (see "
+                          "catalog.read_telescopes()) to compare in the band "
+                          "given by -r or -L/-H"))
+parser.add_argument("--cube",
+                    help="File to memory-map the (pulsar,C,B) sigma cube to (--array)")
 
 pulsar_group.add_argument("-d", "--psr-dict", 
-                          help="Python dictionary containing pulsar parameters")
+                          help=("Pulsar catalog: python dictionary (e.g., psr_info.py), "
+                                "table (psr_info.txt), or spreadsheet (psr_info.ods)"))
 
 pulsar_group.add_argument("-n", "--name", default="Fake",
                           help="Pulsar name (default=%(default)s)")
@@ -103,29 +121,13 @@ pulsar_group.add_argument("-i", "--diss-ts", type=float, default=1000.0,
                                 "default=%(default)s"))
 args = parser.parse_args()
 
-if args.rx_specs is not None:
-    interpolate = True
-    rx_freq,Trx,gain,epsilon = np.loadtxt(args.rx_specs,unpack=True)
-    low_freq = np.min(rx_freq)
-    high_freq = np.max(rx_freq)
-    freqs = np.logspace(np.log10(low_freq),np.log10(high_freq),NCHAN)
-else:
-    interpolate = False
-    Trx = args.Trx
-    gain = args.gain
-    epsilon = args.epsilon
-    low_freq = args.low_freq
-    high_freq = args.high_freq
-    freqs = np.logspace(np.log10(low_freq),np.log10(high_freq),NCHAN)
-    rx_freq = freqs.copy()
+telescope_noise,low_freq,high_freq = catalog.make_telescope_noise(
+    args.rx_specs,gain=args.gain,Trx=args.Trx,epsilon=args.epsilon,tobs=args.tobs,
+    low_freq=args.low_freq,high_freq=args.high_freq)
+freqs = np.logspace(np.log10(low_freq),np.log10(high_freq),NCHAN)
 
 if args.psr_dict is not None:
-    import importlib
-    psr_dict = importlib.import_module(args.psr_dict.rstrip(".py"))
-    for a in dir(psr_dict):
-        if not a.startswith("__"):
-            psrs = psr_dict.__getattribute__(a)
-            break
+    psrs = catalog.load_catalog(args.psr_dict)
 else:
     psrs = {args.name: {
         "name": args.name,
@@ -140,31 +142,51 @@ else:
         "scat_ts": args.scat_ts,
         "scat_ts_var": args.scat_ts_var,
         "diss_ts": args.diss_ts }}
-sigmas = []
-telescope_noise = TelescopeNoise(gain=gain,T_const=Trx+Tcmb,epsilon=epsilon,
-                                 T=args.tobs,rx_nu=rx_freq,
-                                 interpolate=interpolate)
+pulsar_noises = []
 galactic_noise = GalacticNoise()
 for name,psr in psrs.items():
-    if psr["W50"] is None and psr["Weff"] is not None: 
-        psr["W50"] = 0.66*psr["Weff"]
-    if psr["scat_ts"] is None and psr["DM"] is not None:
-        psr["scat_ts"] = 1000*pu.pulse_broadening(psr["DM"],1000.0)
-    if None not in psr.values():
-        pulsar_noise = PulsarNoise(
-            name,alpha=-psr["spec_index"],I_0=psr["flux_1GHz"],DM=psr["DM"],
-            taud=psr["scat_ts"]*1.5**4.4,tauvar=psr["scat_ts_var"]*1.5**4.4*0.5,
-            dtd=psr["diss_ts"],P=psr["period"],Uscale=psr["uscale"],
-            sigma_Js=np.zeros(NCHAN)+psr["rms_J1"] / \
-            np.sqrt(1000*args.tobs/psr["period"]),
-            Weffs=np.zeros(NCHAN)+psr["Weff"],W50s=np.zeros(NCHAN)+psr["W50"])
-        frequency_optimizer = FrequencyOptimizer(
-            pulsar_noise,galactic_noise,telescope_noise,
-            numin=low_freq,numax=high_freq,nchan=NCHAN,log=True,nsteps=NSTEPS,
-            frac_bw=False,full_bandwidth=False,masks=None)
-        sigma = frequency_optimizer.calc_single(freqs)
-        sigmas.append(sigma)
+    pulsar_noise = catalog.make_pulsar_noise(name,psr,args.tobs,NCHAN)
+    if pulsar_noise is not None:
+        pulsar_noises.append(pulsar_noise)
+
+# All pulsars at once
+pulsar_noise_batch = PulsarNoiseBatch(pulsar_noises)
+frequency_optimizer = FrequencyOptimizer(
+    pulsar_noise_batch,galactic_noise,telescope_noise,
+    numin=low_freq,numax=high_freq,nchan=NCHAN,log=True,nsteps=NSTEPS,
+    frac_bw=False,full_bandwidth=False,masks=None)
+if args.array:
+    import objectives
+    frequency_optimizer.verbose = False
+    frequency_optimizer.calc_cube(args.cube)
+    report = frequency_optimizer.compare_objectives(target=args.target)
+    print(objectives.format_comparison(report))
+    best_C,best_B = report["mean"]["C"],report["mean"]["B"]
+    freqs = np.logspace(np.log10(best_C-best_B/2.0),np.log10(best_C+best_B/2.0),NCHAN)
+    print("")
+    print("Per-pulsar sigma in the band optimizing the mean:")
+sigmas = frequency_optimizer.calc_pulsars(freqs)
+if args.allocate is None:
+    for name,sigma in zip(pulsar_noise_batch.names,sigmas):
         print("%-10s   %.3f"%(name,sigma))
+else:
+    time_scaling = frequency_optimizer.get_time_scaling(freqs)
+    times_needed = time_scaling.time_for_target(args.target)
+    times,allocated_sigmas = time_scaling.allocate(args.allocate,args.objective,
+                                                   target=args.target)
+    print("%-10s   %8s %14s %14s %10s"%("PSR","sigma","T_target(s)","T_alloc(s)","sigma_alloc"))
+    for name,sigma,T_needed,T,allocated_sigma in zip(
+            pulsar_noise_batch.names,sigmas,times_needed,times,allocated_sigmas):
+        print("%-10s   %8.3f %14.1f %14.1f %10.3f"%(name,sigma,T_needed,T,allocated_sigma))
+
+if args.telescopes is not None:
+    config_names,telescope_noises = catalog.read_telescopes(args.telescopes,tobs=args.tobs)
+    config_sigmas = frequency_optimizer.calc_sweep(telescope_noises,freqs)
+    print("")
+    print("%-16s %10s %10s"%("Configuration","Mean","Median"))
+    for config_name,sigmas_config in zip(config_names,config_sigmas):
+        print("%-16s %10.3f %10.3f"%(config_name,np.mean(sigmas_config),np.median(sigmas_config)))
+    print("")
 
 sigma_mean = np.mean(sigmas)
 sigma_median = np.median(sigmas)
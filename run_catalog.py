@@ -0,0 +1,98 @@
+from argparse import ArgumentParser
+import catalog
+
+usage = """%(prog)s [options]
+
+Run the full frequency optimization grid (FrequencyOptimizer.calc)
+for every pulsar in a catalog, given as a python dictionary (see
+psr_info.py), a whitespace-delimited table (see psr_info.txt), or a
+spreadsheet (psr_info.ods); see predict_toas.py for the pulsar
+parameters.
+
+Receiver/telescope parameters are specified as in predict_toas.py,
+either via a text file (-r/--rx-specs) with columns
+
+Frequency(GHz) Trx(K) Gain(K/Jy) FractionalGainError
+
+or with frequency-independent values from command line arguments.
+
+For each pulsar, the grid is written to OUTDIR/<name>.npz and its
+optimum center frequency, bandwidth, and sigma_TOA are appended to
+OUTDIR/summary.txt as soon as the pulsar finishes.  With -j/--ncpu,
+blocks of grid rows of all pulsars are spread over a pool of
+processes.
+
+To spread the catalog over independent batch jobs, run the same
+command with --nshards N and --shard I for I = 0 ... N-1; each job
+writes OUTDIR/shard_I_of_N.npz.  Running it once more with --nshards N
+and --merge writes the same outputs as a single run."""
+
+parser = ArgumentParser(description="Optimize frequencies for a pulsar catalog", usage=usage)
+rx_group = parser.add_argument_group(title="Receiver specs")
+grid_group = parser.add_argument_group(title="Grid parameters")
+rx_group.add_argument("-r", "--rx-specs",
+                      help="File containing receiver performance specs")
+rx_group.add_argument("-L", "--low-freq", type=float, default=1.0,
+                      help="Low frequency (GHz; default=%(default)s)")
+rx_group.add_argument("-H", "--high-freq", type=float, default=2.0,
+                      help="High frequency (GHz; default=%(default)s)")
+rx_group.add_argument("-T", "--trx", dest="Trx", type=float, default=20,
+                      help="Receiver temperature (K; default=%(default)s)")
+rx_group.add_argument("-G", "--gain", type=float, default=2.0,
+                      help="Telescope gain (K/Jy; default=%(default)s)")
+rx_group.add_argument("-e", "--epsilon", type=float, default=0.01,
+                      help="Fractional gain instability (default=%(default)s)")
+parser.add_argument("-t", "--tobs", type=float, default=1800.0,
+                    help="Observing time (s; default=%(default)s)")
+parser.add_argument("-d", "--psr-dict", default="psr_info.py",
+                    help="Pulsar catalog, .py, table, or .ods (default=%(default)s)")
+parser.add_argument("-o", "--outdir", default="catalog_output",
+                    help="Output directory (default=%(default)s)")
+parser.add_argument("-j", "--ncpu", type=int, default=1,
+                    help="Number of processes (default=%(default)s)")
+parser.add_argument("-p", "--plot", action="store_true",
+                    help="Also plot each grid to OUTDIR/<name>.png")
+grid_group.add_argument("--numin", type=float,
+                        help="Lowest frequency of the grid (GHz; default=lowest receiver frequency)")
+grid_group.add_argument("--numax", type=float,
+                        help="Highest frequency of the grid (GHz; default=highest receiver frequency)")
+grid_group.add_argument("--nchan", type=int, default=catalog.NCHAN,
+                        help="Number of channels (default=%(default)s)")
+grid_group.add_argument("--nsteps", type=int, default=catalog.NSTEPS,
+                        help="Grid steps per decade (default=%(default)s)")
+grid_group.add_argument("--r", type=float,
+                        help="Maximum ratio of highest to lowest frequency")
+parser.add_argument("--nshards", type=int,
+                    help="Number of shards to split the catalog grids into")
+parser.add_argument("--shard", type=int,
+                    help="Compute only this shard (0 ... NSHARDS-1)")
+parser.add_argument("--merge", action="store_true",
+                    help="Merge the NSHARDS shards in OUTDIR")
+if __name__ == "__main__": # spawned workers import this module
+    args = parser.parse_args()
+
+    telescope_noise,low_freq,high_freq = catalog.make_telescope_noise(
+        args.rx_specs,gain=args.gain,Trx=args.Trx,epsilon=args.epsilon,
+        tobs=args.tobs,low_freq=args.low_freq,high_freq=args.high_freq)
+    numin = low_freq if args.numin is None else args.numin
+    numax = high_freq if args.numax is None else args.numax
+
+    psrs = catalog.load_catalog(args.psr_dict)
+    if args.shard is not None:
+        if args.nshards is None:
+            parser.error("--shard requires --nshards")
+        catalog.run_catalog_shard(psrs,telescope_noise,args.outdir,numin,numax,
+                                  args.shard,args.nshards,tobs=args.tobs,nchan=args.nchan,
+                                  nsteps=args.nsteps,r=args.r)
+    elif args.merge:
+        if args.nshards is None:
+            parser.error("--merge requires --nshards")
+        freqopts = catalog.merge_catalog_shards(psrs,telescope_noise,args.outdir,numin,numax,
+                                                args.nshards,tobs=args.tobs,nchan=args.nchan,
+                                                nsteps=args.nsteps,plot=args.plot,r=args.r)
+        print("Merged %i pulsars, summary in %s/summary.txt"%(len(freqopts),args.outdir))
+    else:
+        freqopts = catalog.run_catalog(psrs,telescope_noise,args.outdir,numin,numax,
+                                       tobs=args.tobs,nchan=args.nchan,nsteps=args.nsteps,
+                                       ncpu=args.ncpu,plot=args.plot,r=args.r)
+        print("Finished %i pulsars, summary in %s/summary.txt"%(len(freqopts),args.outdir))
@@ -0,0 +1,131 @@
+import numpy as np
+import os
+import cache
+
+
+### ==================================================
+### Sharded grid runs
+### ==================================================
+
+def split_weights(weights,nshards):
+    '''
+    Split a sequence of work units with the given weights into nshards contiguous
+    (start,stop) ranges of about equal total weight; some ranges may be empty
+    '''
+    cumulative = np.concatenate(([0.0],np.cumsum(weights,dtype=float)))
+    bounds = np.searchsorted(cumulative,cumulative[-1]*np.arange(nshards+1)/float(nshards),side='left')
+    bounds[0],bounds[-1] = 0,len(weights)
+    return [(int(bounds[i]),int(bounds[i+1])) for i in range(nshards)]
+
+
+def get_units(freqopts):
+    '''
+    Return the work units, (name,row) for every row of the grid of every FrequencyOptimizer in the
+    dictionary freqopts, and their weights (number of valid cells, plus one for the per-row overhead)
+    '''
+    units = []
+    weights = []
+    for name,freqopt in freqopts.items():
+        valid = freqopt.get_grid()[2]
+        units.extend([(name,row) for row in range(len(valid))])
+        weights.extend(np.sum(valid,axis=1)+1)
+    return units,weights
+
+
+def get_shard(freqopts,index,nshards):
+    '''
+    Return the rows of each grid that belong to shard index (0 <= index < nshards), as a list of
+    (name,start,stop). The split only depends on the grids, so independent jobs agree on it.
+    '''
+    if not 0 <= index < nshards:
+        raise ValueError("Shard index %i out of range for %i shards"%(index,nshards))
+    units,weights = get_units(freqopts)
+    start,stop = split_weights(weights,nshards)[index]
+    pieces = []
+    for name,row in units[start:stop]:
+        if len(pieces) > 0 and pieces[-1][0] == name and pieces[-1][2] == row:
+            pieces[-1][2] = row+1
+        else:
+            pieces.append([name,row,row+1])
+    return [tuple(piece) for piece in pieces]
+
+
+def calc_shard(freqopts,index,nshards,filename):
+    '''
+    Compute shard index of nshards of the grids of the FrequencyOptimizers in the dictionary freqopts
+    (keyed by name) and write it to filename. The file describes itself: it holds the run key and grid
+    of each FrequencyOptimizer it covers, so that merge_shards() needs nothing else.
+    '''
+    pieces = get_shard(freqopts,index,nshards)
+    arrays = dict(index=index,nshards=nshards,names=np.array(list(freqopts.keys())),npieces=len(pieces))
+    for i,(name,start,stop) in enumerate(pieces):
+        freqopt = freqopts[name]
+        sigmas,valid = freqopt.calc_rows(slice(start,stop))
+        arrays["piece_%i"%i] = np.array([name,str(start),str(stop)])
+        arrays["sigmas_%i"%i] = sigmas
+        arrays["exact_%i"%i] = valid
+    for j,(name,freqopt) in enumerate(freqopts.items()):
+        arrays["key_%i"%j] = np.array(freqopt.get_run_key())
+        arrays["Cs_%i"%j] = freqopt.Cs
+        if freqopt.frac_bw == False:
+            arrays["Bs_%i"%j] = freqopt.Bs
+        else:
+            arrays["Fs_%i"%j] = freqopt.Fs
+    cache.atomic_savez(filename,**arrays)
+    return pieces
+
+
+def merge_shards(filenames):
+    '''
+    Merge the files written by calc_shard() for all shards of a run. Returns a dictionary keyed by name
+    of dictionaries with Cs, Bs (or Fs), sigmas, and exact, as written by FrequencyOptimizer.save().
+    Raises ValueError if the files belong to different runs or shards are missing.
+    '''
+    results = dict()
+    keys = dict()
+    found = set()
+    nshards = None
+    for filename in filenames:
+        with np.load(filename) as data:
+            if nshards is None:
+                nshards = int(data['nshards'])
+            elif int(data['nshards']) != nshards:
+                raise ValueError("%s is a shard of %i, not %i"%(filename,int(data['nshards']),nshards))
+            index = int(data['index'])
+            if index in found:
+                raise ValueError("Shard %i appears more than once"%index)
+            found.add(index)
+
+            for j,name in enumerate(data['names'].tolist()):
+                key = str(data['key_%i'%j])
+                if keys.setdefault(name,key) != key:
+                    raise ValueError("%s belongs to a different run for %s"%(filename,name))
+                if name not in results:
+                    result = dict(Cs=data['Cs_%i'%j])
+                    if 'Bs_%i'%j in data.files:
+                        result['Bs'] = data['Bs_%i'%j]
+                        ncols = len(result['Bs'])
+                    else:
+                        result['Fs'] = data['Fs_%i'%j]
+                        ncols = len(result['Fs'])
+                    shape = (len(result['Cs']),ncols)
+                    result['sigmas'] = np.zeros(shape) + np.nan
+                    result['exact'] = np.zeros(shape,dtype=bool)
+                    results[name] = result
+
+            for i in range(int(data['npieces'])):
+                name,start,stop = data['piece_%i'%i].tolist()
+                rows = slice(int(start),int(stop))
+                results[name]['sigmas'][rows] = data['sigmas_%i'%i]
+                results[name]['exact'][rows] = data['exact_%i'%i]
+
+    if nshards is None:
+        raise ValueError("No shards to merge")
+    missing = sorted(set(range(nshards)) - found)
+    if len(missing) > 0:
+        raise ValueError("Missing shards: %s"%", ".join(map(str,missing)))
+    return results
+
+
+def get_filename(directory,index,nshards):
+    return os.path.join(directory,"shard_%04i_of_%04i.npz"%(index,nshards))
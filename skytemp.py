@@ -0,0 +1,80 @@
+import numpy as np
+import os
+
+
+### ==================================================
+### Galactic sky temperature
+### ==================================================
+
+# Haslam et al. 408 MHz map as used by psr_tsky() in tsky/tsky.f: 90 bins of 4 deg in
+# Galactic longitude by 180 bins of 1 deg in latitude, in K
+TSKY_FILE = "tsky.dat"
+SPECTRAL_INDEX = -2.6
+
+SKY_MAP = None
+T408_CACHE = dict()
+
+
+def load_map(filename=None):
+    '''
+    Return the 90x180 sky temperature map at 408 MHz, read once from a text file in the format of
+    tsky.dat (16f5.1) or, for a .npy file, memory-mapped. Like the Fortran code, tsky.dat is looked
+    for in the current directory first, then next to this module.
+    '''
+    global SKY_MAP
+    if filename is None:
+        if SKY_MAP is not None:
+            return SKY_MAP
+        filename = TSKY_FILE
+        if not os.path.exists(filename):
+            filename = os.path.join(os.path.dirname(os.path.abspath(__file__)),TSKY_FILE)
+    if filename.endswith(".npy"):
+        sky_map = np.load(filename,mmap_mode='r')
+    else:
+        with open(filename,"r") as FILE:
+            lines = [line.rstrip("\n") for line in FILE]
+        # fixed-width fields of 5 characters, values may run into each other
+        values = [float(line[k:k+5]) for line in lines for k in range(0,len(line),5) if line[k:k+5].strip() != ""]
+        sky_map = np.array(values[:90*180],dtype=np.float32).reshape((90,180)) # single precision, as in the Fortran
+    if np.shape(sky_map) != (90,180):
+        raise ValueError("%s does not contain a 90x180 sky map"%filename)
+    SKY_MAP = sky_map
+    T408_CACHE.clear()
+    return SKY_MAP
+
+
+def get_pixels(l,b):
+    '''
+    Map indices of Galactic longitudes and latitudes (deg), following psr_tsky()
+    '''
+    l = np.mod(np.asarray(l,dtype=float),360.0)
+    b = np.asarray(b,dtype=float)
+    j = np.minimum(np.trunc(b+91.5).astype(int),180) - 1
+    nl = np.where(l < 0.5,359,np.trunc(l-0.5).astype(int))
+    i = nl // 4
+    return i,j
+
+
+def tsky408(l,b):
+    '''
+    Sky temperature (K) at 408 MHz at Galactic longitudes and latitudes l,b (deg), any broadcastable
+    shapes. Values for single positions are cached.
+    '''
+    if np.ndim(l) == 0 and np.ndim(b) == 0:
+        key = (float(l),float(b))
+        if key not in T408_CACHE:
+            i,j = get_pixels(l,b)
+            T408_CACHE[key] = float(load_map()[i,j])
+        return T408_CACHE[key]
+    i,j = get_pixels(l,b)
+    return np.asarray(load_map(),dtype=float)[i,j]
+
+
+def tsky(l,b,freq):
+    '''
+    Sky temperature (K) at Galactic longitudes and latitudes l,b (deg) and frequencies freq (MHz),
+    scaled from 408 MHz with a spectral index of -2.6. Vectorized replacement for tsky.psr_tsky();
+    all arguments broadcast against each other, e.g., one position and a grid of frequencies, or
+    arrays of positions of a catalog with freq[:,np.newaxis].
+    '''
+    return tsky408(l,b)*np.power(np.asarray(freq,dtype=float)/408.0,SPECTRAL_INDEX)
@@ -0,0 +1,144 @@
+import numpy as np
+import os
+import pytest
+import cache
+import frequencyoptimizer
+from frequencyoptimizer import TelescopeNoise
+
+
+def count_cells(freqopt):
+    '''
+    Record the number of cells that freqopt actually computes
+    '''
+    counts = []
+    calc_channels = freqopt.calc_channels
+    def counted(nus):
+        counts.append(len(nus))
+        return calc_channels(nus)
+    freqopt.calc_channels = counted
+    return counts
+
+
+### ==================================================
+### CellStore
+### ==================================================
+
+def test_cell_store_reuse(optimizer,tmp_path):
+    store = cache.CellStore(str(tmp_path))
+    first = optimizer(numax=10.0,cell_store=store)
+    first.calc()
+    wider = optimizer(numax=100.0,cell_store=store)
+    counts = count_cells(wider)
+    wider.calc()
+    nvalid = np.sum(np.isfinite(wider.sigmas))
+    assert sum(counts) == nvalid - np.sum(np.isfinite(first.sigmas)) # the old cells are all reused
+
+    reference = optimizer(numax=100.0)
+    reference.calc()
+    assert np.allclose(wider.sigmas,reference.sigmas,equal_nan=True,rtol=1e-12)
+
+    # from disk, in a new store
+    again = optimizer(numax=100.0,cell_store=cache.CellStore(str(tmp_path)))
+    counts = count_cells(again)
+    again.calc()
+    assert sum(counts) == 0
+    assert np.allclose(again.sigmas,reference.sigmas,equal_nan=True,rtol=1e-12)
+
+
+def test_cell_store_invalidation(optimizer,monkeypatch):
+    store = cache.CellStore()
+    optimizer(cell_store=store).calc()
+
+    other = optimizer(cell_store=store,telnoise=TelescopeNoise(gain=2.0,T_const=40))
+    counts = count_cells(other)
+    other.calc()
+    assert sum(counts) == np.sum(np.isfinite(other.sigmas))
+
+    monkeypatch.setattr(frequencyoptimizer,"get_version",lambda: "another version")
+    changed = optimizer(cell_store=store)
+    counts = count_cells(changed)
+    changed.calc()
+    assert sum(counts) == np.sum(np.isfinite(changed.sigmas))
+
+
+def test_cell_store_shards(tmp_path):
+    store = cache.CellStore(str(tmp_path),max_shards=2)
+    nus = np.arange(12.0).reshape(4,3) + 1
+    for i in range(4):
+        store.store("key",nus[i:i+1],[float(i)])
+    assert len(os.listdir(str(tmp_path))) == 4 # one file per call
+
+    loaded = cache.CellStore(str(tmp_path),max_shards=2)
+    sigmas,found = loaded.lookup("key",nus)
+    assert np.all(found) and np.array_equal(sigmas,np.arange(4.0))
+    assert len(os.listdir(str(tmp_path))) == 1 # merged on load
+    sigmas,found = cache.CellStore(str(tmp_path)).lookup("key",nus)
+    assert np.all(found) and np.array_equal(sigmas,np.arange(4.0))
+
+
+### ==================================================
+### RunCache
+### ==================================================
+
+def test_run_cache_reuse(optimizer,tmp_path):
+    run_cache = cache.RunCache(str(tmp_path))
+    first = optimizer(run_cache=run_cache)
+    first.calc()
+    assert len(run_cache.get_entries()) == 1
+
+    second = optimizer(run_cache=run_cache)
+    counts = count_cells(second)
+    second.calc()
+    assert sum(counts) == 0
+    assert np.array_equal(second.sigmas,first.sigmas,equal_nan=True)
+    assert np.array_equal(second.exact,first.exact)
+
+
+def test_run_cache_invalidation(optimizer,tmp_path,monkeypatch):
+    run_cache = cache.RunCache(str(tmp_path))
+    optimizer(run_cache=run_cache).calc()
+    for freqopt in [optimizer(run_cache=run_cache,nsteps=5),optimizer(run_cache=run_cache,telnoise=TelescopeNoise(gain=2.0,T_const=40))]:
+        counts = count_cells(freqopt)
+        freqopt.calc()
+        assert sum(counts) == np.sum(np.isfinite(freqopt.sigmas))
+
+    adaptive = optimizer(run_cache=run_cache)
+    counts = count_cells(adaptive)
+    adaptive.calc(adaptive=True) # a different run than the full grid
+    assert sum(counts) > 0
+
+    monkeypatch.setattr(frequencyoptimizer,"get_version",lambda: "another version")
+    changed = optimizer(run_cache=run_cache)
+    counts = count_cells(changed)
+    changed.calc()
+    assert sum(counts) == np.sum(np.isfinite(changed.sigmas))
+
+
+def test_run_cache_eviction(tmp_path):
+    run_cache = cache.RunCache(str(tmp_path),maxsize=3000)
+    for i in range(5):
+        run_cache.store("run%i"%i,sigmas=np.zeros(100)+i)
+        os.utime(run_cache.get_filename("run%i"%i),(i,i)) # distinct access times
+    entries = run_cache.get_entries()
+    assert sum(size for mtime,size,filename in entries) <= 3000
+    assert run_cache.load("run4") is not None and run_cache.load("run0") is None
+
+
+### ==================================================
+### Atomic writes
+### ==================================================
+
+def test_atomic_write(tmp_path):
+    filename = str(tmp_path/"array.npy")
+    cache.atomic_save(filename,np.arange(3))
+    def fail(FILE):
+        FILE.write(b"partial")
+        raise KeyboardInterrupt
+    with pytest.raises(KeyboardInterrupt):
+        cache.atomic_write(filename,fail)
+    assert os.listdir(str(tmp_path)) == ["array.npy"]
+    assert np.array_equal(np.load(filename),np.arange(3))
+    filename = str(tmp_path/"arrays.npz")
+    cache.atomic_savez(filename,a=np.ones(2))
+    with np.load(filename) as data:
+        assert np.array_equal(data['a'],np.ones(2))
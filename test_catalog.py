@@ -0,0 +1,105 @@
+import numpy as np
+import os
+import pytest
+import catalog
+from frequencyoptimizer import TelescopeNoise
+
+
+def make_catalog():
+    '''
+    Two complete entries (B1855+09 and J1744-1134 of psr_info.txt) and one without a flux
+    '''
+    keys = ["period","DM","flux_1GHz","spec_index","uscale","W50","Weff","scat_ts","scat_ts_var","diss_ts","rms_J1"]
+    rows = dict(B1855_09=[5.3621,13.3,7.4,-1.5,8.442523,517.907428,750,0.0213,0.0453,1350,105.47],
+                J1744_1134=[4.074546,3.1,4.9,-1.5,27.010938,136.846082,511,0.0038,0.0041,1910,29.23],
+                J1453_1902=[7.9872048,13.5,None,-1.7,None,None,None,0.01,0.01,1000,None])
+    return dict((name,dict(zip(["name"]+keys,[name]+row))) for name,row in rows.items())
+
+
+### ==================================================
+### Catalog grid runs
+### ==================================================
+
+def test_make_pulsar_noise():
+    psrs = make_catalog()
+    psr = dict(psrs["J1744_1134"],W50=None,scat_ts=0.0038)
+    original = dict(psr)
+    psrnoise = catalog.make_pulsar_noise("J1744_1134",psr,1800.0,8)
+    assert psr == original # the catalog entry is not modified
+    assert np.allclose(psrnoise.W50s,0.66*511) and len(psrnoise.Weffs) == 8
+    assert catalog.make_pulsar_noise("J1453_1902",psrs["J1453_1902"]) is None
+
+
+@pytest.mark.parametrize("ncpu",[2,"auto"])
+def test_run_catalog_processes(tmp_path,ncpu):
+    psrs = make_catalog()
+    telnoise = TelescopeNoise(gain=2.0,T_const=30)
+    serial = catalog.run_catalog(psrs,telnoise,str(tmp_path/"serial"),0.3,3.0,nsteps=8,verbose=False)
+    parallel = catalog.run_catalog(psrs,telnoise,str(tmp_path/"parallel"),0.3,3.0,nsteps=8,ncpu=ncpu,verbose=False)
+    assert sorted(parallel) == sorted(serial) == ["B1855_09","J1744_1134"]
+    for name in serial:
+        assert np.allclose(parallel[name].sigmas,serial[name].sigmas,equal_nan=True,rtol=1e-12)
+    with open(str(tmp_path/"serial"/"summary.txt")) as FILE:
+        assert len(FILE.readlines()) == 3
+
+
+def test_run_catalog_bad_ncpu(tmp_path):
+    with pytest.raises(ValueError):
+        catalog.run_catalog(make_catalog(),TelescopeNoise(gain=2.0,T_const=30),str(tmp_path),0.3,3.0,ncpu="4")
+
+
+def test_run_catalog_calc_kwargs(tmp_path):
+    '''
+    Options that only calc() honors are used with ncpu > 1 too
+    '''
+    import cache
+    psrs = make_catalog()
+    telnoise = TelescopeNoise(gain=2.0,T_const=30)
+    run_cache = cache.RunCache(str(tmp_path/"runs"))
+    catalog.run_catalog(psrs,telnoise,str(tmp_path/"out"),0.3,3.0,nsteps=8,ncpu=2,run_cache=run_cache,verbose=False)
+    assert len(run_cache.get_entries()) == 2
+
+
+### ==================================================
+### Catalog cache
+### ==================================================
+
+def write_table(filename,psrs):
+    keys = list(next(iter(psrs.values())).keys())
+    with open(filename,"w") as FILE:
+        FILE.write("\t".join(keys)+"\n")
+        for psr in psrs.values():
+            FILE.write("\t".join(str(psr[key]) for key in keys)+"\n")
+
+
+def test_catalog_cache(tmp_path,monkeypatch):
+    filename = str(tmp_path/"psrs.txt")
+    psrs = make_catalog()
+    write_table(filename,psrs)
+    cat = catalog.Catalog(filename)
+    assert os.path.exists(os.path.join(filename+".cache","info.npz"))
+    assert cat.to_dict() == psrs
+    assert cat.select("DM",3.0,14.0) == ["J1744_1134","B1855_09","J1453_1902"]
+
+    def build(self):
+        raise AssertionError("cache not used")
+    with monkeypatch.context() as m:
+        m.setattr(catalog.Catalog,"build",build)
+        cached = catalog.Catalog(filename)
+    assert isinstance(cached.columns["DM"],np.memmap)
+    assert cached.to_dict() == psrs and len(cached) == 3
+    assert cached.get("B1855_09") == psrs["B1855_09"] and "B1937_21" not in cached
+
+    psrs["B1937_21"] = dict(psrs["B1855_09"],name="B1937_21",DM=71.0)
+    write_table(filename,psrs)
+    os.utime(filename,ns=(0,os.stat(filename).st_mtime_ns+10**9))
+    assert catalog.Catalog(filename).to_dict() == psrs # rebuilt for the new source
+    assert catalog.load_catalog(filename) == psrs
+
+
+def test_catalog_without_cache(tmp_path):
+    filename = str(tmp_path/"psrs.txt")
+    write_table(filename,make_catalog())
+    cat = catalog.Catalog(filename,cachedir=filename) # cannot be a directory
+    assert not isinstance(cat.columns["DM"],np.memmap)
+    assert cat.to_dict() == make_catalog()
@@ -0,0 +1,59 @@
+import numpy as np
+from covariance import StructuredCovariance
+
+
+def make_covariance(seed,shape=(3,10),k=2):
+    rng = np.random.default_rng(seed)
+    d = rng.uniform(0.5,2.0,size=shape)
+    U = rng.normal(size=shape+(k,))
+    return StructuredCovariance(d,U),rng
+
+
+def dense(C):
+    '''
+    Full covariance matrices built directly from d and U
+    '''
+    return C.d[...,np.newaxis]*np.eye(C.N) + np.matmul(C.U,np.swapaxes(C.U,-1,-2))
+
+
+def test_to_dense():
+    C,rng = make_covariance(0)
+    assert np.allclose(C.to_dense(),dense(C))
+
+
+def test_solve():
+    C,rng = make_covariance(1)
+    b = rng.normal(size=(10,4))
+    assert np.allclose(C.solve(b),np.einsum('...ij,jm->...im',np.linalg.inv(dense(C)),b))
+
+
+def test_solve_rank_one():
+    C,rng = make_covariance(2,k=1)
+    b = rng.normal(size=(10,1))
+    assert np.allclose(C.solve(b),np.einsum('...ij,jm->...im',np.linalg.inv(dense(C)),b))
+
+
+def test_epoch_averaged_variance():
+    C,rng = make_covariance(3)
+    assert np.allclose(C.epoch_averaged_variance(),1.0/np.sum(np.linalg.inv(dense(C)),axis=(-2,-1)))
+
+
+def test_nonpositive_diagonal():
+    '''
+    Matrices with a zero or negative diagonal element are solved densely, the others with Woodbury
+    '''
+    C,rng = make_covariance(4,shape=(3,6),k=1)
+    d = np.array(C.d)
+    d[1,2] = 0.0
+    d[2,4] = -0.1
+    C = StructuredCovariance(d,C.U)
+    b = rng.normal(size=(6,2))
+    CI = np.linalg.inv(dense(C))
+    assert np.allclose(C.solve(b),np.einsum('...ij,jm->...im',CI,b))
+    assert np.allclose(C.epoch_averaged_variance(),1.0/np.sum(CI,axis=(-2,-1)))
+
+
+def test_add():
+    C1,rng = make_covariance(5,k=1)
+    C2,rng = make_covariance(6,k=2)
+    assert np.allclose((C1 + C2).to_dense(),dense(C1) + dense(C2))
@@ -0,0 +1,70 @@
+import numpy as np
+import os
+import catalog
+import design
+from frequencyoptimizer import PulsarNoiseBatch,TelescopeNoise
+
+
+def make_telescopes():
+    rx = dict(rx_nu=np.array([0.7,1.0,2.0,3.0]),gain=np.array([1.8,2.0,1.9,1.2]),T_const=np.array([30.0,25.0,28.0,40.0]),
+              epsilon=np.array([0.01,0.01,0.02,0.03]))
+    return [TelescopeNoise(gain=2.0,T_const=30),
+            TelescopeNoise(gain=10.0,T_const=20,epsilon=0.005,pi_V=0.2),
+            TelescopeNoise(gain=1.0,T_const=50,Npol=1),
+            TelescopeNoise(interpolate=True,**rx)]
+
+
+def make_psrnoises(pulsar_noise,jitter=1.0):
+    return [pulsar_noise("A",sigma_Js=0.066*jitter),
+            pulsar_noise("B",DM=71.0,taud=None,dnud=2e-3,sigma_Js=0.3*jitter,glon=30.0,glat=2.0),
+            pulsar_noise("C",DM=20.0,I_0=1.0,sigma_Js=0.0,W50s=np.linspace(50,90,8))]
+
+
+### ==================================================
+### Telescope sweeps
+### ==================================================
+
+def test_sweep_matches_recompute(optimizer,pulsar_noise):
+    psrnoises = make_psrnoises(pulsar_noise)
+    freqopt = optimizer(psrnoise=PulsarNoiseBatch(psrnoises))
+    nus = np.geomspace(0.8,2.0,8)
+    telnoises = make_telescopes()
+    sweep = freqopt.calc_sweep(telnoises,nus)
+    assert sweep.shape == (4,3)
+    for k,telnoise in enumerate(telnoises):
+        expected = optimizer(psrnoise=PulsarNoiseBatch(psrnoises),telnoise=telnoise).calc_pulsars(nus)
+        assert np.allclose(sweep[k],expected,rtol=1e-10)
+    assert np.allclose(design.TelescopeSweep(freqopt,np.broadcast_to(nus,(3,8))).sweep(telnoises,chunk=1),sweep,rtol=1e-12)
+
+
+def test_sweep_integration_time(optimizer,pulsar_noise):
+    # sigma_Js are those for the reference integration time, as in timescaling.py
+    freqopt = optimizer(psrnoise=PulsarNoiseBatch(make_psrnoises(pulsar_noise)))
+    nus = np.geomspace(0.8,2.0,8)
+    telnoise = TelescopeNoise(gain=5.0,T_const=25,T=7200.0)
+    scaled = PulsarNoiseBatch(make_psrnoises(pulsar_noise,jitter=0.5))
+    expected = optimizer(psrnoise=scaled,telnoise=telnoise).calc_pulsars(nus)
+    assert np.allclose(freqopt.calc_sweep([telnoise],nus)[0],expected,rtol=1e-10)
+
+
+def test_sweep_grid(optimizer,tmp_path):
+    telnoises = make_telescopes()
+    freqopt = optimizer()
+    sweep = freqopt.calc_sweep(telnoises,filename=str(tmp_path/"sweep.npy"))
+    assert sweep.shape == (len(telnoises),)+freqopt.get_grid()[2].shape
+    for k,telnoise in enumerate(telnoises):
+        reference = optimizer(telnoise=telnoise)
+        reference.calc()
+        assert np.allclose(sweep[k],reference.sigmas,equal_nan=True,rtol=1e-10)
+
+
+def test_read_telescopes(optimizer,pulsar_noise,request):
+    filename = os.path.join(str(request.config.rootpath),"telescope_configs.txt")
+    names,telnoises = catalog.read_telescopes(filename)
+    assert len(names) == len(telnoises) > 0
+    psrnoises = make_psrnoises(pulsar_noise)
+    nus = np.geomspace(0.8,2.0,8)
+    sweep = optimizer(psrnoise=PulsarNoiseBatch(psrnoises)).calc_sweep(telnoises,nus)
+    for k,telnoise in enumerate(telnoises):
+        expected = optimizer(psrnoise=PulsarNoiseBatch(psrnoises),telnoise=telnoise).calc_pulsars(nus)
+        assert np.allclose(sweep[k],expected,rtol=1e-10)
@@ -0,0 +1,327 @@
+import numpy as np
+import os
+import pickle
+import pytest
+import DISS
+from frequencyoptimizer import K,epoch_averaged_error,evalDMnuError,ReceiverResponse,TelescopeNoise,PulsarNoiseBatch
+
+pytestmark = pytest.mark.filterwarnings("ignore::PendingDeprecationWarning") # np.matrix in the dense reference
+
+
+### ==================================================
+### Helpers
+### ==================================================
+
+def dense_sigma(freqopt,nus):
+    '''
+    sigma_TOA of one cell from dense covariance matrices, as calc_single() computed it
+    before the structured solvers and batching
+    '''
+    cov = freqopt.build_template_fitting_cov_matrix(nus) + freqopt.build_jitter_cov_matrix() + freqopt.build_scintillation_cov_matrix(nus)
+    X = np.matrix(np.ones((len(nus),2)))
+    X[:,1] = np.matrix(K/nus**2).T
+    VI = cov.I
+    P = (X.T*VI*X).I
+
+    dnud = DISS.scale_dnu_d(freqopt.psrnoise.dnud,1.0,nus)
+    DM_nu_cov = np.matrix(np.zeros((len(nus),len(nus))))
+    for i in range(len(nus)):
+        for j in range(len(nus)):
+            if nus[i] != nus[j]:
+                nu1,nu2,dnuiss = (nus[i],nus[j],dnud[i]) if nus[i] > nus[j] else (nus[j],nus[i],dnud[j])
+                DM_nu_cov[i,j] = evalDMnuError(dnuiss,nu1,nu2)**2
+    DM_nu_var = max(epoch_averaged_error(DM_nu_cov,var=True),0.0)
+
+    chromatic = freqopt.psrnoise.tauvar*np.power(nus,-4.4)
+    scattering_var = np.dot(P*X.T*VI,chromatic)[0,0]**2
+    sigmatel2 = epoch_averaged_error(freqopt.build_polarization_cov_matrix(nus))
+    sigma = np.sqrt(epoch_averaged_error(cov,var=True) + P[0,0] + DM_nu_var + scattering_var + sigmatel2)
+    return min(sigma,freqopt.psrnoise.P)
+
+
+def dense_grid(freqopt):
+    Cs,Bs,valid = freqopt.get_grid()
+    sigmas = np.zeros(np.shape(valid)) + np.nan
+    for i,j in zip(*np.nonzero(valid)):
+        sigmas[i,j] = dense_sigma(freqopt,freqopt.get_channels(Cs[i,j],Bs[i,j]))
+    return sigmas
+
+
+### ==================================================
+### Batched calc()
+### ==================================================
+
+@pytest.mark.parametrize("kwargs",[dict(log=True,r=3.0),dict(log=True,nchan=4),dict(log=False,dnu=0.5)])
+def test_calc_matches_dense(optimizer,kwargs):
+    freqopt = optimizer(**kwargs)
+    freqopt.calc()
+    expected = dense_grid(freqopt)
+    assert np.sum(np.isfinite(expected)) > 10
+    assert np.array_equal(np.isfinite(freqopt.sigmas),np.isfinite(expected))
+    ok = np.isfinite(expected)
+    assert np.allclose(freqopt.sigmas[ok],expected[ok],rtol=1e-8)
+
+
+def test_calc_chunks(optimizer):
+    '''
+    The result does not depend on how the cells are split into chunks
+    '''
+    freqopt = optimizer()
+    freqopt.calc()
+    chunked = optimizer(memory_limit=2**14)
+    chunked.calc()
+    assert np.allclose(chunked.sigmas,freqopt.sigmas,equal_nan=True,rtol=1e-12)
+
+
+def test_calc_single_matches_batch(optimizer):
+    freqopt = optimizer()
+    Cs,Bs,valid = freqopt.get_grid()
+    nus = freqopt.get_channels(Cs[valid],Bs[valid])
+    assert np.allclose([freqopt.calc_single(x) for x in nus],freqopt.calc_batch(nus),rtol=1e-12)
+
+
+### ==================================================
+### DM(nu) kernel cache
+### ==================================================
+
+def test_dmnu_cache_matches_uncached(optimizer,pulsar_noise):
+    '''
+    The kernel cached for one pulsar is rescaled for pulsars with other DM and dnud
+    '''
+    from frequencyoptimizer import DMnuKernelCache
+    dmnu_cache = DMnuKernelCache()
+    for i,(DM,taud,dnud) in enumerate([(3.14,26.1e-3,None),(71.0,None,2e-3),(300.0,None,1e-5)]):
+        psrnoise = pulsar_noise(DM=DM,taud=taud,dnud=dnud)
+        cached = optimizer(psrnoise=psrnoise,dmnu_cache=dmnu_cache)
+        cached.calc()
+        if i == 0:
+            nkernels = len(dmnu_cache.variances)
+        assert len(dmnu_cache.variances) == nkernels # every later pulsar hits the cache
+        uncached = optimizer(psrnoise=psrnoise,dmnu_cache=None)
+        uncached.calc()
+        assert np.allclose(cached.sigmas,uncached.sigmas,equal_nan=True,rtol=1e-10)
+
+
+@pytest.mark.parametrize("log",[True,False])
+def test_dmnu_cache_shares_ratios(optimizer,log):
+    '''
+    Cells with the same nuhigh/nulow share one kernel, rescaled to each cell
+    '''
+    from frequencyoptimizer import DMnuKernelCache,epoch_averaged_variance
+    dmnu_cache = DMnuKernelCache()
+    freqopt = optimizer(log=log,dnu=0.5,dmnu_cache=dmnu_cache)
+    Cs,Bs,valid = freqopt.get_grid()
+    nus = freqopt.get_channels(Cs[valid],Bs[valid])
+    variances = freqopt.DMnu_variance(nus)
+    nratios = len(np.unique(np.round(nus[:,-1]/nus[:,0],8)))
+    assert len(dmnu_cache.variances) == nratios < len(nus)
+    expected = np.maximum(epoch_averaged_variance(freqopt.build_DMnu_cov_matrices(nus)),0.0)
+    assert np.allclose(variances,expected,rtol=1e-10)
+
+
+### ==================================================
+### Adaptive grids and optimum search
+### ==================================================
+
+def test_adaptive_matches_grid(optimizer):
+    full = optimizer(nsteps=16)
+    full.calc()
+    adaptive = optimizer(nsteps=16)
+    adaptive.calc(adaptive=True,max_fraction=1.0)
+    valid = np.isfinite(full.sigmas)
+    assert np.array_equal(np.isfinite(adaptive.sigmas),valid)
+    assert 0 < np.sum(adaptive.exact) < np.sum(valid)
+    assert np.allclose(adaptive.sigmas[adaptive.exact],full.sigmas[adaptive.exact],rtol=1e-12)
+    logerror = np.abs(np.log10(adaptive.sigmas[valid]/full.sigmas[valid]))
+    assert np.max(logerror) < 0.05
+
+    # cells near the minimum are computed exactly, so the optimum is the same
+    near = valid & (np.log10(full.sigmas) < np.log10(np.nanmin(full.sigmas)) + np.log10(1.1))
+    assert np.all(adaptive.exact[near])
+    assert np.nanargmin(adaptive.sigmas) == np.nanargmin(full.sigmas)
+
+
+def test_adaptive_fallback(optimizer):
+    '''
+    With max_fraction=0, all cells are computed after the first subdivision
+    '''
+    full = optimizer(nsteps=16)
+    full.calc()
+    adaptive = optimizer(nsteps=16)
+    adaptive.calc(adaptive=True,max_fraction=0.0)
+    assert np.array_equal(adaptive.exact,np.isfinite(full.sigmas))
+    assert np.allclose(adaptive.sigmas,full.sigmas,equal_nan=True,rtol=1e-12)
+
+
+@pytest.mark.parametrize("r",[None,3.0])
+def test_find_optimum(optimizer,r):
+    '''
+    The continuous optimum is at least as good as the best grid cell and satisfies the grid's constraints
+    '''
+    full = optimizer(nsteps=16,r=r)
+    full.calc()
+    freqopt = optimizer(nsteps=16,r=r)
+    C,B,sigma = freqopt.find_optimum()
+    assert sigma <= np.nanmin(full.sigmas)*(1+1e-6)
+    assert np.isclose(sigma,freqopt.calc_single(freqopt.get_channels(C,B)),rtol=1e-12)
+    assert B < 1.9*C*(1+1e-6)
+    assert np.min(full.Cs)*(1-1e-6) <= C <= np.max(full.Cs)*(1+1e-6)
+    if r is not None:
+        assert (C+B/2.0)/(C-B/2.0) <= r*(1+1e-6) and C - B/2.0 >= freqopt.numin*(1-1e-6)
+
+
+def test_find_optimum_starts(optimizer):
+    '''
+    Starting from the grid optimum gives the same result as the coarse search
+    '''
+    freqopt = optimizer(nsteps=16)
+    C,B,sigma = freqopt.find_optimum()
+    C2,B2,sigma2 = freqopt.find_optimum(starts=[(C*1.05,B*0.95)])
+    assert np.isclose(sigma2,sigma,rtol=1e-4)
+
+
+### ==================================================
+### Receiver response
+### ==================================================
+
+def test_receiver_response_interp():
+    rx_nu = np.array([1.4,0.7,1.0,2.0,3.0])
+    gain = np.array([2.0,1.8,1.9,1.5,1.0])
+    T_const = np.array([25.0,30.0,28.0,40.0,50.0])
+    order = np.argsort(rx_nu)
+    response = ReceiverResponse(rx_nu,gain,T_const,0.01)
+    for nus in [np.array([0.5,0.7,1.2,2.5,4.0]),np.linspace(0.1,5.0,300).reshape((3,100))]:
+        G,T,eps = response.evaluate(nus)
+        assert np.shape(G) == np.shape(nus)
+        assert np.allclose(G,np.interp(nus,rx_nu[order],gain[order]),rtol=1e-14)
+        assert np.allclose(T,np.interp(nus,rx_nu[order],T_const[order]),rtol=1e-14)
+        assert np.allclose(eps,0.01,rtol=1e-14)
+    G,T,eps = ReceiverResponse(1.4,2.0,30.0,0.01).evaluate(np.linspace(1,2,100))
+    assert np.all(G == 2.0) and np.all(T == 30.0)
+
+
+def test_receiver_response_memo():
+    response = ReceiverResponse([0.7,1.0,3.0],[1.8,1.9,1.0],[30.0,28.0,50.0],0.01,maxbytes=3*8*200*2)
+    nus = np.linspace(0.5,4.0,200)
+    first = response.evaluate(nus)
+    second = response.evaluate(nus.copy())
+    assert len(response.responses) == 1
+    assert all(np.shares_memory(a,b) for a,b in zip(first,second))
+    assert not first[0].flags.writeable
+    response.evaluate(nus[::-1])
+    response.evaluate(nus.reshape((2,100)))
+    assert len(response.responses) == 2 # the oldest is evicted
+    assert response.nbytes == sum(values.nbytes for values in response.responses.values())
+    assert np.array_equal(response.evaluate(nus)[0],first[0])
+
+    rx = dict(rx_nu=np.array([0.7,1.0,3.0]),gain=np.array([1.8,1.9,1.0]),T_const=np.array([30.0,28.0,50.0]),epsilon=0.01)
+    telnoise = TelescopeNoise(interpolate=True,**rx)
+    assert telnoise.get_response() is TelescopeNoise(interpolate=True,**rx).get_response()
+    assert np.allclose(telnoise.get_gain(nus),np.interp(nus,rx["rx_nu"],rx["gain"]))
+    assert len(pickle.loads(pickle.dumps(telnoise.get_response())).responses) == 0
+
+
+### ==================================================
+### Pulsar batches
+### ==================================================
+
+def make_pulsars(pulsar_noise,nchan):
+    return [pulsar_noise("A",nchan=nchan),
+            pulsar_noise("B",nchan=nchan,DM=71.0,taud=None,dnud=2e-3,glon=30.0,glat=2.0),
+            pulsar_noise("C",nchan=nchan,DM=20.0,P=None,Weffs=300.0,W50s=np.linspace(50,90,nchan),sigma_Js=0.0),
+            pulsar_noise("D",nchan=nchan,DM=300.0,taud=None,dnud=1e-5,tauvar=None,glon=300.0,glat=-40.0)]
+
+
+def test_calc_pulsars_matches_single(optimizer,pulsar_noise):
+    psrnoises = make_pulsars(pulsar_noise,8)
+    batch = optimizer(psrnoise=PulsarNoiseBatch(psrnoises))
+    assert batch.psrnoise.glon.shape == (4,1) and np.isnan(batch.psrnoise.P[2,0])
+    nus = np.geomspace(0.6,2.4,8)
+    per_pulsar = np.array([np.geomspace(0.3,0.9,8),nus,np.geomspace(1.0,4.0,8),np.geomspace(2.0,3.0,8)])
+    for channels in [nus,per_pulsar]:
+        sigmas = batch.calc_pulsars(channels)
+        assert sigmas.shape == (4,)
+        expected = [optimizer(psrnoise=psrnoise).calc_single(np.broadcast_to(channels,(4,8))[k])
+                    for k,psrnoise in enumerate(psrnoises)]
+        assert np.allclose(sigmas,expected,rtol=1e-10)
+
+
+### ==================================================
+### Memory-mapped output
+### ==================================================
+
+def test_memmap_output(optimizer,tmp_path):
+    from frequencyoptimizer import grid_extrema
+    reference = optimizer(nsteps=8)
+    reference.calc()
+    output = str(tmp_path/"sigmas.npy")
+    freqopt = optimizer(nsteps=8,output=output,memory_limit=2**14)
+    freqopt.calc()
+    assert isinstance(freqopt.sigmas,np.memmap)
+    assert np.allclose(np.load(output),reference.sigmas,equal_nan=True,rtol=1e-12)
+    assert np.array_equal(freqopt.exact,np.isfinite(reference.sigmas))
+    assert freqopt.get_optimum() == reference.get_optimum()
+    MIN,MAX,ind = grid_extrema(freqopt.sigmas,block_size=7)
+    assert MIN == np.nanmin(reference.sigmas) and MAX == np.nanmax(reference.sigmas)
+
+    freqopt.save(str(tmp_path/"grid.npz"))
+    with np.load(str(tmp_path/"grid.npz")) as data:
+        assert np.allclose(data['sigmas'],reference.sigmas,equal_nan=True,rtol=1e-12)
+
+
+### ==================================================
+### Checkpoints
+### ==================================================
+
+def interrupt(freqopt,ncalls):
+    '''
+    Make the ncalls-th call of freqopt.calc_cells raise KeyboardInterrupt
+    '''
+    calc_cells = freqopt.calc_cells
+    calls = []
+    def interrupted(Cs,Bs):
+        calls.append(len(Cs))
+        if len(calls) == ncalls:
+            raise KeyboardInterrupt
+        return calc_cells(Cs,Bs)
+    freqopt.calc_cells = interrupted
+
+
+def count_cells(freqopt):
+    calc_cells = freqopt.calc_cells
+    ncells = []
+    freqopt.calc_cells = lambda Cs,Bs: ncells.append(len(Cs)) or calc_cells(Cs,Bs)
+    return ncells
+
+
+@pytest.mark.parametrize("kwargs",[dict(),dict(adaptive=True,max_fraction=1.0)])
+def test_checkpoint_resume(optimizer,tmp_path,kwargs):
+    checkpoint = str(tmp_path/"checkpoint.npz")
+    reference = optimizer(nsteps=16)
+    reference.calc(**kwargs)
+
+    freqopt = optimizer(nsteps=16,checkpoint=checkpoint,checkpoint_interval=0.0,memory_limit=2**16)
+    interrupt(freqopt,3)
+    with pytest.raises(KeyboardInterrupt):
+        freqopt.calc(**kwargs)
+    assert os.path.exists(checkpoint)
+
+    resumed = optimizer(nsteps=16,checkpoint=checkpoint,memory_limit=2**16)
+    ncells = count_cells(resumed)
+    resumed.calc(**kwargs)
+    assert not os.path.exists(checkpoint)
+    assert 0 < sum(ncells) < np.sum(reference.exact)
+    assert np.array_equal(resumed.exact,reference.exact)
+    assert np.allclose(resumed.sigmas,reference.sigmas,equal_nan=True,rtol=1e-12)
+
+
+def test_checkpoint_other_run(optimizer,tmp_path):
+    checkpoint = str(tmp_path/"checkpoint.npz")
+    freqopt = optimizer(checkpoint=checkpoint,checkpoint_interval=0.0,memory_limit=2**16)
+    interrupt(freqopt,2)
+    with pytest.raises(KeyboardInterrupt):
+        freqopt.calc()
+    other = optimizer(numax=5.0,checkpoint=checkpoint)
+    ncells = count_cells(other)
+    other.calc()
+    assert sum(ncells) == np.sum(np.isfinite(other.sigmas))
@@ -0,0 +1,85 @@
+import numpy as np
+import os
+import time
+import pytest
+import parallel
+
+
+def fail(X):
+    raise ValueError("failed in worker")
+
+
+def sleep(X):
+    time.sleep(10)
+    return X
+
+
+def double(X):
+    return 2*X[:,0]
+
+
+def square(x):
+    return x*x
+
+
+def blas_env(x):
+    return os.environ.get("OPENBLAS_NUM_THREADS")
+
+
+def test_map_array():
+    X = np.arange(20.0).reshape(10,2)
+    with parallel.Executor(2) as executor:
+        assert np.array_equal(executor.map_array(double,X,maxchunk=3),2*X[:,0])
+        assert executor.map(square,range(7),maxchunk=2) == [x*x for x in range(7)]
+        assert sorted(executor.imap_unordered(square,range(5))) == [(i,i*i) for i in range(5)]
+
+
+def test_error():
+    with parallel.Executor(2) as executor:
+        with pytest.raises(ValueError,match="failed in worker"):
+            executor.map_array(fail,np.zeros((4,2)))
+        assert np.array_equal(executor.map_array(double,np.ones((4,2))),np.zeros(4)+2) # still usable
+
+
+def test_timeout():
+    with parallel.Executor(1,timeout=0.5) as executor:
+        start = time.time()
+        with pytest.raises(TimeoutError):
+            executor.map(sleep,[1,2])
+        assert time.time() - start < 5
+        assert executor.map(len,[[1],[1,2]],timeout=30) == [1,2] # restarted workers
+
+
+def test_nested_calls():
+    '''
+    Calls made while iterating over another call of the same executor do not deadlock
+    '''
+    with parallel.Executor(2,timeout=60) as executor:
+        results = dict()
+        for i,value in executor.imap_unordered(square,range(3)):
+            results[i] = (value,executor.map(square,range(i+2)))
+    assert results == dict((i,(i*i,[x*x for x in range(i+2)])) for i in range(3))
+
+
+def test_calc_with_processes(optimizer):
+    reference = optimizer(nsteps=8)
+    reference.calc()
+    with parallel.Executor(2) as executor:
+        freqopt = optimizer(nsteps=8,ncpu=2,executor=executor,memory_limit=2**14)
+        freqopt.calc()
+        assert executor.job_id > 0
+    assert np.allclose(freqopt.sigmas,reference.sigmas,equal_nan=True,rtol=1e-12)
+
+
+def test_blas_threads(monkeypatch):
+    monkeypatch.setattr(parallel,"threadpoolctl",None)
+    monkeypatch.setattr(parallel,"WARNED",set())
+    with parallel.Executor(1,blas_threads=2) as executor:
+        assert executor.context.get_start_method() != "fork"
+        assert executor.map(blas_env,[0]) == ["2"]
+    with pytest.warns(RuntimeWarning):
+        with parallel.blas_threads(1):
+            pass
+    if "fork" in parallel.multiprocessing.get_all_start_methods():
+        with pytest.warns(RuntimeWarning):
+            parallel.Executor(1,"fork",blas_threads=1)
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+import shards
+
+
+def assert_same(a,b):
+    assert np.array_equal(a,b,equal_nan=True)
+
+
+### ==================================================
+### Sharded grid runs
+### ==================================================
+
+def test_split_weights():
+    weights = [5,1,1,1,4,0,2]
+    ranges = shards.split_weights(weights,3)
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(weights)
+    assert all(ranges[i][1] == ranges[i+1][0] for i in range(2))
+    assert shards.split_weights([1,1],4)[-1][1] == 2
+
+
+@pytest.mark.parametrize("nshards",[1,3,40])
+def test_merge_shards(tmp_path,optimizer,nshards):
+    reference = optimizer()
+    reference.calc()
+    filenames = [str(tmp_path/("shard_%i.npz"%index)) for index in range(nshards)]
+    for index in range(nshards):
+        optimizer().calc_shard(index,nshards,filenames[index])
+    freqopt = optimizer()
+    freqopt.merge_shards(filenames[::-1])
+    assert_same(freqopt.sigmas,reference.sigmas)
+    assert np.array_equal(freqopt.exact,reference.exact)
+
+
+def test_merge_shards_pulsars(tmp_path,optimizer,pulsar_noise):
+    freqopts = dict((name,optimizer(psrnoise=pulsar_noise(name,DM=DM)))
+                    for name,DM in [("A",3.14),("B",30.0)])
+    filenames = [str(tmp_path/("shard_%i.npz"%index)) for index in range(3)]
+    pieces = [shards.calc_shard(freqopts,index,3,filenames[index]) for index in range(3)]
+    assert sum(stop-start for piece in pieces for name,start,stop in piece) == 2*len(freqopts["A"].Cs)
+    results = shards.merge_shards(filenames)
+    for name,freqopt in freqopts.items():
+        freqopt.calc()
+        assert_same(results[name]['sigmas'],freqopt.sigmas)
+        assert_same(results[name]['Cs'],freqopt.Cs)
+
+
+def test_merge_shards_errors(tmp_path,optimizer):
+    filenames = [str(tmp_path/("shard_%i.npz"%index)) for index in range(2)]
+    for index in range(2):
+        optimizer().calc_shard(index,2,filenames[index])
+    with pytest.raises(ValueError):
+        shards.merge_shards(filenames[:1])
+    with pytest.raises(ValueError):
+        shards.merge_shards([filenames[0]]*2)
+    with pytest.raises(ValueError):
+        optimizer(numax=5.0).merge_shards(filenames)
+    with pytest.raises(ValueError):
+        optimizer().calc_shard(2,2,filenames[0])
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+import skytemp
+
+
+def fortran_tsky408(l,b):
+    '''
+    psr_tsky() of tsky/tsky.f at 408 MHz for one position, reading tsky.dat with nsky(i,j), j fastest
+    '''
+    values = []
+    with open("tsky.dat") as FILE:
+        for line in FILE:
+            values.extend(float(line[k:k+5]) for k in range(0,len(line.rstrip("\n")),5))
+    j = min(int(b+91.5),180)
+    nl = 359 if l < 0.5 else int(l-0.5)
+    i = nl//4 + 1
+    return values[(i-1)*180 + (j-1)]
+
+
+@pytest.fixture(autouse=True)
+def sky_map(monkeypatch,request):
+    monkeypatch.chdir(request.config.rootpath)
+    monkeypatch.setattr(skytemp,"SKY_MAP",None)
+    monkeypatch.setattr(skytemp,"T408_CACHE",dict())
+
+
+### ==================================================
+### Galactic sky temperature
+### ==================================================
+
+def test_tabulated_values():
+    # fifth and first values on line 12 of tsky.dat: nsky(2,1) and nsky(1,177)
+    assert skytemp.tsky408(6.0,-90.0) == pytest.approx(19.2,rel=1e-6)
+    assert skytemp.tsky408(2.0,86.0) == pytest.approx(19.4,rel=1e-6)
+    assert skytemp.tsky(6.0,-90.0,408.0) == pytest.approx(19.2,rel=1e-6)
+
+
+def test_matches_fortran():
+    rng = np.random.default_rng(1)
+    ls = np.concatenate(([0.0,0.4,0.5,4.5,359.9,360.0,-10.0],rng.uniform(0,360,50)))
+    bs = np.concatenate(([-90.0,-89.5,0.0,45.2,89.9,90.0,-30.0],rng.uniform(-90,90,50)))
+    expected = np.array([fortran_tsky408(l,b) for l,b in zip(np.mod(ls,360.0),bs)])
+    assert np.allclose(skytemp.tsky408(ls,bs),expected,rtol=1e-6)
+    assert np.allclose([skytemp.tsky408(l,b) for l,b in zip(ls,bs)],expected,rtol=1e-6)
+
+
+def test_broadcasting(tmp_path):
+    freqs = np.array([100.0,408.0,1400.0])
+    T = skytemp.tsky(np.array([10.0,200.0]),np.array([5.0,-60.0]),freqs[:,np.newaxis])
+    assert T.shape == (3,2)
+    assert np.allclose(T[1],skytemp.tsky408([10.0,200.0],[5.0,-60.0]))
+    assert np.allclose(T[:,0],skytemp.tsky408(10.0,5.0)*(freqs/408.0)**-2.6)
+
+    filename = str(tmp_path/"tsky.npy")
+    np.save(filename,skytemp.load_map())
+    assert np.array_equal(skytemp.load_map(filename),skytemp.load_map())
+    with pytest.raises(ValueError):
+        np.save(filename,np.zeros((10,10)))
+        skytemp.load_map(filename)
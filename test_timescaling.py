@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+from frequencyoptimizer import PulsarNoiseBatch,TelescopeNoise
+
+
+def make_batch(optimizer,pulsar_noise,T=1800.0,jitter=1.0):
+    psrnoises = [pulsar_noise("A",sigma_Js=0.066*jitter),
+                 pulsar_noise("B",DM=71.0,taud=None,dnud=2e-3,sigma_Js=0.3*jitter,glon=30.0,glat=2.0),
+                 pulsar_noise("C",DM=20.0,I_0=1.0,sigma_Js=0.1*jitter),
+                 pulsar_noise("D",DM=150.0,I_0=0.3,taud=None,dnud=1e-4,sigma_Js=0.0)]
+    return optimizer(psrnoise=PulsarNoiseBatch(psrnoises),telnoise=TelescopeNoise(gain=2.0,T_const=30,T=T))
+
+
+### ==================================================
+### Integration-time scaling
+### ==================================================
+
+def test_sigma_matches_calc_pulsars(optimizer,pulsar_noise):
+    freqopt = make_batch(optimizer,pulsar_noise)
+    nus = np.geomspace(0.8,2.0,8)
+    ts = freqopt.get_time_scaling(nus)
+    assert ts.shape == (4,)
+    assert np.allclose(ts.sigma(1800.0),freqopt.calc_pulsars(nus),rtol=1e-10)
+    # sigma_Js are those for T0 and scale as sqrt(T0/T)
+    longer = make_batch(optimizer,pulsar_noise,T=7200.0,jitter=0.5)
+    assert np.allclose(ts.sigma(7200.0),longer.calc_pulsars(nus),rtol=1e-10)
+    Ts = np.array([100.0,1800.0,1e5])
+    assert np.allclose(ts.sigma(Ts[:,np.newaxis])[1],ts.sigma(1800.0))
+    assert np.all(np.diff(ts.sigma(Ts[:,np.newaxis]),axis=0) <= 0)
+
+
+def test_time_for_target(optimizer,pulsar_noise):
+    ts = make_batch(optimizer,pulsar_noise).get_time_scaling(np.geomspace(0.8,2.0,8))
+    targets = ts.sigma(1800.0)*np.array([1e6,0.9,0.5,1e-3])
+    needed = ts.time_for_target(targets)
+    assert needed[0] == 1.0 and np.isinf(needed[3])
+    T = np.where(np.isfinite(needed),needed,1.0)
+    assert np.all(ts.sigma(T)[1:3] <= targets[1:3])
+    assert np.all(ts.sigma(T*0.999)[1:3] > targets[1:3])
+
+
+def test_allocate_fraction(optimizer,pulsar_noise):
+    ts = make_batch(optimizer,pulsar_noise).get_time_scaling(np.geomspace(0.8,2.0,8))
+    target = 1.0
+    needed = ts.time_for_target(target)
+    order = np.argsort(needed)
+    assert np.sum(np.isfinite(needed)) >= 3
+    total = needed[order[0]] + needed[order[1]] + 0.5*needed[order[2]]
+    T,sigmas = ts.allocate(total,"fraction",target=target)
+    assert np.allclose(T[order[:2]],needed[order[:2]])
+    assert np.isclose(T[order[2]],0.5*needed[order[2]]) # the rest goes to the next pulsar
+    assert T[order[3]] == 0 and np.isnan(sigmas[order[3]])
+    assert np.isclose(np.sum(T),total)
+    assert np.all(sigmas[order[:2]] <= target) and sigmas[order[2]] > target
+    assert np.allclose(sigmas[order[:3]],ts.sigma(np.where(T > 0,T,1.0))[order[:3]])
+
+    T,sigmas = ts.allocate(total,"fraction",weights=np.where(np.arange(4) == order[1],100.0,1.0),target=target)
+    assert np.isclose(T[order[1]],needed[order[1]]) and np.isclose(T[order[0]],needed[order[0]])
+
+
+@pytest.mark.parametrize("objective",["mean","inverse_variance","median"])
+def test_allocate(optimizer,pulsar_noise,objective):
+    ts = make_batch(optimizer,pulsar_noise).get_time_scaling(np.geomspace(0.8,2.0,8))
+    T,sigmas = ts.allocate(4*1800.0,objective,nsteps=40)
+    assert np.isclose(np.sum(T),4*1800.0) and np.all(T >= 180.0)
+    assert np.allclose(sigmas,ts.sigma(T))
+    if objective == "mean":
+        assert np.mean(sigmas) <= np.mean(ts.sigma(np.zeros(4)+1800.0))
+    with pytest.raises(ValueError):
+        ts.allocate(1800.0,objective,nsteps=3)
+    with pytest.raises(ValueError):
+        ts.allocate(1800.0,"maximum")
@@ -0,0 +1,147 @@
+import numpy as np
+import DISS
+import objectives
+from frequencyoptimizer import K,cell_values,evalDMnuError
+from covariance import StructuredCovariance
+
+
+### ==================================================
+### Integration-time scaling of sigma_TOA
+### ==================================================
+
+class TimeScaling:
+    '''
+    The parts of sigma_TOA of a stack of channel selections (cells) that do not depend on the integration
+    time T, so that sigma_TOA can be re-evaluated for any T without the sky temperatures, receiver response,
+    scattering table, or DM(nu) kernels. With respect to the T0 of freqopt.telnoise:
+
+    template-fitting errors scale as sqrt(T0/T)
+    jitter errors scale as sqrt(T0/T), i.e., sigma_Js are taken to be those for T0 (as in predict_toas.py)
+    the number of scintles has a factor (1 + etat*T/dtd)
+    the polarization, DM(nu), and chromatic terms do not depend on T
+
+    freqopt: FrequencyOptimizer
+    nus: Channel frequencies of shape (...,nchan), broadcast against the pulsar parameters
+    '''
+    def __init__(self,freqopt,nus,nuref=1.0,etat=0.2,etanu=0.2):
+        nus = np.asarray(nus,dtype=float)
+        psrnoise = freqopt.psrnoise
+        self.T0 = float(freqopt.telnoise.T)
+        self.etat = etat
+
+        self.sntf2 = freqopt.template_fitting_sigmas(nus)**2
+        self.sJ = freqopt.jitter_sigmas(nus)
+        B = freqopt.get_bandwidths(nus)
+        self.dtd = DISS.scale_dt_d(psrnoise.dtd,nuref,nus)
+        self.taud = DISS.scale_tau_d(psrnoise.taud,nuref,nus)
+        self.nnu = 1 + etanu*B/DISS.scale_dnu_d(psrnoise.dnud,nuref,nus)
+
+        self.X = np.ones(np.shape(nus)+(2,)) #design matrix
+        self.X[...,1] = K/nus**2
+        self.chromatic = psrnoise.tauvar * np.power(nus,-4.4)
+        if freqopt.full:
+            DM_nu_var = freqopt.DMnu_variance(nus)
+        else: # [deprecated], as in DM_misestimation_components()
+            DM_nu_var = evalDMnuError(cell_values(psrnoise.dnud),np.max(nus,axis=-1),np.min(nus,axis=-1))**2 / 25.0
+        self.DM_nu_var = DM_nu_var
+        self.sigmatel2 = freqopt.polarization_error(nus)
+        self.P = None if psrnoise.P is None else cell_values(psrnoise.P)
+        self.shape = np.shape(self.DM_nu_var + self.sigmatel2)
+
+    def sigma(self,T,sntf2=None,sigmatel2=None):
+        '''
+        sigma_TOA for integration times T (s), which broadcast against the shape of the cells, e.g.,
+        one T per pulsar of a PulsarNoiseBatch, or T[:,np.newaxis] for every cell at every T.
+        sntf2 (template-fitting variances for T0) and sigmatel2 (polarization term, see polarization_error())
+        replace those of freqopt.telnoise if given, e.g., for other telescopes (see design.py)
+        '''
+        if sntf2 is None:
+            sntf2 = self.sntf2
+        if sigmatel2 is None:
+            sigmatel2 = self.sigmatel2
+        T = np.asarray(T,dtype=float)[...,np.newaxis]
+        with np.errstate(divide="ignore",invalid="ignore"):
+            niss = self.nnu * (1 + self.etat*T/self.dtd)
+            sdiss = self.taud/np.sqrt(niss)
+            block = niss < 2
+            d = sntf2*(self.T0/T) + np.where(block,0.0,sdiss**2)
+            U = np.stack(np.broadcast_arrays(self.sJ*np.sqrt(self.T0/T),np.where(block,sdiss,0.0)),axis=-1)
+            V = StructuredCovariance(d,U)
+
+            VIX = V.solve(self.X)
+            P = np.linalg.inv(np.einsum('...ni,...nj->...ij',self.X,VIX))
+            XTVIc = np.einsum('...ni,...n->...i',VIX,self.chromatic)
+            scattering_var = np.einsum('...ij,...j->...i',P,XTVIc)[...,0]**2
+
+            sigma = np.sqrt(V.epoch_averaged_variance() + P[...,0,0] + scattering_var + self.DM_nu_var + sigmatel2)
+        if self.P is not None:
+            sigma = np.where(sigma > self.P,self.P,sigma)
+        return sigma
+
+    def time_for_target(self,target,Tmin=1.0,Tmax=1e7,niter=60):
+        '''
+        Integration time (s) needed by each cell to reach sigma_TOA = target (us), found by bisection in log T
+        between Tmin and Tmax. Tmin where the target is met already, inf where it is not reached by Tmax.
+        '''
+        target = np.broadcast_to(np.asarray(target,dtype=float),self.shape)
+        low = np.zeros(self.shape) + np.log(Tmin)
+        high = np.zeros(self.shape) + np.log(Tmax)
+        for i in range(niter):
+            mid = 0.5*(low + high)
+            reached = self.sigma(np.exp(mid)) <= target
+            high = np.where(reached,mid,high)
+            low = np.where(reached,low,mid)
+        T = np.exp(high)
+        T = np.where(self.sigma(Tmin) <= target,Tmin,T)
+        return np.where(self.sigma(Tmax) <= target,T,np.inf)
+
+    def allocate(self,total,objective="mean",weights=None,target=1.0,nsteps=None):
+        '''
+        Split a total integration time (s) across the cells, one per pulsar of a PulsarNoiseBatch, to minimize
+        an array-level objective (see objectives.aggregate()). Returns the times and the resulting sigma_TOA.
+
+        mean, inverse_variance, median: Every pulsar gets one of nsteps (default 20 per pulsar) equal
+                                        quanta of time, the others go one at a time to the pulsar that
+                                        improves the objective most
+        fraction: Pulsars get the time they need to reach the target in order of weight per time needed
+                  until the time runs out, the rest of the time goes to the next pulsar in that order, and
+                  the others get none (sigma_TOA NaN)
+        '''
+        N = self.shape[0]
+        if weights is None:
+            weights = np.ones(N)
+        weights = np.asarray(weights,dtype=float)
+        if objective not in objectives.OBJECTIVES:
+            raise ValueError("Unknown objective %s, use one of %s"%(objective,", ".join(objectives.OBJECTIVES)))
+
+        if objective == "fraction":
+            needed = self.time_for_target(target)
+            T = np.zeros(N)
+            order = np.argsort(-weights/needed,kind="stable")
+            nchosen = np.sum(np.cumsum(needed[order]) <= total) # a prefix of order, inf never fits
+            T[order[:nchosen]] = needed[order[:nchosen]]
+            if nchosen < N:
+                T[order[nchosen]] = total - np.sum(T)
+            return T,np.where(T > 0,self.sigma(np.where(T > 0,T,1.0)),np.nan)
+
+        if nsteps is None:
+            nsteps = 20*N
+        if nsteps < N:
+            raise ValueError("nsteps (%i) must be at least the number of pulsars (%i)"%(nsteps,N))
+        quantum = float(total)/nsteps
+        T = np.zeros(N) + quantum
+        sigmas = self.sigma(T)
+        for step in range(nsteps-N):
+            trial = self.sigma(T + quantum)
+            if objective == "mean":
+                gain = weights*(sigmas - trial)
+            elif objective == "inverse_variance":
+                gain = weights*(1.0/trial**2 - 1.0/sigmas**2)
+            else: # the objective with each pulsar improved in turn, ties broken by the gain in the mean
+                candidates = np.where(np.eye(N,dtype=bool),trial[np.newaxis,:],sigmas[np.newaxis,:])
+                gain = -objectives.aggregate(candidates.T,objective,weights,target)
+                gain = np.where(gain >= np.nanmax(gain),weights*(sigmas - trial),-np.inf)
+            i = np.nanargmax(gain)
+            T[i] += quantum
+            sigmas[i] = trial[i]
+        return T,sigmas